@@ -25,6 +25,7 @@ public class Package {
     public String sourceDir;
     public long versionCode;
     public String versionName;
+    public long lastUpdateTime;
     public boolean enabled;
     public boolean system;
     public boolean debuggable;
@@ -49,6 +50,7 @@ public class Package {
         sourceDir = info.applicationInfo.publicSourceDir;
         versionCode = info.versionCode;
         versionName = info.versionName;
+        lastUpdateTime = info.lastUpdateTime;
         enabled = info.applicationInfo.enabled;
         system = (info.applicationInfo.flags & ApplicationInfo.FLAG_SYSTEM) != 0;
         debuggable = (info.applicationInfo.flags & ApplicationInfo.FLAG_DEBUGGABLE) != 0;
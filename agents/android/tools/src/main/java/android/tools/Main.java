@@ -6,6 +6,9 @@ import android.tools.processor.CommandUtils;
 import com.beust.jcommander.JCommander;
 import com.beust.jcommander.Parameter;
 
+import java.io.ByteArrayOutputStream;
+import java.io.PrintStream;
+
 
 public class Main {
 
@@ -49,6 +52,38 @@ public class Main {
         }
     }
 
+    public static final class Result {
+
+        public final String out;
+        public final String err;
+
+        Result(String out, String err) {
+            this.out = out;
+            this.err = err;
+        }
+    }
+
+    public static Result call(String[] args) throws Throwable {
+        // stdout is the command result, stderr must never be mixed into it
+        ByteArrayOutputStream out = new ByteArrayOutputStream();
+        ByteArrayOutputStream err = new ByteArrayOutputStream();
+        PrintStream outStream = new PrintStream(out, true, "UTF-8");
+        PrintStream errStream = new PrintStream(err, true, "UTF-8");
+
+        Output.out.setLocalStream(outStream);
+        Output.err.setLocalStream(errStream);
+        try {
+            parseArgs(args);
+        } finally {
+            Output.out.setLocalStream(null);
+            Output.err.setLocalStream(null);
+            outStream.flush();
+            errStream.flush();
+        }
+
+        return new Result(out.toString("UTF-8"), err.toString("UTF-8"));
+    }
+
     public static void main(String[] args) {
         if (Output.out.getStream() == null && Output.err.getStream() == null) {
             Output.out.setStream(System.out);
@@ -16,10 +16,12 @@ public interface Output {
     class OutputImpl implements Output {
 
         private PrintStream printStream = null;
+        private final ThreadLocal<PrintStream> localPrintStream = new ThreadLocal<>();
 
         @Override
         public PrintStream getStream() {
-            return printStream;
+            PrintStream localStream = localPrintStream.get();
+            return localStream != null ? localStream : printStream;
         }
 
         @Override
@@ -27,55 +29,65 @@ public interface Output {
             this.printStream = printStream;
         }
 
+        @Override
+        public void setLocalStream(PrintStream printStream) {
+            if (printStream != null) {
+                localPrintStream.set(printStream);
+            } else {
+                localPrintStream.remove();
+            }
+        }
+
         @Override
         public Output indent(int indent) {
             StringBuilder sb = new StringBuilder();
             for (int i = 0; i < indent; i++) {
                 sb.append(" ");
             }
-            printStream.print(sb.toString());
+            getStream().print(sb.toString());
             return this;
         }
 
         @Override
         public Output print(String format, Object... args) {
-            printStream.print(args.length > 0 ? String.format(format, args): format);
+            getStream().print(args.length > 0 ? String.format(format, args): format);
             return this;
         }
 
         @Override
         public Output print(Object object) {
-            printStream.print(String.valueOf(object));
+            getStream().print(String.valueOf(object));
             return this;
         }
 
         @Override
         public Output println(String format, Object... args) {
-            printStream.println(args.length > 0 ? String.format(format, args): format);
+            getStream().println(args.length > 0 ? String.format(format, args): format);
             return this;
         }
 
         @Override
         public Output println(Object object) {
-            printStream.println(String.valueOf(object));
+            getStream().println(String.valueOf(object));
             return this;
         }
 
         @Override
         public Output println(Throwable th) {
-            printStream.println(Log.getStackTraceString(th));
+            getStream().println(Log.getStackTraceString(th));
             return this;
         }
 
         @Override
         public Output println() {
-            printStream.println();
+            getStream().println();
             return this;
         }
     }
 
     PrintStream getStream();
     void setStream(PrintStream printStream);
+    void setLocalStream(PrintStream printStream);
     Output indent(int indent);
     Output print(Object object);
     Output print(String format, Object... args);
@@ -0,0 +1,217 @@
+package android.tools.command;
+
+import android.net.Credentials;
+import android.net.LocalServerSocket;
+import android.net.LocalSocket;
+import android.os.SystemClock;
+import android.tools.Main;
+import android.tools.Output;
+
+import com.beust.jcommander.Parameter;
+import com.beust.jcommander.Parameters;
+import com.google.gson.JsonArray;
+import com.google.gson.JsonElement;
+import com.google.gson.JsonObject;
+import com.google.gson.JsonParser;
+
+import org.ironman.framework.Environment;
+import org.ironman.framework.util.LogUtil;
+
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.IOException;
+import java.nio.charset.StandardCharsets;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+import java.util.concurrent.atomic.AtomicInteger;
+
+/**
+ * Long-lived agent, serves framed json-rpc requests on an abstract unix socket:
+ * [4 bytes big-endian length][{"jsonrpc": "2.0", "id": 1, "token": "...", "method": "call", "params": ["package", "--simple"]}]
+ * Only shell and root peers are accepted, and every request must carry the token given on start.
+ */
+@Parameters(commandNames = "daemon")
+public class DaemonCommand extends Command {
+
+    private static final String TAG = DaemonCommand.class.getSimpleName();
+
+    private static final int MAX_FRAME_SIZE = 16 * 1024 * 1024;
+
+    private static final int ROOT_UID = 0;
+    private static final int SHELL_UID = 2000;
+
+    @Parameter(names = {"--name"}, order = 0, required = true,
+            description = "Listen on the abstract unix socket with this name")
+    private String name = null;
+
+    @Parameter(names = {"--idle-timeout"}, order = 1,
+            description = "Exit after being idle for the given seconds, 0 means never")
+    private int idleTimeout = 600;
+
+    @Parameter(names = {"--workers"}, order = 2,
+            description = "Maximum number of requests handled concurrently")
+    private int workers = 4;
+
+    @Parameter(names = {"--token"}, order = 3, required = true,
+            description = "Reject requests that do not carry this token")
+    private String token = null;
+
+    private final AtomicInteger activeCount = new AtomicInteger(0);
+    private volatile long lastActiveTime = SystemClock.uptimeMillis();
+
+    @Override
+    public void run() throws Exception {
+        LocalServerSocket server = new LocalServerSocket(name);
+
+        try {
+            // make sure the main looper is prepared in the main thread
+            Environment.getApplication();
+        } catch (Throwable th) {
+            LogUtil.printStackTrace(TAG, th);
+        }
+
+        if (idleTimeout > 0) {
+            startIdleWatcher();
+        }
+
+        ExecutorService executor = Executors.newFixedThreadPool(Math.max(workers, 1));
+        while (true) {
+            LocalSocket socket = server.accept();
+            if (!isTrustedPeer(socket)) {
+                try {
+                    socket.close();
+                } catch (IOException ignored) {
+                }
+                continue;
+            }
+            Thread thread = new Thread(new Connection(socket, executor), "daemon-connection");
+            thread.setDaemon(true);
+            thread.start();
+        }
+    }
+
+    private static boolean isTrustedPeer(LocalSocket socket) {
+        try {
+            Credentials credentials = socket.getPeerCredentials();
+            int uid = credentials.getUid();
+            if (uid == ROOT_UID || uid == SHELL_UID) {
+                return true;
+            }
+            LogUtil.w(TAG, "Reject connection from uid %d", uid);
+        } catch (IOException e) {
+            LogUtil.printStackTrace(TAG, e);
+        }
+        return false;
+    }
+
+    private void startIdleWatcher() {
+        Thread thread = new Thread(() -> {
+            while (true) {
+                SystemClock.sleep(1000);
+                if (activeCount.get() == 0 && SystemClock.uptimeMillis() - lastActiveTime > idleTimeout * 1000L) {
+                    System.exit(0);
+                }
+            }
+        }, "daemon-idle-watcher");
+        thread.setDaemon(true);
+        thread.start();
+    }
+
+    private JsonObject handle(JsonObject request) {
+        JsonObject response = new JsonObject();
+        response.addProperty("jsonrpc", "2.0");
+        response.add("id", request.get("id"));
+
+        try {
+            String method = request.get("method").getAsString();
+            if ("ping".equals(method)) {
+                response.addProperty("result", "pong");
+            } else if ("call".equals(method)) {
+                JsonArray params = request.getAsJsonArray("params");
+                String[] args = new String[params.size()];
+                for (int i = 0; i < args.length; i++) {
+                    args[i] = params.get(i).getAsString();
+                }
+                if (args.length > 0 && "daemon".equals(args[0])) {
+                    throw new IllegalArgumentException("Nested daemon is not allowed");
+                }
+                Main.Result result = Main.call(args);
+                response.addProperty("result", result.out);
+                if (!result.err.isEmpty()) {
+                    LogUtil.w(TAG, "%s", result.err);
+                    response.addProperty("stderr", result.err);
+                }
+            } else {
+                throw new IllegalArgumentException("Method not found: " + method);
+            }
+        } catch (Throwable th) {
+            JsonObject error = new JsonObject();
+            error.addProperty("code", -32000);
+            error.addProperty("message", String.valueOf(th.getMessage()));
+            response.add("error", error);
+        }
+
+        return response;
+    }
+
+    private class Connection implements Runnable {
+
+        private final LocalSocket socket;
+        private final ExecutorService executor;
+        private final DataOutputStream output;
+
+        Connection(LocalSocket socket, ExecutorService executor) throws IOException {
+            this.socket = socket;
+            this.executor = executor;
+            this.output = new DataOutputStream(socket.getOutputStream());
+        }
+
+        @Override
+        public void run() {
+            activeCount.incrementAndGet();
+            try {
+                DataInputStream input = new DataInputStream(socket.getInputStream());
+                while (true) {
+                    int length = input.readInt();
+                    if (length < 0 || length > MAX_FRAME_SIZE) {
+                        throw new IOException("Invalid frame length: " + length);
+                    }
+                    byte[] data = new byte[length];
+                    input.readFully(data);
+                    lastActiveTime = SystemClock.uptimeMillis();
+
+                    JsonObject request = JsonParser.parseString(new String(data, StandardCharsets.UTF_8)).getAsJsonObject();
+                    JsonElement requestToken = request.get("token");
+                    if (requestToken == null || !token.equals(requestToken.getAsString())) {
+                        throw new IOException("Invalid token");
+                    }
+                    executor.execute(() -> write(handle(request)));
+                }
+            } catch (IOException e) {
+                // connection closed
+            } catch (Throwable th) {
+                Output.err.println(th);
+            } finally {
+                lastActiveTime = SystemClock.uptimeMillis();
+                activeCount.decrementAndGet();
+                try {
+                    socket.close();
+                } catch (IOException ignored) {
+                }
+            }
+        }
+
+        private void write(JsonObject response) {
+            byte[] data = response.toString().getBytes(StandardCharsets.UTF_8);
+            synchronized (output) {
+                try {
+                    output.writeInt(data.length);
+                    output.write(data);
+                    output.flush();
+                } catch (IOException e) {
+                    // connection closed
+                }
+            }
+        }
+    }
+}
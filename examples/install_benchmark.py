@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+@author  : Hu Ji
+@file    : install_benchmark.py
+@time    : 2026/10/18
+@site    : https://github.com/ice-black-tea
+@software: PyCharm 
+
+              ,----------------,              ,---------,
+         ,-----------------------,          ,"        ,"|
+       ,"                      ,"|        ,"        ,"  |
+      +-----------------------+  |      ,"        ,"    |
+      |  .-----------------.  |  |     +---------+      |
+      |  |                 |  |  |     | -==----'|      |
+      |  | $ sudo rm -rf / |  |  |     |         |      |
+      |  |                 |  |  |/----|`---=    |      |
+      |  |                 |  |  |   ,/|==== ooo |      ;
+      |  |                 |  |  |  // |(((( [33]|    ,"
+      |  `-----------------'  |," .;'| |((((     |  ,"
+      +-----------------------+  ;;  | |         |,"
+         /_)______________(_/  //'   | +---------+
+    ___________________________/___  `,
+   /  oooooooooooooooo  .o.  oooo /,   \,"-----------
+  / ==ooooooooooooooo==.o.  ooo= //   ,`\--{)B     ,"
+ /_==__==========__==_ooo__ooo=_/'   /___________,"
+"""
+import time
+from argparse import ArgumentParser, Namespace
+from typing import Optional
+
+from linktools.cli import AndroidCommand
+
+
+class Command(AndroidCommand):
+    """
+    Compare wall time of push + pm install and streaming install
+    """
+
+    def init_arguments(self, parser: ArgumentParser) -> None:
+        parser.add_argument("apk", nargs="+", help="apk path, split apks can be passed together")
+        parser.add_argument("--rounds", type=int, default=3, help="rounds of each install path")
+
+    def run(self, args: Namespace) -> Optional[int]:
+        device = args.device_picker.pick()
+        results = {}
+        for name, stream in (("push", False), ("stream", True)):
+            elapsed = []
+            for _ in range(args.rounds):
+                start_time = time.time()
+                device.install(args.apk, opts=["-r", "-t", "-d"], stream=stream)
+                elapsed.append(time.time() - start_time)
+            results[name] = elapsed
+            self.logger.info(f"{name}: {', '.join(f'{t:.3f}s' for t in elapsed)}, best {min(elapsed):.3f}s")
+
+        self.logger.info(f"speedup: {min(results['push']) / min(results['stream']):.2f}x")
+        return 0
+
+
+command = Command()
+if __name__ == '__main__':
+    command.main()
@@ -283,14 +283,11 @@ class BaseEnviron(abc.ABC):
         # set environment variable
         index = 0
         dir_names = os.environ["PATH"].split(os.pathsep)
-        for tool in tools:
-            # dirname(executable[0]) -> environ["PATH"]
-            if tool.executable:
-                dir_name = tool.dirname
-                if dir_name and dir_name not in dir_names:
-                    # insert to head
-                    dir_names.insert(index, tool.dirname)
-                    index += 1
+        for dir_name in tools.get_paths():
+            if dir_name not in dir_names:
+                # insert to head
+                dir_names.insert(index, dir_name)
+                index += 1
         # add all paths to environment variables
         os.environ["PATH"] = os.pathsep.join(dir_names)
 
@@ -27,18 +27,24 @@
  /_==__==========__==_ooo__ooo=_/'   /___________,"
 """
 
+import concurrent.futures
+import json
 import os
 import pickle
 import shutil
 import sys
+import threading
 import warnings
-from typing import TYPE_CHECKING, Dict, Union, Mapping, Iterator, Any, Tuple, List, Type
+from typing import TYPE_CHECKING, Dict, Union, Mapping, Iterator, Any, Tuple, List, Type, Optional, Iterable
 
 from . import utils
 from .decorator import cached_property
 from .metadata import __missing__
 
+utils.skip_trace_caller(__file__)
+
 if TYPE_CHECKING:
+    from rich.progress import Progress
     from ._environ import BaseEnviron
 
 
@@ -211,14 +217,30 @@ class Tool(metaclass=ToolMeta):
     def __init__(self, container: "Tools", config: Union[dict, str], **kwargs):
         self._container = container
         self._config = config
+        self._kwargs = kwargs
 
-        self._raw_config = pickle.loads(pickle.dumps(self.__default__))
-        self._raw_config.update(container.config)
-        self._raw_config.update(config)
-        self._raw_config.update(kwargs)
+    @cached_property
+    def _raw_config(self) -> dict:
+        raw_config = pickle.loads(pickle.dumps(self.__default__))
+        raw_config.update(self._container.config)
+        raw_config.update(self._config)
+        raw_config.update(self._kwargs)
+        return raw_config
 
     @cached_property
     def config(self) -> dict:
+        # 通过copy修改过配置的工具不使用索引
+        index = self._container.index if not self._kwargs else None
+        if index is not None:
+            cfg = index.get(self._config["name"])
+            if cfg is not None:
+                return cfg
+        cfg = self._parse_config()
+        if index is not None:
+            index.put(self._config["name"], cfg)
+        return cfg
+
+    def _parse_config(self) -> dict:
         cfg = self.__parser__.parse(self._raw_config)
 
         depends_on = utils.get_item(cfg, "depends_on")
@@ -326,18 +348,32 @@ class Tool(metaclass=ToolMeta):
             tool = self._container[dependency]
             tool.prepare()
 
-        # download and unzip file
+        self._install(self._download())
+
+    def _download(self, progress: "Progress" = None) -> Optional[str]:
+        """
+        下载工具文件到临时目录
+        :param progress: 多个工具同时下载时共用的progress
+        :return: 下载的文件路径，已经存在则返回None
+        """
         if self.exists:
-            pass
-        elif not self.download_url or not self.absolute_path:
+            return None
+        if not self.download_url or not self.absolute_path:
             raise ToolError(
                 f"{self} does not support on "
                 f"{self._container.system} ({self._container.machine})")
-        else:
-            self._container.logger.info(f"Download {self}: {self.download_url}")
-            url_file = self._container.environ.get_url_file(self.download_url)
-            temp_dir = self._container.environ.get_temp_path("tools", "cache")
-            temp_path = url_file.save(to_dir=temp_dir)
+        self._container.logger.info(f"Download {self}: {self.download_url}")
+        url_file = self._container.environ.get_url_file(self.download_url)
+        # 同时下载时文件名可能相同，每个工具使用单独的目录
+        temp_dir = self._container.environ.get_temp_path("tools", "cache", self.name)
+        return url_file.save(to_dir=temp_dir, progress=progress)
+
+    def _install(self, temp_path: Optional[str]) -> None:
+        """
+        解压或者移动下载的文件，并添加可执行权限
+        :param temp_path: 下载的文件路径，为空则只检查权限
+        """
+        if temp_path is not None:
             if not utils.is_empty(self.unpack_path):
                 self._container.logger.debug(f"Unpack {self} to {self.root_path}")
                 shutil.unpack_archive(temp_path, self.root_path)
@@ -392,9 +428,12 @@ class Tool(metaclass=ToolMeta):
         :param error_type: 抛出异常类型
         :return: 返回stdout输出内容
         """
-        process = self.popen(*args, capture_output=True)
+        tracer = utils.get_tracer()
+        span = tracer.span(self.name, "tool", argv=[str(arg) for arg in args]) if tracer else None
+        process = None
 
         try:
+            process = self.popen(*args, capture_output=True)
             out, err = process.exec(
                 timeout=timeout,
                 on_stdout=self._container.logger.info if log_output else None,
@@ -418,12 +457,234 @@ class Tool(metaclass=ToolMeta):
             return out or ""
 
         finally:
-            process.kill()
+            if process is not None:
+                process.kill()
+            if span is not None:
+                span.finish(exit_code=process.returncode if process is not None else None)
 
     def __repr__(self):
         return f"Tool<{self.name}>"
 
 
+class ToolScheduler(object):
+    """
+    同时准备多个工具：按depends_on找出所有需要的工具，依赖排在前面，
+    下载在有限数量的线程中并发执行，解压在单独的线程中进行，与其他工具的下载重叠；
+    依赖失败的工具不再下载，下载地址相同的工具只下载一次
+    """
+
+    def __init__(self, container: "Tools", parallel: int = None):
+        """
+        :param container: 工具集
+        :param parallel: 同时下载的数量，为空则读取TOOLS_PARALLEL配置
+        """
+        self._container = container
+        self._parallel = max(parallel or container.environ.get_config("TOOLS_PARALLEL", type=int, default=4), 1)
+        self._lock = threading.Lock()
+        self._errors: Dict[str, BaseException] = {}
+
+    def resolve(self, tools: Iterable[Tool]) -> List[Tool]:
+        """
+        展开depends_on，返回依赖在前的工具列表
+        """
+        result: Dict[str, Tool] = {}
+        visiting = []
+
+        def visit(tool: Tool):
+            if tool.name in result:
+                return
+            if tool.name in visiting:
+                cycle = " -> ".join([*visiting[visiting.index(tool.name):], tool.name])
+                raise ToolError(f"circular dependency: {cycle}")
+            visiting.append(tool.name)
+            for dependency in tool.depends_on:
+                visit(self._container[dependency])
+            visiting.pop()
+            result[tool.name] = tool
+
+        for tool in tools:
+            visit(tool)
+        return list(result.values())
+
+    def run(self, tools: Iterable[Tool]) -> Dict[str, BaseException]:
+        """
+        准备工具及其依赖
+        :param tools: 需要准备的工具
+        :return: 准备失败的工具名和对应的异常，全部成功时为空
+        """
+        from .rich import create_progress
+
+        tools = self.resolve(tools)
+        self._errors = {}
+
+        # 解压前需要等待完成的工具：所有依赖，以及下载地址相同（如同一个压缩包中的多个程序）的第一个工具，
+        # 后者不重复下载，等第一个解压后再检查是否存在
+        blockers: Dict[str, List[str]] = {}
+        owners: Dict[str, Tool] = {}
+        downloads: List[Tool] = []
+        waiting: Dict[str, Tuple[Tool, Optional[str]]] = {}
+        for tool in tools:
+            blockers[tool.name] = list(tool.depends_on)
+            if tool.exists or not tool.download_url:
+                waiting[tool.name] = (tool, None)
+            elif tool.download_url in owners:
+                blockers[tool.name].append(owners[tool.download_url].name)
+                waiting[tool.name] = (tool, None)
+            else:
+                owners[tool.download_url] = tool
+                downloads.append(tool)
+
+        done = set()
+        with create_progress() as progress, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self._parallel) as download_executor, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=1) as install_executor:
+
+            futures = {
+                download_executor.submit(self._download, tool, progress): (tool, True)
+                for tool in downloads
+            }
+
+            def schedule():
+                changed = True
+                while changed:
+                    changed = False
+                    for name, (tool, temp_path) in list(waiting.items()):
+                        if not all(blocker in done for blocker in blockers[name]):
+                            continue
+                        del waiting[name]
+                        changed = True
+                        if self._check_dependencies(tool):
+                            future = install_executor.submit(self._install, tool, temp_path, progress)
+                            futures[future] = (tool, False)
+                        else:
+                            done.add(name)
+
+            schedule()
+            while futures:
+                finished, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    tool, is_download = futures.pop(future)
+                    if self._set_error(tool, future):
+                        done.add(tool.name)
+                    elif is_download:
+                        waiting[tool.name] = (tool, future.result())
+                    else:
+                        done.add(tool.name)
+                schedule()
+
+        return dict(self._errors)
+
+    def _check_dependencies(self, tool: Tool) -> bool:
+        with self._lock:
+            if tool.name in self._errors:
+                return False
+            for dependency in tool.depends_on:
+                if dependency in self._errors:
+                    self._errors[tool.name] = ToolError(f"{tool} depends on {dependency}, which failed")
+                    return False
+            return True
+
+    def _set_error(self, tool: Tool, future: concurrent.futures.Future) -> bool:
+        error = future.exception()
+        if error is not None:
+            self._container.logger.debug(f"Prepare {tool} failed: {error}")
+            with self._lock:
+                self._errors[tool.name] = error
+        return error is not None
+
+    def _download(self, tool: Tool, progress: "Progress") -> Optional[str]:
+        # 已经失败的依赖排在前面，这种情况就不用下载了
+        if not self._check_dependencies(tool):
+            return None
+        return tool._download(progress)
+
+    def _install(self, tool: Tool, temp_path: Optional[str], progress: "Progress") -> None:
+        if temp_path is None:
+            # 没有单独下载的工具，一般已经存在，或者已经随同一个压缩包解压
+            temp_path = tool._download(progress)
+        tool._install(temp_path)
+
+
+class ToolIndex(object):
+    """
+    工具解析结果的索引，保存每个工具解析后的配置和需要加入PATH的目录，
+    命中时不需要在每次启动时解析所有工具、在PATH中查找可执行文件；
+    工具配置、PATH（包括其中目录的修改时间）、系统、架构任一变化都会生成新的键
+    """
+
+    version = 1
+
+    # 不同的PATH（如子进程继承了加入工具目录后的PATH）各自保留一份
+    max_entries = 8
+
+    def __init__(self, path: str, key: str):
+        self._path = path
+        self._key = key
+        self._entries: Dict[str, dict] = {}
+        self._items: Dict[str, dict] = {}
+        self._paths: Optional[List[str]] = None
+        self._dirty = False
+        self._load()
+
+    @property
+    def key(self) -> str:
+        return self._key
+
+    @property
+    def paths(self) -> Optional[List[str]]:
+        """
+        需要加入PATH的工具目录，没有命中索引时为None
+        """
+        return self._paths
+
+    def _load(self) -> None:
+        try:
+            with open(self._path, "rt", encoding="utf-8") as fd:
+                data = json.load(fd)
+        except (OSError, ValueError):
+            return
+        if not isinstance(data, dict) or data.get("version") != self.version:
+            return
+        self._entries = data.get("entries") or {}
+        entry = self._entries.get(self._key)
+        if entry is not None:
+            self._items = entry.get("items") or {}
+            self._paths = entry.get("paths")
+
+    def get(self, name: str) -> Optional[dict]:
+        return self._items.get(name)
+
+    def put(self, name: str, cfg: dict) -> None:
+        try:
+            # 只保存可以序列化的配置，保证读出来和解析结果一致
+            self._items[name] = json.loads(json.dumps(cfg))
+            self._dirty = True
+        except (TypeError, ValueError):
+            pass
+
+    def save(self, paths: List[str]) -> None:
+        """
+        所有工具解析完成后保存
+        :param paths: 需要加入PATH的工具目录
+        """
+        if not self._dirty and self._paths == paths:
+            return
+        self._paths = paths
+        self._entries.pop(self._key, None)
+        self._entries[self._key] = {"items": self._items, "paths": paths}
+        while len(self._entries) > self.max_entries:
+            self._entries.pop(next(iter(self._entries)))
+        try:
+            temp_path = f"{self._path}.{os.getpid()}.tmp"
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(temp_path, "wt", encoding="utf-8") as fd:
+                json.dump({"version": self.version, "entries": self._entries}, fd)
+            os.replace(temp_path, self._path)
+            self._dirty = False
+        except OSError as e:
+            warnings.warn(f"save tool index failed: {e}")
+
+
 class Tools(object):
 
     def __init__(self, env: "BaseEnviron", **kwargs):
@@ -435,6 +696,58 @@ class Tools(object):
         self.config.setdefault("machine", utils.get_machine())
         self.config.setdefault("interpreter", sys.executable)
 
+    @cached_property
+    def index(self) -> Optional[ToolIndex]:
+        """
+        工具解析结果的索引，TOOLS_INDEX配置为false时不使用
+        """
+        if not self.environ.get_config("TOOLS_INDEX", type=bool, default=True):
+            return None
+        paths = []
+        for path in os.environ.get("PATH", "").split(os.pathsep):
+            try:
+                # 目录中增删文件会改变修改时间，shutil.which的结果可能不同
+                paths.append((path, os.stat(path).st_mtime_ns))
+            except OSError:
+                paths.append((path, None))
+        data = json.dumps(
+            [ToolIndex.version, self.config, self.environ.data_path, paths,
+             {name: tool._config for name, tool in self.items.items()}],
+            sort_keys=True, default=str,
+        )
+        return ToolIndex(self.environ.get_temp_path("tools", "index.json"), utils.get_md5(data))
+
+    def prepare(self, *tools: Union[str, Tool], parallel: int = None) -> Dict[str, BaseException]:
+        """
+        同时准备多个工具及其依赖，参考ToolScheduler
+        :param tools: 工具或者工具名，为空则准备当前平台支持的所有工具
+        :param parallel: 同时下载的数量
+        :return: 准备失败的工具名和对应的异常，全部成功时为空
+        """
+        if tools:
+            tools = [self[tool] if isinstance(tool, str) else tool for tool in tools]
+        else:
+            tools = [tool for tool in self if tool.exists or tool.download_url]
+        return ToolScheduler(self, parallel=parallel).run(tools)
+
+    def get_paths(self) -> List[str]:
+        """
+        需要加入PATH的工具目录，命中索引时直接使用索引中的结果，工具在第一次使用时才解析
+        """
+        index = self.index
+        if index is not None and index.paths is not None:
+            return index.paths
+        paths = []
+        for tool in self:
+            # dirname(executable[0]) -> environ["PATH"]
+            if tool.executable:
+                dir_name = tool.dirname
+                if dir_name and dir_name not in paths:
+                    paths.append(dir_name)
+        if index is not None:
+            index.save(paths)
+        return paths
+
     @property
     def system(self) -> str:
         return self.config["system"]
@@ -38,6 +38,7 @@ from .rich import create_progress
 from .utils import get_md5, ignore_error, timeoutable, parse_header, guess_file_name, user_agent
 
 if TYPE_CHECKING:
+    from rich.progress import Progress
     from ._environ import BaseEnviron
     from .utils import Timeout
 
@@ -86,7 +87,7 @@ class DownloadContext:
     def __exit__(self, *args, **kwargs):
         self._db.__exit__(*args, **kwargs)
 
-    def download(self, timeout: "Timeout"):
+    def download(self, timeout: "Timeout", progress: "Progress" = None):
         self._environ.logger.debug(f"Download file to temp path {self.file_path}")
 
         initial = 0
@@ -107,35 +108,42 @@ class DownloadContext:
         except ModuleNotFoundError:
             fn = self._download_with_urllib
 
-        with create_progress() as progress:
-            task_id = progress.add_task(self.file_name, total=None)
-            progress.advance(task_id, initial)
-
-            with open(self.file_path, "ab") as fp:
-                offset = 0
-                for data in fn(timeout.remain):
-                    advance = len(data)
-                    offset += advance
-                    fp.write(data)
+        # 多个文件同时下载时共用一个progress，否则每次下载单独显示
+        if progress is None:
+            with create_progress() as progress:
+                self._download_to(fn, initial, progress, timeout)
+        else:
+            self._download_to(fn, initial, progress, timeout)
+
+    def _download_to(self, fn, initial: int, progress: "Progress", timeout: "Timeout"):
+        task_id = progress.add_task(self.file_name, total=None)
+        progress.advance(task_id, initial)
+
+        with open(self.file_path, "ab") as fp:
+            offset = 0
+            for data in fn(timeout.remain):
+                advance = len(data)
+                offset += advance
+                fp.write(data)
+                progress.update(
+                    task_id,
+                    advance=advance,
+                    description=self.file_name
+                )
+                if self.file_size is not None:
                     progress.update(
                         task_id,
-                        advance=advance,
-                        description=self.file_name
+                        total=initial + self.file_size
                     )
-                    if self.file_size is not None:
-                        progress.update(
-                            task_id,
-                            total=initial + self.file_size
-                        )
-
-            if self.file_size is not None and self.file_size > offset:
-                raise DownloadError(
-                    f"download size {initial + self.file_size} bytes was expected, "
-                    f"got {initial + offset} bytes"
-                )
 
-            if os.path.getsize(self.file_path) == 0:
-                raise DownloadError(f"download {self.url} error")
+        if self.file_size is not None and self.file_size > offset:
+            raise DownloadError(
+                f"download size {initial + self.file_size} bytes was expected, "
+                f"got {initial + offset} bytes"
+            )
+
+        if os.path.getsize(self.file_path) == 0:
+            raise DownloadError(f"download {self.url} error")
 
     def _download_with_requests(self, timeout: float):
         import requests
@@ -209,13 +217,15 @@ class UrlFile:
         )
 
     @timeoutable
-    def save(self, to_dir: str = None, name: str = None, timeout: "Timeout" = None, retry: int = 2, **kwargs) -> str:
+    def save(self, to_dir: str = None, name: str = None, timeout: "Timeout" = None, retry: int = 2,
+             progress: "Progress" = None, **kwargs) -> str:
         """
         从指定url下载文件
         :param to_dir: 文件路径，如果为空，则保存到temp目录
         :param name: 文件名，如果为空，则默认为下载的文件名
         :param timeout: 超时时间
         :param retry: 重试次数
+        :param progress: 显示下载进度的progress，同时下载多个文件时传入同一个，为空则单独显示
         :return: 文件路径
         """
 
@@ -255,7 +265,7 @@ class UrlFile:
                                 self._environ.logger.warning(
                                     f"Download retry {context.max_times - i}, "
                                     f"{last_error.__class__.__name__}: {last_error}")
-                            context.download(timeout)
+                            context.download(timeout, progress=progress)
                             context.completed = True
                             break
                         except Exception as e:
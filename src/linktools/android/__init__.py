@@ -28,4 +28,18 @@
 """
 
 from .adb import Adb, Device, AdbError
-from .struct import Package, Permission, Component, Activity, Service, Receiver, Provider, IntentFilter
+from .client import AdbClient, AdbConnectionError, AdbProtocolError
+from .agent import AgentDaemon, AgentDaemonError
+from .session import ShellSession, ShellSessionError, ShellSessionLostError
+from .group import DeviceGroup, DeviceResult
+from .sync import SyncEngine, SyncResult
+from .install import ApkFile, InstallError
+from .tracker import AdbDeviceTracker
+from .aio import AsyncAdb, AsyncDevice, AsyncAdbClient
+from .sampler import ProcessSampler, ProcessSnapshot, ProcessSample
+from .netstat import SocketMonitor, SocketChange
+from .forward import ForwardManager, ForwardRegistry, ForwardHandle
+from .screen import ScreenFrame, ScreenRecorder
+from .redirect import Redirect, RedirectEngine, RedirectRule
+from .foreground import ForegroundTracker
+from .struct import Package, Permission, Component, Activity, Service, Receiver, Provider, IntentFilter, ShellResult
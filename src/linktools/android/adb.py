@@ -28,48 +28,448 @@
 """
 
 import json
+import os
 import re
+import shlex
+import threading
 import time
-from typing import Optional, Any, Generator, List
+from typing import TYPE_CHECKING, Optional, Any, Generator, List, Dict, Tuple, Union, Iterable, ContextManager, Set, \
+    BinaryIO, Callable
 
-from .struct import Package, UnixSocket, InetSocket, Process
+from .memo import memoize, invalidates, memo_cache
+from .struct import Package, UnixSocket, InetSocket, Process, ShellResult
 from .. import utils, environ
 from ..decorator import cached_property, cached_classproperty
 from ..device import BridgeError, Bridge, BaseDevice
+from ..metadata import __missing__
 from ..reactor import Stoppable
 
+if TYPE_CHECKING:
+    from .agent import AgentDaemon
+    from .client import AdbClient
+    from .forward import ForwardManager, ForwardHandle
+    from .foreground import ForegroundTracker
+    from .redirect import Redirect
+    from .screen import ScreenFrame, ScreenRecorder
+    from .stream import ExecStream
+    from .session import ShellSession
+    from .install import ApkFile
+    from .sync import SyncResult
+    from .tracker import AdbDeviceTracker
+
 _logger = environ.get_logger("android.adb")
 
+utils.skip_trace_caller(__file__)
+
+_alive_states = ("bootloader", "device", "recovery", "sideload")
+
+# 老版本adbd的shell命令最长4KB，除去agent启动参数后，每批包名不超过3KB
+_package_names_max_length = 3 * 1024
+
 
 class AdbError(BridgeError):
     pass
 
 
+_json_whitespace = re.compile(r"\s*")
+
+
+def _iter_json_array(data: str) -> Generator[Any, None, None]:
+    """
+    逐个解析json数组中的元素，避免一次性构造整个数组
+    """
+    decoder = json.JSONDecoder()
+    index = _json_whitespace.match(data, 0).end()
+    if data[index:index + 1] != "[":
+        raise AdbError(f"invalid json array: {data[:100]}")
+    index += 1
+    while True:
+        index = _json_whitespace.match(data, index).end()
+        if data[index:index + 1] == "]":
+            return
+        obj, index = decoder.raw_decode(data, index)
+        yield obj
+        index = _json_whitespace.match(data, index).end()
+        if data[index:index + 1] == ",":
+            index += 1
+
+
 class Adb(Bridge):
 
-    def __init__(self, options: List[str] = None):
+    _clients: Dict[Tuple[str, int], "AdbClient"] = {}
+    _clients_lock = threading.Lock()
+
+    def __init__(self, options: List[str] = None, native: bool = None):
+        """
+        :param options: adb参数
+        :param native: 是否直接通过adb server协议通信，为空则读取ANDROID_ADB_NATIVE配置
+        """
         super().__init__(
             tool=environ.get_tool("adb"),
             options=options,
             error_type=AdbError
         )
+        if native is None:
+            native = environ.get_config("ANDROID_ADB_NATIVE", type=bool, default=False)
+        self._native = native
+        self._native_checked_time = None
+
+    @property
+    def options(self) -> List[str]:
+        return list(self._options)
+
+    @property
+    def native(self) -> bool:
+        return self._native
+
+    @property
+    def client(self) -> "Optional[AdbClient]":
+        """
+        adb server协议客户端，未开启native、adb参数不支持或adb server不可用时返回None
+        :return: 客户端对象
+        """
+        if not self._native:
+            return None
+
+        address = self._parse_server_address(self._options)
+        if address is None:
+            return None
+
+        from .client import AdbClient
+
+        with self._clients_lock:
+            client = self._clients.get(address)
+            if client is None:
+                client = self._clients[address] = AdbClient(*address)
+
+        # adb server不可用时，每隔一段时间重新检查一次，期间回退到adb命令行
+        if self._native_checked_time is not None:
+            if time.time() - self._native_checked_time < 5:
+                return None
+            if not client.is_available():
+                self._native_checked_time = time.time()
+                return None
+            self._native_checked_time = None
+
+        return client
+
+    def mark_unavailable(self) -> None:
+        """
+        标记adb server不可用，短时间内回退到adb命令行
+        """
+        self._native_checked_time = time.time()
+
+    @classmethod
+    def _parse_server_address(cls, options: List[str]) -> Optional[Tuple[str, int]]:
+        host, port = None, None
+        index = 0
+        while index < len(options):
+            option = str(options[index])
+            if option == "-H" and index + 1 < len(options):
+                host = str(options[index + 1])
+                index += 2
+            elif option == "-P" and index + 1 < len(options):
+                port = utils.int(options[index + 1], default=None)
+                if port is None:
+                    return None
+                index += 2
+            else:
+                # 其他参数（如-a、-L、-t）无法通过协议实现，只能交给adb处理
+                return None
+        if not host or host == "localhost":
+            host = "127.0.0.1"
+        if not port:
+            from .client import _get_server_port
+            port = _get_server_port()
+        return host, port
 
     def list_devices(self, alive: bool = None) -> Generator["Device", None, None]:
         """
-        获取所有设备列表
+        获取所有设备列表，设备跟踪器运行时直接从设备表中读取
         :param alive: 只显示在线的设备
         :return: 设备号数组
         """
-        result = self.exec("devices")
-        lines = result.splitlines()
-        for i in range(1, len(lines)):
-            splits = lines[i].split(maxsplit=1)
-            if len(splits) >= 2:
-                device, status = splits
-                if alive is None:
-                    yield Device(device, adb=self)
-                elif alive == (status in ("bootloader", "device", "recovery", "sideload")):
-                    yield Device(device, adb=self)
+        tracker = self.tracker
+        if tracker is not None and tracker.is_ready:
+            for device in tracker.get_devices(alive=alive):
+                yield Device(device.id, adb=self)
+            return
+        for device, status in self.get_device_states().items():
+            if alive is None:
+                yield Device(device, adb=self)
+            elif alive == (status in _alive_states):
+                yield Device(device, adb=self)
+
+    def get_device_states(self) -> Dict[str, str]:
+        """
+        获取所有设备的状态
+        :return: 设备号 -> 状态
+        """
+        lines = None
+        client = self.client
+        if client is not None:
+            from .client import AdbConnectionError
+            try:
+                lines = ["", *client.host_request("host:devices").splitlines()]
+            except AdbConnectionError as e:
+                _logger.debug(f"Fallback to adb command: {e}")
+                self.mark_unavailable()
+        if lines is None:
+            result = self.exec("devices")
+            lines = result.splitlines()
+        return parse_device_states(lines[1:])
+
+    def track_devices(self) -> "AdbDeviceTracker":
+        """
+        启动设备跟踪器，通过host:track-devices长连接实时更新设备表，启动后list_devices不再需要调用adb
+        :return: 设备跟踪器
+        """
+        return super().track_devices()
+
+    def _create_tracker(self) -> "AdbDeviceTracker":
+        from .tracker import AdbDeviceTracker
+        return AdbDeviceTracker(self)
+
+
+def parse_agent_output(result: str, agent_info: dict) -> str:
+    """
+    截取agent输出中start_flag和end_flag之间的内容，只有start_flag说明agent执行出错
+    """
+    start_flag = agent_info["start_flag"]
+    end_flag = agent_info["end_flag"]
+    begin = result.find(start_flag)
+    end = result.rfind(end_flag)
+    if begin >= 0 and end >= 0:
+        begin = begin + len(start_flag)
+        result = result[begin: end]
+    elif begin >= 0:
+        begin = begin + len(start_flag)
+        raise AdbError(result[begin:])
+    return result
+
+
+def parse_device_states(lines: Iterable[str]) -> Dict[str, str]:
+    """
+    解析adb devices输出的设备列表
+    """
+    states = {}
+    for line in lines:
+        splits = line.split(maxsplit=1)
+        if len(splits) >= 2:
+            states[splits[0]] = splits[1].strip()
+    return states
+
+
+def parse_transport_ids(lines: Iterable[str]) -> Dict[str, str]:
+    """
+    解析adb devices -l输出中的transport_id，旧版本adb没有该字段
+    """
+    transport_ids = {}
+    for line in lines:
+        splits = line.split()
+        for item in splits[2:]:
+            if item.startswith("transport_id:"):
+                transport_ids[splits[0]] = item[len("transport_id:"):]
+    return transport_ids
+
+
+# 以下函数只负责参数拼接和结果解析，不调用adb，Device和AsyncDevice共用
+
+def _get_native_command(args: Iterable[Any]) -> Optional[Tuple[str, List[str]]]:
+    """
+    判断adb命令能否通过adb server协议执行
+    :return: 命令名和参数，不支持时返回None，交给adb命令行处理
+    """
+    args = [str(arg) for arg in args]
+    if len(args) < 2:
+        return None
+    command, args = args[0], args[1:]
+    if command in ("shell", "exec-out"):
+        return (command, args) if not args[0].startswith("-") else None
+    if command in ("push", "pull") and len(args) == 2:
+        return command, args
+    return None
+
+
+def _log_output(out: str, err: str = "") -> None:
+    for line in out.splitlines():
+        if line.rstrip():
+            _logger.info(line.rstrip())
+    for line in err.splitlines():
+        if line.rstrip():
+            _logger.error(line.rstrip())
+
+
+def _make_native_result(out: bytes, err: bytes, exit_code: Optional[int],
+                        ignore_errors: bool = False, log_output: bool = False) -> str:
+    """
+    与adb命令行保持一致：返回码不为0且有错误输出时抛异常，否则返回去掉首尾空白的输出
+    """
+    out = out.decode(errors="ignore")
+    err = err.decode(errors="ignore")
+    if log_output:
+        _log_output(out, err)
+    if not ignore_errors and exit_code not in (0, None):
+        err = err.strip()
+        if err:
+            raise AdbError(err)
+    return out.strip()
+
+
+def _make_shell_args(args: Iterable[Any], su: bool = False, user: str = None) -> List[str]:
+    cmd = utils.list2cmdline([str(arg) for arg in args])
+    if su:
+        return ["shell", "su", "-c", cmd]
+    elif user:
+        return ["shell", "su", user, "-c", cmd]
+    return ["shell", cmd]
+
+
+def _make_agent_args(agent_path: str, agent_info: dict, args: Iterable[str], flag: bool = False) -> List[str]:
+    agent_args = [
+        "CLASSPATH=%s" % agent_path,
+        "app_process", "/", agent_info["main"],
+    ]
+    if flag:
+        agent_args.extend([
+            "--start-flag", agent_info["start_flag"],
+            "--end-flag", agent_info["end_flag"]
+        ])
+    agent_args.extend(args)
+    return agent_args
+
+
+def _make_package_args(package_names: Iterable[str], system: bool = None) -> List[str]:
+    agent_args = ["package"]
+    if not utils.is_empty(package_names):
+        agent_args.append("--packages")
+        agent_args.extend(package_names)
+    if system is True:
+        agent_args.append("--system")
+    elif system is False:
+        agent_args.append("--non-system")
+    return agent_args
+
+
+def _split_package_names(package_names: Iterable[str]) -> List[List[str]]:
+    batches, batch, length = [], [], 0
+    for name in package_names:
+        if batch and length + len(name) + 1 > _package_names_max_length:
+            batches.append(batch)
+            batch, length = [], 0
+        batch.append(name)
+        length += len(name) + 1
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class _PackageQuery:
+    """
+    一次包信息查询，负责包信息缓存的查找和更新，调用agent由使用方完成：
+        query = _PackageQuery(serial, agent_args, simple=simple, refresh=refresh)
+        args = query.args
+        while args is not None:
+            args = query.feed(call_agent(*args))
+        packages = query.iter_packages()
+    """
+
+    # 边解析边写入缓存时，每批写入的包数量
+    _put_batch_size = 100
+
+    def __init__(self, serial: str, agent_args: Iterable[str], simple: bool = None, refresh: bool = False):
+        from .cache import package_cache
+
+        self._serial = serial
+        self._agent_args = tuple(agent_args)
+        # 只需要基本信息或者没有开启缓存时，直接解析agent输出
+        self._direct = simple is True or not package_cache.enabled
+        self._out: Optional[str] = None
+        self._full_out: Optional[str] = None
+        self._simple_objs: Optional[List[dict]] = None
+        # 缓存命中的包保存未解析的json字符串，在iter_packages中逐个解析
+        self._cached_objs: Dict[str, Union[dict, str]] = {}
+        self._missing_names: List[str] = []
+        self._batches: List[List[str]] = []
+        self.args: Tuple[str, ...] = self._agent_args
+        if simple is True:
+            self.args = (*self._agent_args, "--simple")
+        elif not self._direct and not refresh:
+            # 开启缓存时先获取简单信息，只有新增或者版本有变化的包才需要获取完整信息
+            self.args = (*self._agent_args, "--simple")
+        elif not self._direct:
+            # 强制刷新时直接获取完整信息，在iter_packages中边解析边更新缓存
+            self._simple_objs = []
+
+    def feed(self, out: str) -> Optional[Tuple[str, ...]]:
+        """
+        传入上一次agent调用的输出，可能会读写包信息缓存
+        :return: 下一次agent调用的参数，不需要再调用时返回None
+        """
+        from .cache import package_cache
+
+        if self._direct:
+            self._out = out
+            return None
+
+        if self._simple_objs is None:
+            self._simple_objs = json.loads(out)
+            self._cached_objs = package_cache.get(self._serial, self._simple_objs, raw=True)
+            self._missing_names = [obj["name"] for obj in self._simple_objs if obj.get("name") not in self._cached_objs]
+            if self._missing_names and not self._cached_objs:
+                # 一个都没有命中（如第一次查询），一次性获取完整信息，不需要传入所有包名
+                return self._agent_args
+            # 包名太多时分批获取，避免超过adbd的命令长度限制
+            self._batches = _split_package_names(self._missing_names)
+        elif not self._cached_objs:
+            # 完整信息留到iter_packages中逐个解析
+            self._full_out = out
+            return None
+        else:
+            objs = list(_iter_json_array(out))
+            package_cache.put(self._serial, objs)
+            self._cached_objs.update({obj["name"]: obj for obj in objs if obj.get("name")})
+
+        if self._batches:
+            return ("package", "--packages", *self._batches.pop(0))
+
+        if self._agent_args == ("package",):
+            package_cache.retain(self._serial, [obj["name"] for obj in self._simple_objs if obj.get("name")])
+        _logger.debug(f"Package cache of {self._serial}: {len(self._simple_objs) - len(self._missing_names)} hits, "
+                      f"{len(self._missing_names)} misses, total {package_cache.stats}")
+        return None
+
+    def iter_packages(self) -> Generator[Package, None, None]:
+        if self._direct:
+            for obj in _iter_json_array(self._out):
+                yield Package(obj)
+            return
+        if self._full_out is not None:
+            yield from self._iter_full_packages()
+            return
+        for obj in self._simple_objs:
+            obj = self._cached_objs.pop(obj.get("name"), None)
+            if isinstance(obj, str):
+                obj = json.loads(obj)
+            if obj is not None:
+                yield Package(obj)
+
+    def _iter_full_packages(self) -> Generator[Package, None, None]:
+        from .cache import package_cache
+
+        names, objs = [], []
+        for obj in _iter_json_array(self._full_out):
+            if obj.get("name"):
+                names.append(obj["name"])
+                objs.append(obj)
+                if len(objs) >= self._put_batch_size:
+                    package_cache.put(self._serial, objs)
+                    objs = []
+            yield Package(obj)
+        package_cache.put(self._serial, objs)
+        if self._agent_args == ("package",):
+            package_cache.retain(self._serial, names)
+        _logger.debug(f"Package cache of {self._serial}: {len(names)} updated, total {package_cache.stats}")
 
 
 class Device(BaseDevice):
@@ -97,6 +497,14 @@ class Device(BaseDevice):
         """
         return self._id
 
+    @property
+    def adb(self) -> Adb:
+        """
+        获取adb对象
+        :return: adb对象
+        """
+        return self._adb
+
     @cached_property
     def name(self) -> str:
         """
@@ -122,6 +530,36 @@ class Device(BaseDevice):
             return "x86"
         raise AdbError("unknown abi: %s" % result)
 
+    @cached_property
+    def features(self) -> "Set[str]":
+        """
+        获取adb支持的特性，如shell_v2、cmd等
+        :return: 特性集合
+        """
+        client = self._adb.client
+        if client is not None:
+            return set(client.get_features(self._id))
+        return set(self._adb.exec("-s", self._id, "features", ignore_errors=True).split())
+
+    @utils.timeoutable
+    def get_transport_id(self, timeout: utils.Timeout = None) -> Optional[str]:
+        """
+        获取adb server为当前连接分配的transport_id，只访问本机adb server，设备断开重连后会变化
+        :return: transport_id，旧版本adb不支持时返回None
+        """
+        lines = None
+        client = self._adb.client
+        if client is not None:
+            from .client import AdbConnectionError
+            try:
+                lines = client.host_request("host:devices-l", timeout=timeout).splitlines()
+            except AdbConnectionError as e:
+                _logger.debug(f"Fallback to adb command: {e}")
+                self._adb.mark_unavailable()
+        if lines is None:
+            lines = self._adb.exec("devices", "-l", ignore_errors=True, timeout=timeout).splitlines()
+        return parse_transport_ids(lines).get(self._id)
+
     @cached_property
     def uid(self) -> int:
         """
@@ -146,31 +584,117 @@ class Device(BaseDevice):
         :param args: 命令行参数
         :return: adb输出结果
         """
+        tracer = utils.get_tracer()
+        if tracer is None:
+            return self._exec(*args, **kwargs)
+        with tracer.span(f"adb {args[0] if args else ''}".rstrip(), "device",
+                         argv=[str(arg) for arg in args], serial=self.id) as span:
+            result = self._exec(*args, **kwargs)
+            if isinstance(result, str):
+                span.args["output_size"] = len(result)
+            return result
+
+    def _exec(self, *args: [Any], **kwargs) -> str:
+        client = self._adb.client
+        if client is not None:
+            from .client import AdbConnectionError
+            try:
+                result = self._exec_native(client, *args, **kwargs)
+                if result is not __missing__:
+                    return result
+            except AdbConnectionError as e:
+                _logger.debug(f"Fallback to adb command: {e}")
+                self._adb.mark_unavailable()
         args = ["-s", self.id, *args]
         return self._adb.exec(*args, **kwargs)
 
+    def _exec_native(self, client: "AdbClient", *args: [Any], timeout: utils.Timeout = None,
+                     ignore_errors: bool = False, log_output: bool = False) -> Any:
+        """
+        通过adb server协议执行命令，不支持的命令返回__missing__，交给adb命令行处理
+        """
+        native_command = _get_native_command(args)
+        if native_command is None:
+            return __missing__
+
+        command, args = native_command
+        out, err, exit_code = b"", b"", None
+
+        try:
+            if command in ("shell", "exec-out"):
+                # 与adb命令行行为保持一致，参数直接用空格拼接
+                cmdline = " ".join(args)
+                if command == "shell":
+                    out, err, exit_code = client.shell(self.id, cmdline, timeout=timeout)
+                else:
+                    out = client.exec_out(self.id, cmdline, timeout=timeout)
+
+            elif command == "push":
+                src, dst = args
+                if not os.path.isfile(src):
+                    return __missing__
+                if dst.endswith("/") or client.stat(self.id, dst, timeout=timeout).is_dir:
+                    dst = dst.rstrip("/") + "/" + os.path.basename(src)
+                client.push(self.id, src, dst, timeout=timeout)
+                exit_code = 0
+
+            elif command == "pull":
+                src, dst = args
+                remote_stat = client.stat(self.id, src, timeout=timeout)
+                if not remote_stat.is_file:
+                    return __missing__
+                if os.path.isdir(dst):
+                    dst = os.path.join(dst, os.path.basename(src))
+                client.pull(self.id, src, dst, timeout=timeout)
+                exit_code = 0
+
+        except AdbError as e:
+            from .client import AdbConnectionError
+            if isinstance(e, AdbConnectionError) or not ignore_errors:
+                raise
+            return ""
+
+        return _make_native_result(out, err, exit_code, ignore_errors=ignore_errors, log_output=log_output)
+
     def make_shell_args(self, *args: [Any], privilege: bool = False, user: str = None):
-        cmd = utils.list2cmdline([str(arg) for arg in args])
-        if privilege and self.uid != 0:
-            args = ["shell", "su", "-c", cmd]
-        elif user:
-            args = ["shell", "su", user, "-c", cmd]
-        else:
-            args = ["shell", cmd]
-        return args
+        return _make_shell_args(args, su=privilege and self.uid != 0, user=user)
 
     @utils.timeoutable
-    def shell(self, *args: [Any], privilege: bool = False, user: str = None, **kwargs) -> str:
+    def shell(self, *args: [Any], privilege: bool = False, user: str = None, session: bool = None, **kwargs) -> str:
         """
         执行shell
         :param args: shell命令
         :param privilege: 是否以root权限运行
         :param user: 以指定user运行
+        :param session: 是否复用常驻的shell会话，为空则读取ANDROID_SHELL_SESSION配置
         :return: adb输出结果
         """
+        if session is None:
+            session = environ.get_config("ANDROID_SHELL_SESSION", type=bool, default=False)
+        if session:
+            from .session import ShellSessionError
+            try:
+                with self.session(privilege=privilege, user=user, timeout=kwargs.get("timeout")) as s:
+                    return s.shell(*args, **kwargs)
+            except ShellSessionError as e:
+                # 只有命令还没有发送时才能回退，否则命令可能被执行两次
+                _logger.debug(f"Fallback to adb shell: {e}")
         args = self.make_shell_args(*args, privilege=privilege, user=user)
         return self.exec(*args, **kwargs)
 
+    @utils.timeoutable
+    def session(self, privilege: bool = False, user: str = None,
+                timeout: utils.Timeout = None) -> "ContextManager[ShellSession]":
+        """
+        从会话池中获取一个常驻的shell会话，省去每次创建进程和su的开销
+        :param privilege: 是否以root权限运行
+        :param user: 以指定user运行
+        :param timeout: 创建会话的超时时间
+        :return: 会话对象，退出上下文后放回会话池
+        """
+        from .session import open_session
+        return open_session(self, privilege=privilege, user=user, timeout=timeout)
+
     @utils.timeoutable
     def sudo(self, *args: [Any], **kwargs) -> str:
         """
@@ -182,37 +706,147 @@ class Device(BaseDevice):
         return self.shell(*args, **kwargs)
 
     @utils.timeoutable
-    def install(self, path_or_url: str, opts: [str] = (), **kwargs):
+    def shell_batch(self, commands: "Iterable[Union[str, Iterable[Any]]]", privilege: bool = False, user: str = None,
+                    timeout: utils.Timeout = None, ignore_errors: bool = False,
+                    log_output: bool = False) -> List[ShellResult]:
+        """
+        把多条shell命令合并成一个脚本执行，只需要一次adb调用
+        :param commands: 命令列表，字符串作为脚本原样执行，列表则和shell一样拼接参数
+        :param privilege: 是否以root权限运行
+        :param user: 以指定user运行
+        :param timeout: 超时时间
+        :param ignore_errors: 忽略错误，报错不会抛异常
+        :param log_output: 把输出打印到logger中
+        :return: 每条命令的执行结果，没有执行完的命令exit_code为None
+        """
+        commands = [
+            command if isinstance(command, str) else utils.list2cmdline([str(arg) for arg in command])
+            for command in commands
+        ]
+        if not commands:
+            return []
+
+        # 每条命令执行完后，分别往stdout和stderr输出分隔标记，stdout的标记中带上返回码
+        mark = f"__linktools_{utils.make_uuid()}__"
+        script = "\n".join(
+            f"{command}\n"
+            f"__rc=$?; echo; echo {mark}:{index}:$__rc; echo >&2; echo {mark}:{index}:e >&2"
+            for index, command in enumerate(commands)
+        )
+        switch_user = (privilege and self.uid != 0) or bool(user)
+        if privilege and self.uid != 0:
+            script = f"su -c {shlex.quote(script)}"
+        elif user:
+            script = f"su {shlex.quote(user)} -c {shlex.quote(script)}"
+
+        out, err = self._shell_output(script, timeout=timeout)
+
+        # 不支持shell_v2时，stderr和stdout混在一起，需要先把stderr的标记去掉
+        out_pattern = re.compile(rf"\r?\n{mark}:(\d+):(\d+)\r?\n")
+        err_pattern = re.compile(rf"\r?\n{mark}:(\d+):e\r?\n")
+        out = err_pattern.sub("", out)
+
+        outs, errs, exit_codes = {}, {}, {}
+        out_pos = err_pos = 0
+        for match in out_pattern.finditer(out):
+            index = int(match.group(1))
+            outs[index], exit_codes[index] = out[out_pos:match.start()], int(match.group(2))
+            out_pos = match.end()
+        for match in err_pattern.finditer(err):
+            errs[int(match.group(1))] = err[err_pos:match.start()]
+            err_pos = match.end()
+        # 超时等情况下，剩余输出都属于第一条没有执行完的命令
+        if len(exit_codes) < len(commands):
+            outs.setdefault(len(exit_codes), out[out_pos:])
+            errs.setdefault(len(exit_codes), err[err_pos:])
+
+        results = []
+        for index, command in enumerate(commands):
+            result = ShellResult(command, outs.get(index, ""), errs.get(index, ""), exit_codes.get(index))
+            if log_output:
+                for line in result.out.splitlines():
+                    if line.rstrip():
+                        _logger.info(line.rstrip())
+                for line in result.err.splitlines():
+                    if line.rstrip():
+                        _logger.error(line.rstrip())
+            results.append(result)
+
+        if not ignore_errors:
+            # su不存在或者被拒绝时一条命令都没有执行，不会输出任何标记
+            if switch_user and not exit_codes and not err_pattern.search(err):
+                raise AdbError(err.strip() or out.strip() or "switch user failed")
+            for result in results:
+                if result.exit_code not in (0, None) and result.err.strip():
+                    raise AdbError(result.err.strip())
+
+        return results
+
+    def _shell_output(self, cmdline: str, timeout: utils.Timeout) -> Tuple[str, str]:
+        """
+        执行shell命令，分别返回stdout和stderr的原始内容
+        """
+        client = self._adb.client
+        if client is not None:
+            from .client import AdbConnectionError
+            try:
+                out, err, _ = client.shell(self.id, cmdline, timeout=timeout)
+                return out.decode(errors="ignore"), err.decode(errors="ignore")
+            except AdbConnectionError as e:
+                _logger.debug(f"Fallback to adb command: {e}")
+                self._adb.mark_unavailable()
+
+        process = self.popen("shell", cmdline, capture_output=True)
+        try:
+            out, err = process.exec(timeout=timeout)
+        finally:
+            process.kill()
+        if isinstance(out, bytes):
+            out = out.decode(errors="ignore")
+        if isinstance(err, bytes):
+            err = err.decode(errors="ignore")
+        return out or "", err or ""
+
+    @utils.timeoutable
+    @invalidates("package")
+    def install(self, path_or_url: "Union[str, ApkFile, Iterable[Union[str, ApkFile]]]", opts: [str] = (),
+                stream: bool = None, timeout: utils.Timeout = None, **kwargs):
         """
         安装apk
-        :param path_or_url: apk文件路径
+        :param path_or_url: apk文件路径，split apk传入路径列表
         :param opts: 安装参数
+        :param stream: 是否通过stdin流式安装，不需要先推送到设备上，为空则设备支持时自动开启
+        :param timeout: 超时时间
         """
-        apk_path = path_or_url
-        if path_or_url.startswith("http://") or path_or_url.startswith("https://"):
-            environ.logger.info(f"Download file: {path_or_url}")
-            file = environ.get_url_file(path_or_url)
-            apk_path = file.save()
-            environ.logger.info(f"Save file to local: {apk_path}")
+        from .install import resolve_apks, is_streaming_supported, stream_install, push_install
 
-        remote_path = self.get_data_path("apk", f"{int(time.time())}.apk")
-        try:
+        apks = resolve_apks(path_or_url)
+
+        if self.uid >= 10000:
+            if len(apks) > 1:
+                raise AdbError("split apks can only be installed by shell user")
+            remote_path = self.get_data_path("apk", f"{int(time.time())}.apk")
             environ.logger.debug(f"Push file to remote: {remote_path}")
-            self.push(apk_path, remote_path, **kwargs)
-            if self.uid >= 10000:
-                self.shell("am", "start", "--user", "0",
-                           "-a", "android.intent.action.VIEW",
-                           "-t", "application/vnd.android.package-archive",
-                           "-d", "file://%s" % remote_path,
-                           **kwargs)
-            else:
-                self.shell("pm", "install", *(opts or tuple()), remote_path,
-                           **kwargs)
-        finally:
-            environ.logger.debug(f"Clear remote file: {remote_path}")
-            self.shell("rm", remote_path, **kwargs)
+            self.push(apks[0].path, remote_path, timeout=timeout, **kwargs)
+            self.shell("am", "start", "--user", "0",
+                       "-a", "android.intent.action.VIEW",
+                       "-t", "application/vnd.android.package-archive",
+                       "-d", "file://%s" % remote_path,
+                       timeout=timeout, **kwargs)
+            return
+
+        if stream is None:
+            stream = is_streaming_supported(self)
+        if stream:
+            out = stream_install(self, apks, opts, timeout=timeout)
+            if kwargs.get("log_output"):
+                environ.logger.info(out)
+            return
+
+        push_install(self, apks, opts, timeout=timeout, **kwargs)
 
     @utils.timeoutable
+    @invalidates("package", "process")
     def uninstall(self, package_name: str, **kwargs):
         """
         卸载apk
@@ -241,73 +875,156 @@ class Device(BaseDevice):
         """
         self.exec("pull", src, dst, **kwargs)
 
-    def forward(self, local: str, remote: str):
+    @utils.timeoutable
+    def sync(self, src: str, dst: str, direction: str = "push", checksum: bool = False,
+             max_workers: int = 4, resume: bool = True, timeout: utils.Timeout = None) -> "SyncResult":
+        """
+        增量同步文件或目录，只传输有变化的文件，多个文件并发传输，大文件中断后可以继续传输
+        :param src: 源文件或目录，push时为本地路径，pull时为设备路径
+        :param dst: 目标文件或目录
+        :param direction: push（本地到设备）或pull（设备到本地）
+        :param checksum: 通过md5判断文件是否变化，否则比较大小和修改时间
+        :param max_workers: 最多同时传输的文件数
+        :param resume: 是否支持断点续传
+        :param timeout: 超时时间
+        :return: 同步结果
         """
-        端口转发
-        :param local: 本地端口
-        :param remote: 远程端口
-        :return: 可关闭对象
+        from .sync import SyncEngine
+        engine = SyncEngine(self, checksum=checksum, max_workers=max_workers, resume=resume)
+        if direction == "push":
+            return engine.push(src, dst, timeout=timeout)
+        elif direction == "pull":
+            return engine.pull(src, dst, timeout=timeout)
+        raise AdbError(f"unknown sync direction: {direction}")
+
+    def read_stream(self, path: str, privilege: bool = False) -> "ExecStream":
         """
+        通过exec-out cat读取远程文件，返回原始数据流
+        :param path: 远程文件路径
+        :param privilege: 是否以root权限读取
+        :return: 数据流，使用完需要关闭
+        """
+        from .stream import ExecStream
+        return ExecStream(self, f"cat {shlex.quote(path)}", privilege=privilege)
 
-        result = self.exec("forward", local, remote)
-        if local == "tcp:0":
-            local = f"tcp:{result}"
+    def pull_tree(self, remote_dir: str, local_dir: str, privilege: bool = False,
+                  progress: "Callable[[str, Optional[int], int], Any]" = None) -> List[str]:
+        """
+        通过exec-out tar拉取整个目录，不需要在设备上生成临时文件
+        :param remote_dir: 远程目录
+        :param local_dir: 本地目录
+        :param privilege: 是否以root权限读取，如拉取应用数据目录
+        :param progress: 进度回调：(名称, 总大小, 已传输大小)
+        :return: 本地文件路径
+        """
+        from .pull import pull_tree
+        return pull_tree(self, remote_dir, local_dir, privilege=privilege, progress=progress)
+
+    def pull_apks(self, package: str, local_dir: str, privilege: bool = False, max_workers: int = 4,
+                  progress: "Callable[[str, Optional[int], int], Any]" = None) -> List[str]:
+        """
+        并行拉取包的base apk和所有split apk
+        :param package: 包名
+        :param local_dir: 本地目录
+        :param privilege: 是否以root权限读取
+        :param max_workers: 同时拉取的文件数
+        :param progress: 进度回调：(名称, 总大小, 已传输大小)
+        :return: 本地apk路径
+        """
+        from .pull import pull_apks
+        return pull_apks(self, package, local_dir, privilege=privilege, max_workers=max_workers, progress=progress)
 
-        _local = local.split(":", maxsplit=1)
-        _remote = remote.split(":", maxsplit=1)
+    @utils.timeoutable
+    def screencap(self, png: bool = True, timeout: utils.Timeout = None) -> bytes:
+        """
+        截图，直接通过exec-out返回图片内容，不在设备上保存文件
+        :param png: 输出png格式，否则输出screencap原始数据
+        :param timeout: 超时时间
+        :return: 图片内容
+        """
+        from .screen import screencap
+        return screencap(self, png=png, timeout=timeout)
 
-        # noinspection PyPropertyDefinition,PyMethodParameters
-        class Forward(Stoppable):
-            local = property(fget=lambda _: _local)
-            remote = property(fget=lambda _: _remote)
+    def iter_screen_frames(self, fps: float = None) -> "Generator[ScreenFrame, None, None]":
+        """
+        通过同一个exec-out连接持续获取屏幕原始帧
+        :param fps: 帧率上限，为空则尽可能快
+        :return: 帧生成器
+        """
+        from .screen import iter_frames
+        return iter_frames(self, fps=fps)
 
-            def stop(_):
-                self.exec("forward", "--remove", local, ignore_errors=True)
+    def screenrecord(self, output: "Union[str, BinaryIO, Callable[[bytes], Any]]", bit_rate: int = None,
+                     size: str = None, time_limit: int = None) -> "ScreenRecorder":
+        """
+        录屏，h264裸流直接写到本地文件或者回调中
+        :param output: 本地文件路径、文件对象或者回调
+        :param bit_rate: 码率
+        :param size: 分辨率，如1280x720
+        :param time_limit: 最长录制时间（秒）
+        :return: 已经开始的录屏对象，调用stop结束
+        """
+        from .screen import ScreenRecorder
+        return ScreenRecorder(self, output, bit_rate=bit_rate, size=size, time_limit=time_limit).start()
 
-        return Forward()
+    @property
+    def forwards(self) -> "ForwardManager":
+        """
+        端口转发管理，同一进程中同一台设备共用
+        """
+        from .forward import ForwardManager
+        return ForwardManager.get(self)
 
-    def reverse(self, remote: str, local: str):
+    def forward(self, local: str, remote: str) -> "ForwardHandle":
         """
-        端口转发
+        端口转发，已经存在的相同转发会被复用，所有引用都关闭后才移除
+        :param local: 本地端口，tcp:0则从端口登记表中分配
         :param remote: 远程端口
-        :param local: 本地端口
         :return: 可关闭对象
         """
+        return self.forwards.forward(local, remote)
 
-        result = self.exec("reverse", remote, local)
-        if remote == "tcp:0":
-            remote = f"tcp:{result}"
-
-        _local = local.split(":", maxsplit=1)
-        _remote = remote.split(":", maxsplit=1)
-
-        # noinspection PyPropertyDefinition,PyMethodParameters
-        class Reverse(Stoppable):
-            local = property(fget=lambda _: _local)
-            remote = property(fget=lambda _: _remote)
-
-            def stop(_):
-                self.exec("reverse", "--remove", remote, ignore_errors=True)
-
-        return Reverse()
+    def reverse(self, remote: str, local: str) -> "ForwardHandle":
+        """
+        端口转发，已经存在的相同转发会被复用，所有引用都关闭后才移除
+        :param remote: 远程端口
+        :param local: 本地端口
+        :return: 可关闭对象
+        """
+        return self.forwards.reverse(remote, local)
 
-    def redirect(self, address: str = None, port: int = None, uid: int = None):
+    def redirect(self, address: str = None, port: int = None, uid: int = None,
+                 uids: "Iterable[Union[int, str]]" = None, ports: Iterable[int] = None,
+                 udp: bool = False, dns: str = None) -> "Redirect":
         """
-        将手机流量重定向到本地指定端口
+        将手机流量重定向到本地指定端口，规则保存在单独的iptables链中，不会影响其他规则
         :param address: 本地监听地址，不填默认本机
         :param port: 本地监听端口
         :param uid: 监听目标uid
+        :param uids: 监听多个目标uid，支持10000-10999这样的范围
+        :param ports: 只重定向访问这些目标端口的流量
+        :param udp: 是否同时重定向udp流量
+        :param dns: dns查询重定向到的地址，如192.168.1.2:53
         :return: 重定向对象
         """
+        from .forward import forward_registry
+        from .redirect import Redirect, RedirectEngine
 
-        remote_port = None
+        remote_port = reverse = None
 
-        if not port:
-            port = utils.pick_unused_port()
+        reserved = not port
+        if reserved:
+            port = forward_registry.reserve_port()
 
         if not address:
             # 如果没有指定目标地址，则通过reverse端口访问
-            remote_port = self.exec("reverse", f"tcp:0", f"tcp:{port}").strip()
+            try:
+                reverse = self.reverse("tcp:0", f"tcp:{port}")
+            except:
+                if reserved:
+                    forward_registry.release_port(port)
+                raise
+            remote_port = reverse.remote_port
             address = "127.0.0.1"
             destination = f"{address}:{remote_port}"
             _logger.debug(f"Not found redirect address, use {destination} instead")
@@ -316,40 +1033,59 @@ class Device(BaseDevice):
             destination = f"{address}:{port}"
             _logger.debug(f"Found redirect address {destination}")
 
-        # 配置iptables规则，首先清除之前的规则，然后再把流量转发到目标端口上
-        self.sudo("iptables", "-t", "nat", "-F")
-
-        args = ["-A", "OUTPUT", "-p", "tcp"]  # 添加一条tcp协议的转发规则
-        args += ["!", "-o", "lo"]  # 过滤localhost
-        if uid is not None:
-            args += ["-m", "owner", "--uid-owner", uid]  # 指定要重定向流量的uid
-        args += ["-j", "DNAT", "--to-destination", destination]  # 转发到指定端口
-        self.sudo("iptables", "-t", "nat", *args)
-
-        # noinspection PyMethodParameters
-        class Redirect(Stoppable):
-
-            def __init__(self):
-                self.local_port = port
-                self.local_address = address
-                self.remote_port = remote_port
+        uids = [*([uid] if uid is not None else []), *(uids or [])]
+        redirect = Redirect(RedirectEngine.get(self), address, port, destination, remote_port, reverse, reserved)
+        try:
+            redirect.update(uids=uids, ports=ports, udp=udp, dns=dns)
+        except:
+            redirect.stop()
+            raise
+        return redirect
 
-            def stop(_):
-                # 清空iptables -t nat配置
-                self.sudo("iptables", "-t", "nat", "-F", ignore_errors=True)
-                # 如果占用reverse端口，则释放端口
-                if remote_port:
-                    self.exec("reverse", "--remove", f"tcp:{remote_port}", ignore_errors=True)
+    def invalidate_cache(self, *groups: str) -> None:
+        """
+        清除该设备的查询缓存，在设备外修改了设备状态（如手动安装应用）后调用
+        :param groups: 需要清除的分组，如package、process，为空则全部清除
+        """
+        memo_cache.invalidate(self.id, groups or None)
 
-        return Redirect()
+    @utils.timeoutable
+    def get_props(self, **kwargs) -> Dict[str, str]:
+        """
+        获取所有属性值，结果会缓存下来供get_prop使用
+        :return: 属性名和属性值
+        """
+        from .prop import parse_props, prop_cache
+        props = parse_props(self.shell("getprop", **kwargs))
+        if props:
+            prop_cache.put(self.id, props, connection=lambda: self.get_transport_id(timeout=kwargs.get("timeout")))
+        return props
 
     @utils.timeoutable
-    def get_prop(self, prop: str, **kwargs) -> str:
+    def get_prop(self, prop: str, cache: bool = True, **kwargs) -> str:
         """
         获取属性值
         :param prop: 属性名
+        :param cache: 是否使用属性缓存，只读属性一直有效，其他属性在ANDROID_PROP_CACHE_TTL秒内有效
         :return: 属性值
         """
+        if cache:
+            from .prop import prop_cache, is_readonly_prop
+            if is_readonly_prop(prop) or prop_cache.ttl > 0:
+                value = prop_cache.get(
+                    self.id, prop,
+                    fingerprint=lambda: self.shell(
+                        "getprop", "ro.build.fingerprint",
+                        ignore_errors=True, timeout=kwargs.get("timeout")
+                    ).rstrip(),
+                    connection=lambda: self.get_transport_id(timeout=kwargs.get("timeout")),
+                )
+                if value is not None:
+                    return value
+                # 一次性拉取所有属性，后续获取其他属性时不需要再调用adb
+                props = self.get_props(ignore_errors=True, timeout=kwargs.get("timeout"))
+                if props:
+                    return props.get(prop, "")
         return self.shell("getprop", prop, **kwargs).rstrip()
 
     @utils.timeoutable
@@ -360,10 +1096,15 @@ class Device(BaseDevice):
         :param value: 属性值
         :return: adb输出结果
         """
+        from .prop import prop_cache
         args = ["setprop", prop, value]
-        return self.shell(*args, **kwargs).rstrip()
+        try:
+            return self.shell(*args, **kwargs).rstrip()
+        finally:
+            prop_cache.invalidate(self.id)
 
     @utils.timeoutable
+    @invalidates("process")
     def start(self, package_name: str, activity_name: str = None, **kwargs) -> str:
         """
         启动app的launcher页面
@@ -387,6 +1128,7 @@ class Device(BaseDevice):
         )
 
     @utils.timeoutable
+    @invalidates("process")
     def kill(self, package_name: str, **kwargs) -> str:
         """
         关闭进程
@@ -397,6 +1139,7 @@ class Device(BaseDevice):
         return self.shell(*args, **kwargs).rstrip()
 
     @utils.timeoutable
+    @invalidates("process")
     def force_stop(self, package_name: str, **kwargs) -> str:
         """
         关闭进程
@@ -437,12 +1180,14 @@ class Device(BaseDevice):
         target_dir = self.get_storage_path("apk", apk_md5)
         target_path = self.get_storage_path("apk", apk_md5, apk_name)
 
-        # check apk path
-        if not self.is_file_exist(target_path):
+        # 远程文件的md5与agent不一致（不存在或者上次推送中断）时重新推送
+        from .sync import stat_remote_files, SyncEngine
+        remote = stat_remote_files(self, [target_path], checksum=True).get(target_path)
+        if remote is None or remote.md5 != apk_md5:
             self.shell("rm", "-rf", target_dir)
-            self.push(apk_path, target_path)
-            if not self.is_file_exist(target_path):
-                raise AdbError("%s does not exist" % target_path)
+            result = SyncEngine(self, resume=False).push(apk_path, target_path)
+            if not result.is_success:
+                raise AdbError("push %s failed: %s" % (target_path, result.errors[target_path]))
 
         return target_path
 
@@ -453,52 +1198,44 @@ class Device(BaseDevice):
         :param flag: 是否添加flag
         :return: 参数列表
         """
-        agent_info = self.agent_info
-        start_flag = agent_info["start_flag"]
-        end_flag = agent_info["end_flag"]
-        main_class = agent_info["main"]
+        return _make_agent_args(self.agent_path, self.agent_info, args, flag=flag)
 
-        agent_args = [
-            "CLASSPATH=%s" % self.agent_path,
-            "app_process", "/", main_class,
-        ]
-
-        if flag:
-            agent_args.extend([
-                "--start-flag", start_flag,
-                "--end-flag", end_flag
-            ])
-
-        agent_args.extend(args)
-
-        return agent_args
+    @cached_property
+    def agent_daemon(self) -> "AgentDaemon":
+        """
+        辅助apk常驻进程，首次调用时才会启动
+        :return: 常驻进程对象
+        """
+        from .agent import AgentDaemon
+        return AgentDaemon(self)
 
     @utils.timeoutable
     def call_agent(self, *args: [str], **kwargs) -> str:
         """
-        调用辅助apk功能
+        调用辅助apk功能，默认复用常驻进程，常驻进程不可用或需要切换用户时单独启动进程
         :param args: 参数
         :return: 输出结果
         """
-        agent_info = self.agent_info
-        start_flag = agent_info["start_flag"]
-        end_flag = agent_info["end_flag"]
+        if not kwargs.get("privilege") and not kwargs.get("user") and \
+                environ.get_config("ANDROID_AGENT_DAEMON", type=bool, default=True):
+            daemon = self.agent_daemon
+            if daemon.is_available:
+                from .agent import AgentDaemonError
+                try:
+                    return daemon.call(*args, timeout=kwargs.get("timeout"))
+                except AgentDaemonError as e:
+                    _logger.debug(f"Fallback to agent process: {e}")
+                except AdbError:
+                    if not kwargs.get("ignore_errors"):
+                        raise
+                    return ""
 
         # call apk
         result = self.shell(
             *self.make_agent_args(*args, flag=True),
             **kwargs
         )
-
-        begin = result.find(start_flag)
-        end = result.rfind(end_flag)
-        if begin >= 0 and end >= 0:
-            begin = begin + len(start_flag)
-            result = result[begin: end]
-        elif begin >= 0:
-            begin = begin + len(start_flag)
-            raise AdbError(result[begin:])
-        return result
+        return parse_agent_output(result, self.agent_info)
 
     @utils.timeoutable
     def get_current_package(self, **kwargs) -> str:
@@ -506,12 +1243,9 @@ class Device(BaseDevice):
         获取顶层包名
         :return: 顶层包名
         """
-        if self.uid < 10000:
-            args = ["dumpsys", "activity", "top", "|", "grep", "^TASK", "-A", "1", ]
-            out = self.shell(*args, **kwargs)
-            items = out.splitlines()[-1].split()
-            if items is not None and len(items) >= 2:
-                return items[1].split("/")[0].rstrip()
+        activity = self._get_resumed_activity(**kwargs)
+        if activity:
+            return activity.split("/")[0]
         # use agent instead of dumpsys
         out = self.call_agent("common", "--top-package", **kwargs)
         if not utils.is_empty(out):
@@ -524,14 +1258,39 @@ class Device(BaseDevice):
         获取顶层activity名
         :return: 顶层activity名
         """
-        args = ["dumpsys", "activity", "top", "|", "grep", "^TASK", "-A", "1"]
-        result = self.shell(*args, **kwargs)
-        items = result.splitlines()[-1].split()
-        if items is not None and len(items) >= 2:
-            return items[1].rstrip()
+        activity = self._get_resumed_activity(**kwargs)
+        if activity:
+            return activity
         raise AdbError("can not fetch top activity")
 
+    def _get_resumed_activity(self, **kwargs) -> Optional[str]:
+        # 前台跟踪已经就绪时直接使用事件更新的结果，否则只查询dumpsys中resumed activity那一行，不等待跟踪就绪
+        from .foreground import ForegroundTracker, query_resumed_activity
+        tracker = ForegroundTracker.find(self)
+        if tracker is not None and tracker.is_ready:
+            activity = tracker.current_activity
+            if activity:
+                return activity
+        return query_resumed_activity(self, timeout=kwargs.get("timeout"))
+
+    @property
+    def foreground(self) -> "ForegroundTracker":
+        """
+        前台应用跟踪，同一进程中同一台设备共用，调用device.foreground.start()后才会开始跟踪
+        """
+        from .foreground import ForegroundTracker
+        return ForegroundTracker.get(self)
+
+    @property
+    def current_package(self) -> str:
+        """
+        当前前台包名，调用device.foreground.start()后由事件流更新，不需要每次都执行dumpsys，
+        没有启动跟踪时与get_current_package相同
+        """
+        return self.get_current_package()
+
     @utils.timeoutable
+    @memoize("package")
     def get_apk_path(self, package: str, **kwargs) -> str:
         """
         获取apk路径
@@ -546,6 +1305,7 @@ class Device(BaseDevice):
         return utils.get_item(obj, 0, "sourceDir", default="")
 
     @utils.timeoutable
+    @memoize("package")
     def get_uid(self, package_name: str = None, timeout: utils.Timeout = None) -> Optional[int]:
         """
         根据包名获取uid
@@ -569,63 +1329,72 @@ class Device(BaseDevice):
             raise AdbError("unknown adb uid: %s" % out)
 
     @utils.timeoutable
-    def get_package(self, package_name: str, simple: bool = None, **kwargs) -> Optional[Package]:
+    @memoize("package", bypass="refresh")
+    def get_package(self, package_name: str, simple: bool = None, refresh: bool = False,
+                    **kwargs) -> Optional[Package]:
         """
         根据包名获取包信息
         :param package_name: 包名
         :param simple: 只获取基本信息
+        :param refresh: 忽略包信息缓存，强制重新获取
         :return: 包信息
         """
         args = ["package", "--packages", package_name]
-        if simple is True:
-            args.append("--simple")
-        objs = json.loads(self.call_agent(*args, **kwargs))
-        return Package(objs[0]) if len(objs) > 0 else None
+        for package in self._iter_packages(*args, simple=simple, refresh=refresh, **kwargs):
+            return package
+        return None
 
     @utils.timeoutable
-    def get_packages(self, *package_names: str, system: bool = None, simple: bool = None, **kwargs) -> [Package]:
+    @memoize("package", bypass="refresh")
+    def get_packages(self, *package_names: str, system: bool = None, simple: bool = None, refresh: bool = False,
+                     **kwargs) -> [Package]:
         """
         获取包信息
         :param package_names: 需要匹配的所有包名，为空则匹配所有
         :param system: true只匹配系统应用，false只匹配非系统应用，为空则全匹配
         :param simple: 只获取基本信息
+        :param refresh: 忽略包信息缓存，强制重新获取
         :return: 包信息
         """
-        result = []
-        agent_args = ["package"]
-        if not utils.is_empty(package_names):
-            agent_args.append("--packages")
-            agent_args.extend(package_names)
-        if system is True:
-            agent_args.append("--system")
-        elif system is False:
-            agent_args.append("--non-system")
-        if simple is True:
-            agent_args.append("--simple")
-        objs = json.loads(self.call_agent(*agent_args, **kwargs))
-        for obj in objs:
-            result.append(Package(obj))
-        return result
+        return list(self.iter_packages(*package_names, system=system, simple=simple, refresh=refresh, **kwargs))
 
     @utils.timeoutable
-    def get_packages_for_uid(self, *uids: int, simple: bool = None, **kwargs) -> [Package]:
+    def iter_packages(self, *package_names: str, system: bool = None, simple: bool = None, refresh: bool = False,
+                      **kwargs) -> Generator[Package, None, None]:
+        """
+        逐个解析并返回包信息，不需要一次性构造所有包对象
+        :param package_names: 需要匹配的所有包名，为空则匹配所有
+        :param system: true只匹配系统应用，false只匹配非系统应用，为空则全匹配
+        :param simple: 只获取基本信息
+        :param refresh: 忽略包信息缓存，强制重新获取
+        :return: 包信息
+        """
+        agent_args = _make_package_args(package_names, system=system)
+        return self._iter_packages(*agent_args, simple=simple, refresh=refresh, **kwargs)
+
+    @utils.timeoutable
+    def get_packages_for_uid(self, *uids: int, simple: bool = None, refresh: bool = False,
+                             **kwargs) -> [Package]:
         """
         获取指定uid包信息
         :param uids: 需要匹配的所有uid
         :param simple: 只获取基本信息
+        :param refresh: 忽略包信息缓存，强制重新获取
         :return: 包信息
         """
-        result = []
         agent_args = ["package"]
         if not utils.is_empty(uids):
             agent_args.append("--uids")
             agent_args.extend([str(uid) for uid in uids])
-        if simple is True:
-            agent_args.append("--simple")
-        objs = json.loads(self.call_agent(*agent_args, **kwargs))
-        for obj in objs:
-            result.append(Package(obj))
-        return result
+        return list(self._iter_packages(*agent_args, simple=simple, refresh=refresh, **kwargs))
+
+    def _iter_packages(self, *agent_args: str, simple: bool = None, refresh: bool = False,
+                       **kwargs) -> Generator[Package, None, None]:
+        query = _PackageQuery(self.id, agent_args, simple=simple, refresh=refresh)
+        args = query.args
+        while args is not None:
+            args = query.feed(self.call_agent(*args, **kwargs))
+        yield from query.iter_packages()
 
     @utils.timeoutable
     def get_tcp_sockets(self, **kwargs) -> [InetSocket]:
@@ -669,6 +1438,7 @@ class Device(BaseDevice):
         return result
 
     @utils.timeoutable
+    @memoize("process", ttl=1)
     def get_processes(self, **kwargs) -> [Process]:
         result = []
         agent_args = ["process", "--list"]
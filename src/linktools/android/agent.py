@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import atexit
+import itertools
+import json
+import secrets
+import socket
+import struct
+import threading
+import time
+from typing import TYPE_CHECKING, Optional, Dict, Any, List
+
+from .adb import AdbError
+from .client import AdbConnection
+from .. import utils, environ
+from ..decorator import cached_property
+from ..reactor import Stoppable
+
+if TYPE_CHECKING:
+    from .adb import Device
+
+_logger = environ.get_logger("android.agent")
+
+
+class AgentDaemonError(AdbError):
+    """
+    agent常驻进程不可用，调用方可以回退到单次启动agent的方式
+    """
+    pass
+
+
+class _ConnectionLost(Exception):
+    pass
+
+
+class _Request:
+
+    def __init__(self, id: int, connection: AdbConnection):
+        self.id = id
+        self.connection = connection
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+    def set_result(self, result: Any) -> None:
+        self.result = result
+        self.event.set()
+
+    def set_error(self, error: BaseException) -> None:
+        self.error = error
+        self.event.set()
+
+
+class AgentDaemon(Stoppable):
+    """
+    android-tools常驻进程，监听abstract unix socket，通过带长度前缀的json-rpc复用同一个进程，
+    省去每次调用都要启动app_process的开销
+    """
+
+    def __init__(self, device: "Device", idle_timeout: int = 600, start_timeout: float = 5):
+        """
+        :param device: 设备
+        :param idle_timeout: 常驻进程空闲多久后自动退出
+        :param start_timeout: 等待常驻进程启动的最长时间
+        """
+        self._device = device
+        self._idle_timeout = idle_timeout
+        self._start_timeout = start_timeout
+        self._lock = threading.RLock()
+        self._connect_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, _Request] = {}
+        self._connection: Optional[AdbConnection] = None
+        self._forward: Optional[Stoppable] = None
+        self._disabled = False
+        self._atexit_registered = False
+
+    @cached_property
+    def name(self) -> str:
+        """
+        abstract unix socket名，带有随机后缀，每个AgentDaemon对象启动自己的常驻进程
+        """
+        return f"{environ.name}-agent-{self._device.agent_info['md5']}-{secrets.token_hex(8)}"
+
+    @cached_property
+    def token(self) -> str:
+        """
+        启动常驻进程时传入，每个请求都要带上，常驻进程同时只接受shell和root用户的连接
+        """
+        return secrets.token_hex(16)
+
+    @property
+    def is_available(self) -> bool:
+        """
+        当前agent是否支持常驻进程模式
+        """
+        if self._disabled:
+            return False
+        return "daemon" in self._device.agent_info.get("features", [])
+
+    @utils.timeoutable
+    def call(self, *args: [Any], timeout: utils.Timeout = None) -> str:
+        """
+        通过常驻进程调用agent
+        :param args: agent参数
+        :param timeout: 超时时间
+        :return: 输出结果
+        """
+        params = [str(arg) for arg in args]
+        try:
+            return self._request("call", params, timeout)
+        except _ConnectionLost as e:
+            # 常驻进程可能已经退出，重新启动后再试一次
+            _logger.debug(f"Agent daemon connection lost: {e}, restart it")
+            self._close_connection()
+        try:
+            return self._request("call", params, timeout)
+        except _ConnectionLost as e:
+            self._close_connection()
+            raise AgentDaemonError(f"agent daemon connection lost: {e}")
+
+    def _request(self, method: str, params: List[str], timeout: utils.Timeout,
+                 connection: AdbConnection = None) -> Any:
+        if connection is None:
+            connection = self._ensure_connection(timeout)
+
+        request = _Request(next(self._ids), connection)
+        with self._lock:
+            self._pending[request.id] = request
+
+        try:
+            data = json.dumps({
+                "jsonrpc": "2.0", "id": request.id, "token": self.token, "method": method, "params": params,
+            }).encode()
+            with self._write_lock:
+                connection.send(struct.pack(">I", len(data)) + data)
+        except OSError as e:
+            with self._lock:
+                self._pending.pop(request.id, None)
+            raise _ConnectionLost(e)
+
+        if not request.event.wait(timeout.remain):
+            with self._lock:
+                self._pending.pop(request.id, None)
+            raise AdbError(f"agent daemon request timeout: {' '.join(params)}")
+
+        if isinstance(request.error, _ConnectionLost):
+            raise request.error
+        if request.error is not None:
+            raise AdbError(str(request.error))
+        return request.result
+
+    def _ensure_connection(self, timeout: utils.Timeout) -> AdbConnection:
+        connection = self._connection
+        if connection is not None:
+            return connection
+
+        with self._connect_lock:
+            if self._connection is not None:
+                return self._connection
+            if self._disabled:
+                raise AgentDaemonError("agent daemon is disabled")
+
+            if self._connect(timeout):
+                return self._connection
+
+            _logger.debug(f"Start agent daemon: {self.name}")
+            self._start(timeout)
+
+            deadline = utils.Timeout(self._start_timeout)
+            while deadline.check() and timeout.check():
+                if self._connect(timeout):
+                    return self._connection
+                time.sleep(.1)
+
+            # 启动失败（比如apk版本太旧），后续不再尝试
+            self._disabled = True
+            raise AgentDaemonError(f"agent daemon {self.name} failed to start")
+
+    def _start(self, timeout: utils.Timeout) -> None:
+        self._device.shell(
+            f"CLASSPATH={self._device.agent_path}",
+            "nohup", "app_process", "/", self._device.agent_info["main"],
+            "daemon", "--name", self.name, "--idle-timeout", self._idle_timeout, "--token", self.token,
+            ">", "/dev/null", "2>&1", "&",
+            ignore_errors=True,
+            timeout=timeout,
+        )
+
+    def _open(self, timeout: utils.Timeout) -> AdbConnection:
+        client = self._device.adb.client
+        if client is not None:
+            # 可以直接通过adb server打开localabstract，不需要端口转发
+            return client.open(self._device.id, f"localabstract:{self.name}", timeout=timeout)
+
+        if self._forward is None:
+            self._forward = self._device.forward("tcp:0", f"localabstract:{self.name}")
+            if not self._atexit_registered:
+                self._atexit_registered = True
+                atexit.register(self.stop)
+        sock = socket.create_connection(("127.0.0.1", int(self._forward.local[1])), timeout=timeout.remain)
+        return AdbConnection(sock)
+
+    def _connect(self, timeout: utils.Timeout) -> bool:
+        try:
+            connection = self._open(timeout)
+        except (AdbError, OSError) as e:
+            _logger.debug(f"Connect to agent daemon failed: {e}")
+            return False
+
+        connection.settimeout(None)
+        reader = threading.Thread(target=self._read_loop, args=(connection,))
+        reader.daemon = True
+        reader.start()
+
+        try:
+            self._request("ping", [], utils.Timeout(1), connection=connection)
+        except (AdbError, _ConnectionLost) as e:
+            _logger.debug(f"Ping agent daemon failed: {e}")
+            self._shutdown(connection)
+            return False
+
+        self._connection = connection
+        return True
+
+    def _read_loop(self, connection: AdbConnection) -> None:
+        error = _ConnectionLost("connection closed")
+        try:
+            while True:
+                length = struct.unpack(">I", connection.recv_exactly(4))[0]
+                response = json.loads(connection.recv_exactly(length))
+                with self._lock:
+                    request = self._pending.pop(response.get("id"), None)
+                if request is None:
+                    continue
+                if "error" in response:
+                    request.set_error(AdbError(utils.get_item(response, "error", "message", default="")))
+                else:
+                    # stderr单独返回，不会混进结果
+                    if response.get("stderr"):
+                        _logger.debug(f"Agent daemon stderr: {response['stderr'].rstrip()}")
+                    request.set_result(response.get("result"))
+        except Exception as e:
+            error = _ConnectionLost(e)
+        finally:
+            with self._lock:
+                if self._connection is connection:
+                    self._connection = None
+                pending = [r for r in self._pending.values() if r.connection is connection]
+                for request in pending:
+                    self._pending.pop(request.id, None)
+            connection.close()
+            for request in pending:
+                request.set_error(error)
+
+    def _close_connection(self) -> None:
+        with self._lock:
+            connection, self._connection = self._connection, None
+        if connection is not None:
+            # 关闭socket后，读线程会负责清理未完成的请求
+            self._shutdown(connection)
+
+    @classmethod
+    def _shutdown(cls, connection: AdbConnection) -> None:
+        # 读线程发现连接断开时可能已经关闭了socket
+        sock = connection.socket
+        if sock is not None:
+            utils.ignore_error(sock.shutdown, args=(socket.SHUT_RDWR,))
+        connection.close()
+
+    def stop(self) -> None:
+        """
+        断开与常驻进程的连接，常驻进程空闲一段时间后会自行退出
+        """
+        self._close_connection()
+        forward, self._forward = self._forward, None
+        if forward is not None:
+            forward.stop()
+
+    def __repr__(self):
+        return f"AgentDaemon<{self._device.id}, {self.name}>"
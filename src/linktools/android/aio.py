@@ -0,0 +1,554 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import asyncio
+import functools
+import json
+import os
+import stat
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from .adb import Adb, Device, AdbError, parse_agent_output, parse_device_states, _alive_states, \
+    _get_native_command, _log_output, _make_native_result, _make_shell_args, _make_agent_args, \
+    _make_package_args, _PackageQuery
+from .client import AdbConnectionError, AdbProtocolError, SyncStat, _SYNC_DATA_MAX, _ShellOutput, \
+    _get_server_port, _encode_request, _make_status_error, _encode_packet, _encode_int, _decode_header, \
+    _decode_stat, _decode_shell_header
+from .memo import memoize
+from .struct import Package, Process
+from .. import utils, environ
+from ..metadata import __missing__
+
+_logger = environ.get_logger("android.aio")
+
+
+async def _run_in_executor(fn: Callable, *args: Any, **kwargs: Any) -> Any:
+    """
+    在线程池中执行会阻塞的操作（文件读写、sqlite、磁盘缓存），避免阻塞事件循环
+    """
+    return await asyncio.get_event_loop().run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
+
+class AsyncAdbConnection:
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+
+    async def send(self, data: bytes) -> None:
+        self._writer.write(data)
+        await self._writer.drain()
+
+    async def request(self, request: str) -> None:
+        """
+        发送请求并检查返回状态
+        :param request: 请求内容，如host:version
+        """
+        await self.send(_encode_request(request))
+        status = await self.recv_exactly(4)
+        if status != b"OKAY":
+            raise _make_status_error(status, await self.recv_string() if status == b"FAIL" else None)
+
+    async def recv(self, size: int = 65536) -> bytes:
+        return await self._reader.read(size)
+
+    async def recv_exactly(self, size: int) -> bytes:
+        try:
+            return await self._reader.readexactly(size)
+        except asyncio.IncompleteReadError as e:
+            raise AdbProtocolError(f"connection closed, expected {size} bytes, got {len(e.partial)}")
+
+    async def recv_all(self) -> bytes:
+        return await self._reader.read()
+
+    async def recv_string(self) -> str:
+        length = int(await self.recv_exactly(4), 16)
+        return (await self.recv_exactly(length)).decode(errors="ignore")
+
+    def close(self) -> None:
+        utils.ignore_error(self._writer.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class AsyncAdbClient:
+    """
+    asyncio版本的adb server协议客户端，所有操作都可以通过取消task中断
+    """
+
+    def __init__(self, host: str = None, port: int = None, connect_timeout: float = 3):
+        """
+        :param host: adb server地址
+        :param port: adb server端口
+        :param connect_timeout: 连接adb server的超时时间
+        """
+        self.host = host or "127.0.0.1"
+        self.port = port or _get_server_port()
+        self.connect_timeout = connect_timeout
+        self._features: Dict[str, Set[str]] = {}
+
+    async def connect(self) -> AsyncAdbConnection:
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port),
+                timeout=self.connect_timeout,
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            raise AdbConnectionError(f"cannot connect to adb server {self.host}:{self.port}: {e}") from e
+        return AsyncAdbConnection(reader, writer)
+
+    async def host_request(self, request: str) -> str:
+        async with await self.connect() as connection:
+            await connection.request(request)
+            return await connection.recv_string()
+
+    async def get_features(self, serial: str) -> Set[str]:
+        features = self._features.get(serial)
+        if features is None:
+            result = await self.host_request(f"host-serial:{serial}:features")
+            features = self._features[serial] = set(result.strip().split(","))
+        return features
+
+    async def open(self, serial: str, service: str) -> AsyncAdbConnection:
+        """
+        打开设备上的服务，返回原始数据流
+        :param serial: 设备号
+        :param service: 服务名
+        :return: 连接对象，使用完需要关闭
+        """
+        connection = await self.connect()
+        try:
+            await connection.request(f"host:transport:{serial}")
+            await connection.request(service)
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    async def shell(self, serial: str, command: str) -> Tuple[bytes, bytes, Optional[int]]:
+        """
+        执行shell命令，设备支持shell_v2时可以拿到stderr和返回码
+        :return: stdout, stderr, 返回码（不支持shell_v2时为None）
+        """
+        if "shell_v2" not in await self.get_features(serial):
+            return await self.exec_out(serial, command, service="shell"), b"", None
+
+        output = _ShellOutput()
+        async with await self.open(serial, f"shell,v2,raw:{command}") as connection:
+            try:
+                while True:
+                    id, length = _decode_shell_header(await connection.recv_exactly(5))
+                    if output.feed(id, await connection.recv_exactly(length) if length > 0 else b""):
+                        break
+            except AdbProtocolError:
+                # 连接被提前关闭，返回已经读取的内容
+                pass
+        return output.result()
+
+    async def exec_out(self, serial: str, command: str, service: str = "exec") -> bytes:
+        async with await self.open(serial, f"{service}:{command}") as connection:
+            return await connection.recv_all()
+
+    async def stat(self, serial: str, path: str) -> SyncStat:
+        async with await self.open(serial, "sync:") as connection:
+            await connection.send(_encode_packet(b"STAT", path.encode()))
+            return _decode_stat(await connection.recv_exactly(16))
+
+    async def push(self, serial: str, src: str, dst: str, mode: int = None) -> None:
+        """
+        推送本地文件到设备，本地文件在线程池中分块读取
+        """
+        st = await _run_in_executor(os.stat, src)
+        if mode is None:
+            mode = stat.S_IMODE(st.st_mode)
+        fd = await _run_in_executor(open, src, "rb")
+        try:
+            async with await self.open(serial, "sync:") as connection:
+                await connection.send(_encode_packet(b"SEND", f"{dst},{mode}".encode()))
+                while True:
+                    data = await _run_in_executor(fd.read, _SYNC_DATA_MAX)
+                    if not data:
+                        break
+                    await connection.send(_encode_packet(b"DATA", data))
+                await connection.send(_encode_int(b"DONE", int(st.st_mtime)))
+                id, length = _decode_header(await connection.recv_exactly(8))
+                if id == b"FAIL":
+                    raise AdbProtocolError((await connection.recv_exactly(length)).decode(errors="ignore"))
+                if id != b"OKAY":
+                    raise AdbProtocolError(f"unexpected sync response: {id!r}")
+        finally:
+            fd.close()
+
+    async def pull(self, serial: str, src: str, dst: str) -> None:
+        """
+        拉取设备文件到本地，先写到临时文件，拉取失败时不会留下空文件或者不完整的文件
+        """
+        temp_path = f"{dst}.linktools-partial"
+        fd = await _run_in_executor(open, temp_path, "wb")
+        try:
+            try:
+                async with await self.open(serial, "sync:") as connection:
+                    await connection.send(_encode_packet(b"RECV", src.encode()))
+                    while True:
+                        id, length = _decode_header(await connection.recv_exactly(8))
+                        if id == b"DATA":
+                            await _run_in_executor(fd.write, await connection.recv_exactly(length))
+                        elif id == b"DONE":
+                            break
+                        elif id == b"FAIL":
+                            raise AdbProtocolError((await connection.recv_exactly(length)).decode(errors="ignore"))
+                        else:
+                            raise AdbProtocolError(f"unexpected sync response: {id!r}")
+            finally:
+                fd.close()
+        except BaseException:
+            utils.ignore_error(os.remove, args=(temp_path,))
+            raise
+        await _run_in_executor(os.replace, temp_path, dst)
+
+    def __repr__(self):
+        return f"AsyncAdbClient<{self.host}:{self.port}>"
+
+
+class AsyncAdb:
+    """
+    asyncio版本的adb，开启native时直接通过adb server协议通信，否则通过asyncio子进程调用adb
+    """
+
+    def __init__(self, options: List[str] = None, native: bool = None):
+        """
+        :param options: adb参数
+        :param native: 是否直接通过adb server协议通信，为空则读取ANDROID_ADB_NATIVE配置
+        """
+        self._adb = Adb(options=options, native=native)
+        self._client: Optional[AsyncAdbClient] = None
+        if self._adb.native:
+            address = Adb._parse_server_address(self._adb.options)
+            if address is not None:
+                self._client = AsyncAdbClient(*address)
+
+    @property
+    def sync(self) -> Adb:
+        """
+        对应的同步adb对象，共享配置和设备跟踪器
+        """
+        return self._adb
+
+    @property
+    def client(self) -> Optional[AsyncAdbClient]:
+        return self._client
+
+    async def popen(self, *args: [Any], **kwargs) -> asyncio.subprocess.Process:
+        tool = self._adb._tool
+        if tool is None:
+            raise AdbError("tool not found")
+        await _run_in_executor(tool.prepare)
+        args = [*tool.executable_cmdline, *self._adb.options, *args]
+        args = [str(arg) for arg in args]
+        environ.logger.debug(f"Exec cmdline: {utils.list2cmdline(args)}")
+        return await asyncio.create_subprocess_exec(*args, **kwargs)
+
+    async def exec(self, *args: [Any], ignore_errors: bool = False) -> str:
+        """
+        执行adb命令，task被取消时结束adb进程
+        :param args: 命令行参数
+        :param ignore_errors: 忽略错误，报错不会抛异常
+        :return: adb输出结果
+        """
+        process = await self.popen(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            out, err = await process.communicate()
+        finally:
+            if process.returncode is None:
+                utils.ignore_error(process.kill)
+        if not ignore_errors and process.returncode != 0:
+            err = err.decode(errors="ignore").strip()
+            if err:
+                raise AdbError(err)
+        return out.decode(errors="ignore").strip()
+
+    async def get_device_states(self) -> Dict[str, str]:
+        if self._client is not None:
+            try:
+                return parse_device_states((await self._client.host_request("host:devices")).splitlines())
+            except AdbConnectionError as e:
+                _logger.debug(f"Fallback to adb command: {e}")
+        return parse_device_states((await self.exec("devices")).splitlines()[1:])
+
+    async def list_devices(self, alive: bool = None) -> List["AsyncDevice"]:
+        """
+        获取所有设备列表，同步adb的设备跟踪器运行时直接从设备表中读取
+        :param alive: 只显示在线的设备
+        :return: 设备列表
+        """
+        tracker = self._adb.tracker
+        if tracker is not None and tracker.is_ready:
+            return [AsyncDevice(device.id, adb=self) for device in tracker.get_devices(alive=alive)]
+        return [
+            AsyncDevice(id, adb=self)
+            for id, state in (await self.get_device_states()).items()
+            if alive is None or alive == (state in _alive_states)
+        ]
+
+    def __repr__(self):
+        return f"AsyncAdb<{self._adb.options}>"
+
+
+class AsyncForward:
+
+    def __init__(self, device: "AsyncDevice", local: str, remote: str):
+        self._device = device
+        self.local = local.split(":", maxsplit=1)
+        self.remote = remote.split(":", maxsplit=1)
+        self._local = local
+
+    async def stop(self) -> None:
+        await self._device.exec("forward", "--remove", self._local, ignore_errors=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+
+
+class AsyncDevice:
+    """
+    asyncio版本的设备，接口与Device保持一致，解析逻辑（属性、包信息、进程信息）与Device共用
+    """
+
+    def __init__(self, id: str, adb: AsyncAdb = None):
+        """
+        :param id: 设备号
+        :param adb: 异步adb对象
+        """
+        self._id = id
+        self._adb = adb or AsyncAdb()
+        self._uid: Optional[int] = None
+        self._agent_path: Optional[str] = None
+
+    @property
+    def id(self) -> str:
+        return self._id
+
+    @property
+    def adb(self) -> AsyncAdb:
+        return self._adb
+
+    @property
+    def sync(self) -> Device:
+        """
+        对应的同步设备对象
+        """
+        return Device(self._id, adb=self._adb.sync)
+
+    async def exec(self, *args: [Any], ignore_errors: bool = False, log_output: bool = False) -> str:
+        """
+        执行adb命令
+        :param args: 命令行参数
+        :param ignore_errors: 忽略错误，报错不会抛异常
+        :param log_output: 把输出打印到logger中
+        :return: adb输出结果
+        """
+        client = self._adb.client
+        if client is not None:
+            try:
+                result = await self._exec_native(client, *args, ignore_errors=ignore_errors, log_output=log_output)
+                if result is not __missing__:
+                    return result
+            except AdbConnectionError as e:
+                _logger.debug(f"Fallback to adb command: {e}")
+        out = await self._adb.exec("-s", self._id, *args, ignore_errors=ignore_errors)
+        if log_output:
+            _log_output(out)
+        return out
+
+    async def _exec_native(self, client: AsyncAdbClient, *args: [Any],
+                           ignore_errors: bool = False, log_output: bool = False) -> Any:
+        """
+        与Device._exec_native一致，不支持的命令返回__missing__，交给adb命令行处理
+        """
+        native_command = _get_native_command(args)
+        if native_command is None:
+            return __missing__
+
+        command, args = native_command
+        out, err, exit_code = b"", b"", None
+
+        try:
+            if command in ("shell", "exec-out"):
+                cmdline = " ".join(args)
+                if command == "shell":
+                    out, err, exit_code = await client.shell(self._id, cmdline)
+                else:
+                    out = await client.exec_out(self._id, cmdline)
+
+            elif command == "push":
+                src, dst = args
+                if not os.path.isfile(src):
+                    return __missing__
+                if dst.endswith("/") or (await client.stat(self._id, dst)).is_dir:
+                    dst = dst.rstrip("/") + "/" + os.path.basename(src)
+                await client.push(self._id, src, dst)
+                exit_code = 0
+
+            elif command == "pull":
+                src, dst = args
+                if not (await client.stat(self._id, src)).is_file:
+                    return __missing__
+                if os.path.isdir(dst):
+                    dst = os.path.join(dst, os.path.basename(src))
+                await client.pull(self._id, src, dst)
+                exit_code = 0
+
+        except AdbError as e:
+            if isinstance(e, AdbConnectionError) or not ignore_errors:
+                raise
+            return ""
+
+        return _make_native_result(out, err, exit_code, ignore_errors=ignore_errors, log_output=log_output)
+
+    async def get_uid(self) -> int:
+        """
+        获取shell的uid
+        """
+        if self._uid is None:
+            out = await self.shell("id", "-u")
+            uid = utils.int(out, default=None)
+            if uid is None:
+                raise AdbError("unknown adb uid: %s" % out)
+            self._uid = uid
+        return self._uid
+
+    async def shell(self, *args: [Any], privilege: bool = False, user: str = None,
+                    ignore_errors: bool = False, log_output: bool = False) -> str:
+        """
+        执行shell
+        :param args: shell命令
+        :param privilege: 是否以root权限运行
+        :param user: 以指定user运行
+        :param ignore_errors: 忽略错误，报错不会抛异常
+        :param log_output: 把输出打印到logger中
+        :return: adb输出结果
+        """
+        args = _make_shell_args(args, su=privilege and await self.get_uid() != 0, user=user)
+        return await self.exec(*args, ignore_errors=ignore_errors, log_output=log_output)
+
+    async def sudo(self, *args: [Any], **kwargs) -> str:
+        kwargs["privilege"] = True
+        return await self.shell(*args, **kwargs)
+
+    async def push(self, src: str, dst: str, **kwargs) -> str:
+        return await self.exec("push", src, dst, **kwargs)
+
+    async def pull(self, src: str, dst: str, **kwargs) -> str:
+        return await self.exec("pull", src, dst, **kwargs)
+
+    async def forward(self, local: str, remote: str) -> AsyncForward:
+        """
+        端口转发，返回的对象可以作为async with使用
+        :param local: 本地端口
+        :param remote: 远程端口
+        """
+        result = await self.exec("forward", local, remote)
+        if local == "tcp:0":
+            local = f"tcp:{result}"
+        return AsyncForward(self, local, remote)
+
+    async def get_props(self, **kwargs) -> Dict[str, str]:
+        """
+        获取所有属性值，与Device共用属性缓存
+        """
+        from .prop import parse_props, prop_cache
+        props = parse_props(await self.shell("getprop", **kwargs))
+        if props:
+            # 开启磁盘缓存时会写文件
+            await _run_in_executor(prop_cache.put, self._id, props, connection=self.sync.get_transport_id)
+        return props
+
+    async def get_prop(self, prop: str, cache: bool = True, **kwargs) -> str:
+        """
+        获取属性值，与Device共用属性缓存，读取磁盘缓存时的校验方式也相同
+        """
+        if cache:
+            from .prop import prop_cache, is_readonly_prop
+            if is_readonly_prop(prop) or prop_cache.ttl > 0:
+                device = self.sync
+
+                def get_fingerprint():
+                    # 在线程池或后台校验线程中调用，直接使用同步设备对象
+                    return device.shell("getprop", "ro.build.fingerprint", ignore_errors=True).rstrip()
+
+                value = await _run_in_executor(
+                    prop_cache.get, self._id, prop,
+                    fingerprint=get_fingerprint,
+                    connection=device.get_transport_id,
+                )
+                if value is not None:
+                    return value
+                props = await self.get_props(ignore_errors=True)
+                if props:
+                    return props.get(prop, "")
+        return (await self.shell("getprop", prop, **kwargs)).rstrip()
+
+    async def get_agent_path(self) -> str:
+        """
+        初始化agent，与Device使用同一个路径，md5不一致时重新推送
+        """
+        if self._agent_path is None:
+            agent_info = Device.agent_info
+            apk_name, apk_md5 = agent_info["name"], agent_info["md5"]
+            target_dir = Device.get_storage_path("apk", apk_md5)
+            target_path = Device.get_storage_path("apk", apk_md5, apk_name)
+            out = await self.shell("md5sum", target_path, ignore_errors=True)
+            if out.split(maxsplit=1)[:1] != [apk_md5]:
+                await self.shell("rm", "-rf", target_dir)
+                await self.push(environ.get_asset_path(apk_name), target_path)
+            self._agent_path = target_path
+        return self._agent_path
+
+    async def call_agent(self, *args: [str], **kwargs) -> str:
+        """
+        调用辅助apk功能
+        :param args: 参数
+        :return: 输出结果
+        """
+        agent_args = _make_agent_args(await self.get_agent_path(), Device.agent_info, args, flag=True)
+        return parse_agent_output(await self.shell(*agent_args, **kwargs), Device.agent_info)
+
+    @memoize("package", bypass="refresh")
+    async def get_packages(self, *package_names: str, system: bool = None, simple: bool = None,
+                           refresh: bool = False, **kwargs) -> List[Package]:
+        """
+        获取包信息，与Device共用包信息缓存和查询缓存
+        :param package_names: 需要匹配的所有包名，为空则匹配所有
+        :param system: true只匹配系统应用，false只匹配非系统应用，为空则全匹配
+        :param simple: 只获取基本信息
+        :param refresh: 忽略包信息缓存，强制重新获取
+        :return: 包信息
+        """
+        agent_args = _make_package_args(package_names, system=system)
+        query = _PackageQuery(self._id, agent_args, simple=simple, refresh=refresh)
+        args = query.args
+        while args is not None:
+            out = await self.call_agent(*args, **kwargs)
+            # 会读写sqlite中的包信息缓存
+            args = await _run_in_executor(query.feed, out)
+        # 完整信息在解析时写入缓存，同样放到线程池中
+        return await _run_in_executor(list, query.iter_packages())
+
+    @memoize("package", bypass="refresh")
+    async def get_package(self, package_name: str, **kwargs) -> Optional[Package]:
+        packages = await self.get_packages(package_name, **kwargs)
+        return packages[0] if packages else None
+
+    @memoize("process", ttl=1)
+    async def get_processes(self, **kwargs) -> List[Process]:
+        return [Process(obj) for obj in json.loads(await self.call_agent("process", "--list", **kwargs))]
+
+    def __repr__(self):
+        return f"AsyncDevice<{self._id}>"
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import contextlib
+import json
+import sqlite3
+import threading
+from typing import Dict, Iterable, Generator, Union
+
+from .. import utils, environ
+
+_logger = environ.get_logger("android.cache")
+
+
+class PackageCache:
+    """
+    包信息的磁盘缓存，以(设备号, 包名, versionCode, lastUpdateTime)为键保存agent返回的完整包信息，
+    每次查询只需要获取简单信息，版本没有变化的包直接从缓存读取
+    """
+
+    def __init__(self, path: str = None):
+        """
+        :param path: sqlite数据库路径，为空则放在数据目录下
+        """
+        self._path = path
+        self._lock = threading.Lock()
+        self._initialized = False
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def path(self) -> str:
+        if self._path is None:
+            self._path = environ.get_data_path("cache", "package.db", create_parent=True)
+        return self._path
+
+    @property
+    def enabled(self) -> bool:
+        return environ.get_config("ANDROID_PACKAGE_CACHE", type=bool, default=True)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+    @contextlib.contextmanager
+    def _connect(self) -> Generator[sqlite3.Connection, None, None]:
+        with self._lock:
+            connection = sqlite3.connect(self.path, timeout=10)
+            try:
+                if not self._initialized:
+                    connection.execute(
+                        "CREATE TABLE IF NOT EXISTS packages ("
+                        "  serial TEXT NOT NULL,"
+                        "  name TEXT NOT NULL,"
+                        "  version_code TEXT NOT NULL,"
+                        "  last_update_time INTEGER NOT NULL,"
+                        "  source_dir TEXT NOT NULL,"
+                        "  data TEXT NOT NULL,"
+                        "  PRIMARY KEY (serial, name)"
+                        ")"
+                    )
+                    self._initialized = True
+                yield connection
+                connection.commit()
+            finally:
+                connection.close()
+
+    @classmethod
+    def _make_key(cls, obj: dict):
+        # 老版本agent不返回lastUpdateTime，同时比较sourceDir，重新安装后路径会变化
+        return (
+            str(utils.get_item(obj, "versionCode", default="")),
+            utils.get_item(obj, "lastUpdateTime", type=int, default=0),
+            utils.get_item(obj, "sourceDir", type=str, default=""),
+        )
+
+    def get(self, serial: str, simple_objs: Iterable[dict], raw: bool = False) -> Dict[str, Union[dict, str]]:
+        """
+        根据简单信息查询缓存，只返回版本没有变化的包
+        :param serial: 设备号
+        :param simple_objs: agent返回的简单包信息
+        :param raw: 返回未解析的json字符串，由调用方在需要时再解析
+        :return: 包名和完整包信息
+        """
+        keys = {obj["name"]: self._make_key(obj) for obj in simple_objs if obj.get("name")}
+        result = {}
+        if not keys:
+            return result
+        try:
+            with self._connect() as connection:
+                names = list(keys.keys())
+                # sqlite默认最多支持999个参数
+                for i in range(0, len(names), 500):
+                    chunk = names[i:i + 500]
+                    rows = connection.execute(
+                        f"SELECT name, version_code, last_update_time, source_dir, data FROM packages "
+                        f"WHERE serial = ? AND name IN ({','.join('?' * len(chunk))})",
+                        (serial, *chunk)
+                    )
+                    for name, version_code, last_update_time, source_dir, data in rows:
+                        if keys[name] == (version_code, last_update_time, source_dir):
+                            result[name] = data if raw else json.loads(data)
+        except sqlite3.Error as e:
+            _logger.debug(f"Query package cache failed: {e}")
+        self.hits += len(result)
+        self.misses += len(keys) - len(result)
+        return result
+
+    def put(self, serial: str, objs: Iterable[dict]) -> None:
+        """
+        保存完整包信息
+        :param serial: 设备号
+        :param objs: agent返回的完整包信息
+        """
+        rows = [
+            (serial, obj["name"], *self._make_key(obj), json.dumps(obj))
+            for obj in objs if obj.get("name")
+        ]
+        if not rows:
+            return
+        try:
+            with self._connect() as connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO packages "
+                    "(serial, name, version_code, last_update_time, source_dir, data) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+        except sqlite3.Error as e:
+            _logger.debug(f"Update package cache failed: {e}")
+
+    def retain(self, serial: str, names: Iterable[str]) -> None:
+        """
+        删除设备上已经不存在的包
+        :param serial: 设备号
+        :param names: 设备上所有的包名
+        """
+        names = set(names)
+        try:
+            with self._connect() as connection:
+                rows = connection.execute("SELECT name FROM packages WHERE serial = ?", (serial,)).fetchall()
+                removed = [(serial, name) for name, in rows if name not in names]
+                connection.executemany("DELETE FROM packages WHERE serial = ? AND name = ?", removed)
+        except sqlite3.Error as e:
+            _logger.debug(f"Update package cache failed: {e}")
+
+    def clear(self, serial: str = None) -> None:
+        """
+        清除缓存
+        :param serial: 设备号，为空则清除所有设备
+        """
+        try:
+            with self._connect() as connection:
+                if serial is None:
+                    connection.execute("DELETE FROM packages")
+                else:
+                    connection.execute("DELETE FROM packages WHERE serial = ?", (serial,))
+        except sqlite3.Error as e:
+            _logger.debug(f"Clear package cache failed: {e}")
+
+
+package_cache = PackageCache()
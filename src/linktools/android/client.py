@@ -0,0 +1,608 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import os
+import select
+import socket
+import stat
+import struct
+import threading
+import time
+from collections import deque
+from typing import Optional, Tuple, List, Dict, Set, Callable, Any
+
+from .adb import AdbError
+from .. import utils, environ
+
+_logger = environ.get_logger("android.client")
+
+_SYNC_DATA_MAX = 64 * 1024
+
+_SHELL_ID_STDIN = 0
+_SHELL_ID_STDOUT = 1
+_SHELL_ID_STDERR = 2
+_SHELL_ID_EXIT = 3
+_SHELL_ID_CLOSE_STDIN = 4
+
+
+class AdbConnectionError(AdbError):
+    """
+    无法连接adb server，此时还没有发送任何请求，可以安全地回退到adb命令行
+    """
+    pass
+
+
+class AdbProtocolError(AdbError):
+    pass
+
+
+def _get_server_port() -> int:
+    """
+    adb server的默认端口，与adb命令行一样可以通过ANDROID_ADB_SERVER_PORT环境变量修改
+    """
+    return utils.int(os.environ.get("ANDROID_ADB_SERVER_PORT"), default=5037)
+
+
+# 以下函数只负责adb协议数据的编解码，AdbClient和AsyncAdbClient共用
+
+def _encode_request(request: str) -> bytes:
+    data = request.encode()
+    return b"%04x%s" % (len(data), data)
+
+
+def _make_status_error(status: bytes, message: str = None) -> AdbProtocolError:
+    if status == b"FAIL":
+        return AdbProtocolError(message)
+    return AdbProtocolError(f"unexpected adb status: {status!r}")
+
+
+def _encode_packet(id: bytes, data: bytes = b"") -> bytes:
+    return id + struct.pack("<I", len(data)) + data
+
+
+def _encode_int(id: bytes, value: int) -> bytes:
+    return id + struct.pack("<I", value)
+
+
+def _decode_header(header: bytes) -> Tuple[bytes, int]:
+    """
+    解析sync协议8字节的包头
+    :return: 包类型，数据长度
+    """
+    return header[:4], struct.unpack("<I", header[4:])[0]
+
+
+def _decode_stat(data: bytes) -> "SyncStat":
+    """
+    解析sync协议16字节的STAT响应
+    """
+    if data[:4] != b"STAT":
+        raise AdbProtocolError(f"unexpected sync response: {data[:4]!r}")
+    mode, size, mtime = struct.unpack("<III", data[4:])
+    return SyncStat(mode, size, mtime)
+
+
+def _decode_shell_header(header: bytes) -> Tuple[int, int]:
+    """
+    解析shell_v2协议5字节的包头
+    :return: 数据流id，数据长度
+    """
+    return header[0], struct.unpack("<I", header[1:])[0]
+
+
+class _ShellOutput:
+    """
+    按数据流id收集shell_v2的输出
+    """
+
+    def __init__(self):
+        self.out = bytearray()
+        self.err = bytearray()
+        self.exit_code: Optional[int] = None
+
+    def feed(self, id: int, data: bytes) -> bool:
+        """
+        :return: 命令是否已经退出
+        """
+        if id == _SHELL_ID_STDOUT:
+            self.out.extend(data)
+        elif id == _SHELL_ID_STDERR:
+            self.err.extend(data)
+        elif id == _SHELL_ID_EXIT:
+            self.exit_code = data[0] if data else 0
+            return True
+        return False
+
+    def result(self) -> Tuple[bytes, bytes, Optional[int]]:
+        return bytes(self.out), bytes(self.err), self.exit_code
+
+
+class SyncStat:
+
+    def __init__(self, mode: int, size: int, mtime: int):
+        self.mode = mode
+        self.size = size
+        self.mtime = mtime
+
+    @property
+    def exists(self) -> bool:
+        return self.mode != 0
+
+    @property
+    def is_dir(self) -> bool:
+        return stat.S_ISDIR(self.mode)
+
+    @property
+    def is_file(self) -> bool:
+        return stat.S_ISREG(self.mode)
+
+    def __repr__(self):
+        return f"SyncStat(mode={self.mode:o}, size={self.size}, mtime={self.mtime})"
+
+
+class AdbConnection:
+
+    def __init__(self, sock: socket.socket):
+        self._sock = sock
+
+    @property
+    def socket(self) -> socket.socket:
+        return self._sock
+
+    @property
+    def is_closed(self) -> bool:
+        return self._sock is None
+
+    @property
+    def is_alive(self) -> bool:
+        """
+        空闲连接是否还可用，如果对端已经关闭或者有未读数据，都认为不可用
+        """
+        if self._sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([self._sock], [], [], 0)
+            return not readable
+        except (OSError, ValueError):
+            return False
+
+    def settimeout(self, timeout: utils.Timeout) -> None:
+        self._sock.settimeout(timeout.remain if timeout else None)
+
+    def send(self, data: bytes) -> None:
+        self._sock.sendall(data)
+
+    def send_request(self, request: str) -> None:
+        self._sock.sendall(_encode_request(request))
+
+    def recv(self, size: int = 65536) -> bytes:
+        return self._sock.recv(size)
+
+    def recv_exactly(self, size: int) -> bytes:
+        # 预先分配好缓冲区直接写入，读取大块数据时不需要反复扩容和拷贝
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        offset = 0
+        while offset < size:
+            count = self._sock.recv_into(view[offset:])
+            if not count:
+                raise AdbProtocolError(f"connection closed, expected {size} bytes, got {offset}")
+            offset += count
+        view.release()
+        return bytes(buffer)
+
+    def recv_all(self) -> bytes:
+        buffer = bytearray()
+        while True:
+            data = self._sock.recv(65536)
+            if not data:
+                break
+            buffer.extend(data)
+        return bytes(buffer)
+
+    def recv_string(self) -> str:
+        length = int(self.recv_exactly(4), 16)
+        return self.recv_exactly(length).decode(errors="ignore")
+
+    def check_status(self) -> None:
+        status = self.recv_exactly(4)
+        if status != b"OKAY":
+            raise _make_status_error(status, self.recv_string() if status == b"FAIL" else None)
+
+    def request(self, request: str) -> None:
+        """
+        发送请求并检查返回状态
+        :param request: 请求内容，如host:version
+        """
+        self.send_request(request)
+        self.check_status()
+
+    def close(self) -> None:
+        if self._sock is not None:
+            utils.ignore_error(self._sock.close)
+            self._sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class SyncConnection:
+
+    def __init__(self, serial: str, connection: AdbConnection):
+        self._serial = serial
+        self._connection = connection
+
+    @property
+    def serial(self) -> str:
+        return self._serial
+
+    @property
+    def is_alive(self) -> bool:
+        return self._connection.is_alive
+
+    def settimeout(self, timeout: utils.Timeout) -> None:
+        self._connection.settimeout(timeout)
+
+    def _send_packet(self, id: bytes, data: bytes = b"") -> None:
+        self._connection.send(_encode_packet(id, data))
+
+    def _send_int(self, id: bytes, value: int) -> None:
+        self._connection.send(_encode_int(id, value))
+
+    def _recv_header(self) -> Tuple[bytes, int]:
+        return _decode_header(self._connection.recv_exactly(8))
+
+    def _raise_fail(self, length: int) -> None:
+        message = self._connection.recv_exactly(length).decode(errors="ignore")
+        raise AdbProtocolError(message)
+
+    def stat(self, path: str) -> SyncStat:
+        """
+        获取远程文件信息
+        :param path: 远程路径
+        :return: 文件信息，文件不存在时mode为0
+        """
+        self._send_packet(b"STAT", path.encode())
+        return _decode_stat(self._connection.recv_exactly(16))
+
+    def list(self, path: str) -> List[Tuple[str, SyncStat]]:
+        """
+        列出远程目录
+        :param path: 远程目录
+        :return: 文件名和文件信息列表
+        """
+        result = []
+        self._send_packet(b"LIST", path.encode())
+        while True:
+            data = self._connection.recv_exactly(20)
+            id = data[:4]
+            if id == b"DONE":
+                break
+            if id != b"DENT":
+                raise AdbProtocolError(f"unexpected sync response: {id!r}")
+            mode, size, mtime, name_length = struct.unpack("<IIII", data[4:])
+            name = self._connection.recv_exactly(name_length).decode(errors="ignore")
+            if name not in (".", ".."):
+                result.append((name, SyncStat(mode, size, mtime)))
+        return result
+
+    def push(self, reader: Callable[[int], bytes], path: str, mode: int = 0o644, mtime: int = None) -> None:
+        """
+        推送数据到远程文件
+        :param reader: 数据来源，接收读取长度，返回空数据表示结束
+        :param path: 远程路径
+        :param mode: 文件权限
+        :param mtime: 文件修改时间
+        """
+        self._send_packet(b"SEND", f"{path},{mode}".encode())
+        while True:
+            data = reader(_SYNC_DATA_MAX)
+            if not data:
+                break
+            self._send_packet(b"DATA", data)
+        self._send_int(b"DONE", int(mtime if mtime is not None else time.time()))
+        id, length = self._recv_header()
+        if id == b"FAIL":
+            self._raise_fail(length)
+        if id != b"OKAY":
+            raise AdbProtocolError(f"unexpected sync response: {id!r}")
+
+    def pull(self, path: str, writer: Callable[[bytes], Any]) -> None:
+        """
+        拉取远程文件
+        :param path: 远程路径
+        :param writer: 数据写入回调
+        """
+        self._send_packet(b"RECV", path.encode())
+        while True:
+            id, length = self._recv_header()
+            if id == b"DATA":
+                writer(self._connection.recv_exactly(length))
+            elif id == b"DONE":
+                break
+            elif id == b"FAIL":
+                self._raise_fail(length)
+            else:
+                raise AdbProtocolError(f"unexpected sync response: {id!r}")
+
+    def close(self) -> None:
+        if not self._connection.is_closed:
+            utils.ignore_error(self._send_int, args=(b"QUIT", 0))
+            self._connection.close()
+
+
+class AdbClient:
+    """
+    直接通过adb server协议(默认tcp:127.0.0.1:5037)与设备通信，省去每次fork adb进程的开销
+    """
+
+    def __init__(self, host: str = None, port: int = None, max_idle: int = 4, connect_timeout: float = 3):
+        """
+        :param host: adb server地址
+        :param port: adb server端口
+        :param max_idle: 每台设备最多缓存的sync连接数
+        :param connect_timeout: 连接adb server的超时时间
+        """
+        self.host = host or "127.0.0.1"
+        self.port = port or _get_server_port()
+        self.max_idle = max_idle
+        self.connect_timeout = connect_timeout
+        self._lock = threading.Lock()
+        self._sync_pool: Dict[str, deque] = {}
+        self._features: Dict[str, Set[str]] = {}
+
+    @utils.timeoutable
+    def connect(self, timeout: utils.Timeout = None) -> AdbConnection:
+        """
+        连接adb server
+        :return: 连接对象
+        """
+        remain = timeout.remain
+        connect_timeout = self.connect_timeout if remain is None else min(remain, self.connect_timeout)
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=connect_timeout)
+        except OSError as e:
+            raise AdbConnectionError(f"cannot connect to adb server {self.host}:{self.port}: {e}") from e
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = AdbConnection(sock)
+        connection.settimeout(timeout)
+        return connection
+
+    @utils.timeoutable
+    def transport(self, serial: str, timeout: utils.Timeout = None) -> AdbConnection:
+        """
+        连接adb server并切换到指定设备
+        :param serial: 设备号
+        :return: 连接对象
+        """
+        connection = self.connect(timeout=timeout)
+        try:
+            connection.request(f"host:transport:{serial}")
+        except:
+            connection.close()
+            raise
+        return connection
+
+    @utils.timeoutable
+    def is_available(self, timeout: utils.Timeout = None) -> bool:
+        """
+        adb server是否可用
+        """
+        try:
+            self.version(timeout=timeout)
+            return True
+        except (AdbError, OSError) as e:
+            _logger.debug(f"Adb server {self.host}:{self.port} is not available: {e}")
+            return False
+
+    @utils.timeoutable
+    def version(self, timeout: utils.Timeout = None) -> int:
+        """
+        获取adb server版本号
+        """
+        with self.connect(timeout=timeout) as connection:
+            connection.request("host:version")
+            return int(connection.recv_string(), 16)
+
+    @utils.timeoutable
+    def host_request(self, request: str, timeout: utils.Timeout = None) -> str:
+        """
+        发送host请求，并读取返回的字符串，如host:devices
+        """
+        with self.connect(timeout=timeout) as connection:
+            connection.request(request)
+            return connection.recv_string()
+
+    @utils.timeoutable
+    def get_features(self, serial: str, timeout: utils.Timeout = None) -> Set[str]:
+        """
+        获取设备支持的特性，如shell_v2、cmd等
+        :param serial: 设备号
+        :return: 特性集合
+        """
+        features = self._features.get(serial)
+        if features is None:
+            result = self.host_request(f"host-serial:{serial}:features", timeout=timeout)
+            features = self._features[serial] = set(result.strip().split(","))
+        return features
+
+    @utils.timeoutable
+    def open(self, serial: str, service: str, timeout: utils.Timeout = None) -> AdbConnection:
+        """
+        打开设备上的服务，返回原始数据流，如shell:ls、exec:screencap -p
+        :param serial: 设备号
+        :param service: 服务名
+        :return: 连接对象，使用完需要关闭
+        """
+        connection = self.transport(serial, timeout=timeout)
+        try:
+            connection.request(service)
+        except:
+            connection.close()
+            raise
+        return connection
+
+    @utils.timeoutable
+    def shell(self, serial: str, command: str, timeout: utils.Timeout = None) \
+            -> Tuple[bytes, bytes, Optional[int]]:
+        """
+        执行shell命令，设备支持shell_v2时可以拿到stderr和返回码
+        :param serial: 设备号
+        :param command: shell命令
+        :param timeout: 超时时间，超时后返回已读取的内容
+        :return: stdout, stderr, 返回码（不支持shell_v2或超时时为None）
+        """
+        if "shell_v2" not in self.get_features(serial, timeout=timeout):
+            return self.exec_out(serial, command, service="shell", timeout=timeout), b"", None
+
+        output = _ShellOutput()
+        with self.open(serial, f"shell,v2,raw:{command}", timeout=timeout) as connection:
+            try:
+                while True:
+                    connection.settimeout(timeout)
+                    id, length = _decode_shell_header(connection.recv_exactly(5))
+                    if output.feed(id, connection.recv_exactly(length) if length > 0 else b""):
+                        break
+            except socket.timeout:
+                _logger.debug(f"Shell command timeout: {command}")
+            except AdbProtocolError:
+                # 连接被提前关闭，返回已经读取的内容
+                pass
+        return output.result()
+
+    @utils.timeoutable
+    def exec_out(self, serial: str, command: str, service: str = "exec", timeout: utils.Timeout = None) -> bytes:
+        """
+        执行命令并读取原始输出（不经过pty，二进制安全）
+        :param serial: 设备号
+        :param command: 命令
+        :param service: 服务名，默认为exec
+        :param timeout: 超时时间，超时后返回已读取的内容
+        :return: 输出内容
+        """
+        buffer = bytearray()
+        with self.open(serial, f"{service}:{command}", timeout=timeout) as connection:
+            try:
+                while True:
+                    connection.settimeout(timeout)
+                    data = connection.recv(65536)
+                    if not data:
+                        break
+                    buffer.extend(data)
+            except socket.timeout:
+                _logger.debug(f"Exec command timeout: {command}")
+        return bytes(buffer)
+
+    @utils.timeoutable
+    def exec_in(self, serial: str, command: str, reader: Callable[[int], bytes],
+                timeout: utils.Timeout = None) -> bytes:
+        """
+        执行命令并把数据写入命令的stdin，写完后读取命令输出
+        :param serial: 设备号
+        :param command: 命令
+        :param reader: 数据来源，接收读取长度，返回空数据表示结束
+        :param timeout: 超时时间
+        :return: 输出内容
+        """
+        with self.open(serial, f"exec:{command}", timeout=timeout) as connection:
+            connection.settimeout(timeout)
+            while True:
+                data = reader(65536)
+                if not data:
+                    break
+                connection.send(data)
+            # adb server收到半关闭会直接关闭整个连接，所以这里不shutdown，由命令自己判断数据是否结束
+            return connection.recv_all()
+
+    @utils.timeoutable
+    def _acquire_sync(self, serial: str, timeout: utils.Timeout = None) -> SyncConnection:
+        with self._lock:
+            pool = self._sync_pool.get(serial)
+            while pool:
+                connection = pool.pop()
+                if connection.is_alive:
+                    connection.settimeout(timeout)
+                    return connection
+                connection.close()
+        return SyncConnection(serial, self.open(serial, "sync:", timeout=timeout))
+
+    def _release_sync(self, connection: SyncConnection) -> None:
+        with self._lock:
+            pool = self._sync_pool.setdefault(connection.serial, deque())
+            if len(pool) < self.max_idle:
+                connection.settimeout(None)
+                pool.append(connection)
+                return
+        connection.close()
+
+    @utils.timeoutable
+    def sync(self, serial: str, fn: "Callable[[SyncConnection], Any]", timeout: utils.Timeout = None) -> Any:
+        """
+        从连接池中取出sync连接并执行操作，正常结束后连接会放回连接池
+        :param serial: 设备号
+        :param fn: 需要执行的操作
+        :return: 操作返回值
+        """
+        connection = self._acquire_sync(serial, timeout=timeout)
+        try:
+            result = fn(connection)
+        except:
+            # 协议状态未知，直接丢弃这个连接
+            connection.close()
+            raise
+        self._release_sync(connection)
+        return result
+
+    @utils.timeoutable
+    def stat(self, serial: str, path: str, timeout: utils.Timeout = None) -> SyncStat:
+        return self.sync(serial, lambda c: c.stat(path), timeout=timeout)
+
+    @utils.timeoutable
+    def list_dir(self, serial: str, path: str, timeout: utils.Timeout = None) -> List[Tuple[str, SyncStat]]:
+        return self.sync(serial, lambda c: c.list(path), timeout=timeout)
+
+    @utils.timeoutable
+    def push(self, serial: str, src: str, dst: str, mode: int = None, timeout: utils.Timeout = None) -> None:
+        """
+        推送本地文件到设备
+        :param serial: 设备号
+        :param src: 本地文件
+        :param dst: 远程路径
+        :param mode: 文件权限，默认与本地文件相同
+        """
+        st = os.stat(src)
+        if mode is None:
+            mode = stat.S_IMODE(st.st_mode)
+        with open(src, "rb") as fd:
+            self.sync(serial, lambda c: c.push(fd.read, dst, mode=mode, mtime=int(st.st_mtime)), timeout=timeout)
+
+    @utils.timeoutable
+    def pull(self, serial: str, src: str, dst: str, timeout: utils.Timeout = None) -> None:
+        """
+        拉取设备文件到本地
+        :param serial: 设备号
+        :param src: 远程路径
+        :param dst: 本地文件
+        """
+        # 先写到临时文件，拉取失败时不会留下空文件或者不完整的文件
+        temp_path = f"{dst}.linktools-partial"
+        try:
+            with open(temp_path, "wb") as fd:
+                self.sync(serial, lambda c: c.pull(src, fd.write), timeout=timeout)
+        except BaseException:
+            utils.ignore_error(os.remove, args=(temp_path,))
+            raise
+        os.replace(temp_path, dst)
+
+    def close(self) -> None:
+        with self._lock:
+            pools, self._sync_pool = self._sync_pool, {}
+        for pool in pools.values():
+            for connection in pool:
+                connection.close()
+
+    def __repr__(self):
+        return f"AdbClient<{self.host}:{self.port}>"
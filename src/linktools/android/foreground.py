@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import atexit
+import re
+import subprocess
+import threading
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+from .. import utils, environ
+from ..reactor import Stoppable
+
+if TYPE_CHECKING:
+    from .adb import Device
+
+_logger = environ.get_logger("android.foreground")
+
+# 只取activity栈中resumed的那一行，不会像dumpsys activity top一样输出整个view树
+_QUERY_COMMAND = "dumpsys activity activities | grep ResumedActivity"
+
+# android 7: am_focused_activity, android 8/9: am_set_resumed_activity, android 10+: wm_set_resumed_activity
+_EVENT_TAGS = ("am_focused_activity", "am_set_resumed_activity", "wm_set_resumed_activity")
+
+_record_pattern = re.compile(r"ActivityRecord\{\S+ u\d+ ([^\s/}]+/[^\s}]+)")
+_event_pattern = re.compile(r"^\[\d+,([^,\]/]+/[^,\]]+)")
+
+
+def parse_resumed_activity(out: str) -> Optional[str]:
+    """
+    解析dumpsys activity activities中resumed activity的组件名，
+    多个屏幕时优先使用topResumedActivity
+    :return: 组件名，如com.android.settings/.Settings
+    """
+    result = None
+    for line in out.splitlines():
+        match = _record_pattern.search(line)
+        if match is None:
+            continue
+        if "topResumedActivity" in line:
+            return match.group(1)
+        if result is None:
+            result = match.group(1)
+    return result
+
+
+@utils.timeoutable
+def query_resumed_activity(device: "Device", timeout: utils.Timeout = None) -> Optional[str]:
+    """
+    获取当前resumed activity的组件名
+    :param device: 设备
+    :param timeout: 超时时间
+    :return: 组件名，获取失败返回None
+    """
+    result = device.shell_batch([_QUERY_COMMAND], ignore_errors=True, timeout=timeout)[0]
+    return parse_resumed_activity(result.out)
+
+
+class ForegroundTracker(Stoppable):
+    """
+    跟踪前台应用，先查询一次当前resumed activity，之后在同一个adb shell中通过
+    logcat -b events监听activity resumed事件，不需要反复执行dumpsys
+    """
+
+    _trackers: Dict[str, "ForegroundTracker"] = {}
+    _trackers_lock = threading.Lock()
+
+    def __init__(self, device: "Device"):
+        self._device = device
+        self._mark = f"__linktools_{utils.make_uuid()}__"
+        self._process: Optional[subprocess.Popen] = None
+        self._thread: Optional[threading.Thread] = None
+        self._component: Optional[str] = None
+        self._ready = False
+        self._failed = False
+        self._cond = threading.Condition()
+        self._listeners: List[Callable[[str, str], Any]] = []
+
+    @classmethod
+    def get(cls, device: "Device") -> "ForegroundTracker":
+        """
+        同一个进程中同一台设备共用一个ForegroundTracker，获取时不会启动，需要显式调用start，
+        事件流异常退出后（如设备不支持logcat -T）不会自动重启
+        """
+        with cls._trackers_lock:
+            tracker = cls._trackers.get(device.id)
+            if tracker is None:
+                tracker = cls._trackers[device.id] = cls(device)
+                atexit.register(tracker.stop)
+            return tracker
+
+    @classmethod
+    def find(cls, device: "Device") -> "Optional[ForegroundTracker]":
+        """
+        获取已经在运行的ForegroundTracker，不会启动新的
+        """
+        tracker = cls._trackers.get(device.id)
+        return tracker if tracker is not None and tracker.is_running else None
+
+    @property
+    def is_running(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    @property
+    def failed(self) -> bool:
+        return self._failed
+
+    @property
+    def is_ready(self) -> bool:
+        return self._ready and self.is_running
+
+    @property
+    def current_component(self) -> Optional[str]:
+        return self._component
+
+    @property
+    def current_package(self) -> Optional[str]:
+        component = self._component
+        return component.split("/", 1)[0] if component else None
+
+    @property
+    def current_activity(self) -> Optional[str]:
+        return self._component
+
+    def add_listener(self, fn: Callable[[str, str], Any]) -> None:
+        """
+        :param fn: 前台activity变化时回调：(包名, 组件名)，在读取线程中执行
+        """
+        self._listeners.append(fn)
+
+    def _make_script(self) -> str:
+        # 先记录时间再查询，查询期间发生的切换也能从logcat中读到
+        tags = " ".join(f"{tag}:I" for tag in _EVENT_TAGS)
+        return (
+            f"__t=$(date +'%m-%d %H:%M:%S.000'); "
+            f"{_QUERY_COMMAND}; "
+            f"echo {self._mark}; "
+            f"logcat -b events -v raw -T \"$__t\" {tags} '*:S'"
+        )
+
+    def start(self) -> "ForegroundTracker":
+        if self.is_running:
+            return self
+        with self._cond:
+            self._ready = False
+            self._failed = False
+        # 脚本原样交给设备上的shell执行，不能经过list2cmdline转义
+        self._process = self._device.popen(
+            "shell", self._make_script(),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self._thread = threading.Thread(target=self._read_loop, args=(self._process,), name="foreground-tracker")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        process, self._process = self._process, None
+        if process is not None:
+            utils.ignore_error(process.kill)
+            utils.ignore_error(process.wait, args=(1,))
+
+    @utils.timeoutable
+    def wait_ready(self, timeout: utils.Timeout = None) -> bool:
+        """
+        等待第一次查询完成
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._ready or not self.is_running, timeout.remain) and self._ready
+
+    def _read_loop(self, process: subprocess.Popen) -> None:
+        lines = []
+        try:
+            for line in iter(process.stdout.readline, b""):
+                line = line.decode(errors="ignore").strip()
+                if not self._ready:
+                    if line != self._mark:
+                        lines.append(line)
+                        continue
+                    self._update(parse_resumed_activity("\n".join(lines)))
+                    with self._cond:
+                        self._ready = True
+                        self._cond.notify_all()
+                    continue
+                match = _event_pattern.match(line)
+                if match is not None:
+                    self._update(match.group(1))
+        except (OSError, ValueError) as e:
+            _logger.debug(f"Foreground tracker read error: {e}")
+        finally:
+            with self._cond:
+                # 不是被stop结束的，说明事件流不可用
+                if self._process is process:
+                    _logger.debug(f"{self} exited unexpectedly")
+                    self._failed = True
+                self._cond.notify_all()
+
+    def _update(self, component: Optional[str]) -> None:
+        if not component or component == self._component:
+            return
+        self._component = component
+        package = component.split("/", 1)[0]
+        _logger.debug(f"Foreground activity of {self._device.id} changed: {component}")
+        for listener in self._listeners:
+            try:
+                listener(package, component)
+            except Exception as e:
+                _logger.warning(f"Foreground listener error: {e}")
+
+    def __repr__(self):
+        return f"ForegroundTracker<{self._device.id}>"
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Generator, Iterable, List, Optional, Tuple
+
+from .adb import AdbError
+from .. import utils, environ
+from ..decorator import cached_property
+from ..reactor import Stoppable
+
+if TYPE_CHECKING:
+    from .adb import Device
+
+_logger = environ.get_logger("android.forward")
+
+
+def _is_process_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    if sys.platform == "win32":
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        try:
+            exit_code = ctypes.c_ulong()
+            return kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)) != 0 and exit_code.value == 259
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _parse_port(address: str) -> Optional[int]:
+    if address.startswith("tcp:"):
+        return utils.int(address[4:], default=None)
+    return None
+
+
+class ForwardRegistry:
+    """
+    本机所有进程共享的端口转发登记表，保存为json文件并通过文件锁同步：
+    ports记录预留的本地端口，forward和reverse记录每个转发的使用者进程
+    """
+
+    def __init__(self, path: str = None, ports: Iterable[int] = None):
+        """
+        :param path: 登记表路径，为空则放在数据目录下
+        :param ports: 可分配的本地端口范围
+        """
+        self._path = path
+        self._ports = ports
+        self._lock = threading.RLock()
+
+    @property
+    def path(self) -> str:
+        if self._path is None:
+            self._path = environ.get_data_path("android", "forward.json", create_parent=True)
+        return self._path
+
+    @property
+    def ports(self) -> Iterable[int]:
+        if self._ports is None:
+            start = environ.get_config("ANDROID_FORWARD_PORT_START", type=int, default=47134)
+            self._ports = range(start, start + 5000)
+        return self._ports
+
+    @cached_property
+    def _file_lock(self):
+        from filelock import FileLock
+        return FileLock(f"{self.path}.lock")
+
+    @contextlib.contextmanager
+    def transaction(self) -> Generator[Dict[str, Dict[str, dict]], None, None]:
+        """
+        加锁读取登记表，退出时写回，已经退出的进程预留的端口会被清理掉
+        """
+        with self._lock, self._file_lock:
+            data = None
+            if os.path.exists(self.path):
+                try:
+                    data = json.loads(utils.read_file(self.path, binary=False) or "{}")
+                except (OSError, ValueError) as e:
+                    _logger.debug(f"Load forward registry failed: {e}")
+            if not isinstance(data, dict):
+                data = {}
+            for name in ("ports", "forward", "reverse"):
+                if not isinstance(data.get(name), dict):
+                    data[name] = {}
+
+            alive = {}
+            for entries in data.values():
+                for key, entry in list(entries.items()):
+                    pids = [pid for pid in entry.get("pids", ()) if alive.setdefault(pid, _is_process_alive(pid))]
+                    if pids or entries is not data["ports"]:
+                        entry["pids"] = pids
+                    else:
+                        entries.pop(key)
+
+            yield data
+
+            temp_path = f"{self.path}.{os.getpid()}.tmp"
+            utils.write_file(temp_path, json.dumps(data, indent=2))
+            os.replace(temp_path, self.path)
+
+    def allocate_port(self, data: Dict[str, Dict[str, dict]]) -> int:
+        """
+        在登记表中挑选一个没有被预留或转发占用的端口，只对选中的端口做一次绑定检查
+        """
+        used = set(utils.int(port, default=0) for port in data["ports"])
+        for entry in data["forward"].values():
+            used.add(_parse_port(entry.get("local", "")))
+        for port in self.ports:
+            if port in used:
+                continue
+            if utils.is_port_free(port):
+                return port
+            # 被登记表以外的程序占用了
+            used.add(port)
+        raise AdbError("no free port found in forward registry")
+
+    def reserve_port(self) -> int:
+        """
+        为当前进程预留一个本地端口，进程退出后自动失效
+        :return: 端口号
+        """
+        with self.transaction() as data:
+            port = self.allocate_port(data)
+            data["ports"][str(port)] = {"pids": [os.getpid()], "time": time.time()}
+            return port
+
+    def release_port(self, port: int) -> None:
+        with self.transaction() as data:
+            entry = data["ports"].get(str(port))
+            if entry is not None and os.getpid() in entry["pids"]:
+                data["ports"].pop(str(port))
+
+
+class _ForwardRef:
+
+    __slots__ = ("local", "remote", "count")
+
+    def __init__(self, local: str, remote: str):
+        self.local = local
+        self.remote = remote
+        self.count = 0
+
+
+class ForwardHandle(Stoppable):
+    """
+    转发的引用，最后一个引用stop之后才会真正移除转发
+    """
+
+    def __init__(self, manager: "ForwardManager", type: str, key: str, local: str, remote: str):
+        self._manager = manager
+        self._type = type
+        self._key = key
+        self._local = local
+        self._remote = remote
+        self._stopped = False
+
+    @property
+    def local(self) -> List[str]:
+        return self._local.split(":", maxsplit=1)
+
+    @property
+    def remote(self) -> List[str]:
+        return self._remote.split(":", maxsplit=1)
+
+    @property
+    def local_port(self) -> Optional[int]:
+        return _parse_port(self._local)
+
+    @property
+    def remote_port(self) -> Optional[int]:
+        return _parse_port(self._remote)
+
+    def stop(self):
+        if not self._stopped:
+            self._stopped = True
+            self._manager._release(self._type, self._key)
+
+    def __repr__(self):
+        return f"ForwardHandle<{self._type} {self._local} -> {self._remote}>"
+
+
+class ForwardManager:
+    """
+    单台设备的端口转发管理，相同的转发只创建一次并引用计数，
+    同一台电脑上的多个进程通过ForwardRegistry共享转发和端口分配
+    """
+
+    _managers: Dict[str, "ForwardManager"] = {}
+    _managers_lock = threading.Lock()
+
+    def __init__(self, device: "Device", registry: ForwardRegistry = None):
+        self._device = device
+        self._registry = registry or forward_registry
+        self._lock = threading.RLock()
+        self._refs: Dict[Tuple[str, str], _ForwardRef] = {}
+        self._cleaned = False
+
+    @classmethod
+    def get(cls, device: "Device") -> "ForwardManager":
+        """
+        同一个进程中同一台设备共用一个ForwardManager
+        """
+        with cls._managers_lock:
+            manager = cls._managers.get(device.id)
+            if manager is None:
+                manager = cls._managers[device.id] = cls(device)
+            return manager
+
+    def forward(self, local: Optional[str], remote: str) -> ForwardHandle:
+        """
+        把本地端口转发到设备上
+        :param local: 本地端口，为空或者tcp:0时复用已有的转发或者从登记表中分配端口
+        :param remote: 远程端口
+        :return: 转发引用
+        """
+        with self._lock, self._registry.transaction() as data:
+            self._cleanup(data)
+            entries = data["forward"]
+            if local in (None, "tcp:0"):
+                local = None
+                for entry in entries.values():
+                    if entry["serial"] == self._device.id and entry["remote"] == remote:
+                        local = entry["local"]
+                        break
+                if local is None:
+                    local = f"tcp:{self._registry.allocate_port(data)}"
+            key = self._make_key(local)
+            self._acquire(data, "forward", key, local, remote, ("forward", local, remote))
+            return ForwardHandle(self, "forward", key, local, remote)
+
+    def reverse(self, remote: str, local: str) -> ForwardHandle:
+        """
+        把设备上的端口转发到本地
+        :param remote: 远程端口，tcp:0时复用已有的转发或者由adb分配端口
+        :param local: 本地端口
+        :return: 转发引用
+        """
+        with self._lock, self._registry.transaction() as data:
+            self._cleanup(data)
+            entries = data["reverse"]
+            if remote == "tcp:0":
+                remote = None
+                for entry in entries.values():
+                    if entry["serial"] == self._device.id and entry["local"] == local:
+                        remote = entry["remote"]
+                        break
+                if remote is None:
+                    port = self._device.exec("reverse", "tcp:0", local).strip()
+                    remote = f"tcp:{port}"
+            key = self._make_key(remote)
+            self._acquire(data, "reverse", key, local, remote, ("reverse", remote, local))
+            return ForwardHandle(self, "reverse", key, local, remote)
+
+    def _make_key(self, address: str) -> str:
+        return f"{self._device.id}|{address}"
+
+    def _acquire(self, data: dict, type: str, key: str, local: str, remote: str, args: Tuple[str, ...]):
+        ref = self._refs.get((type, key))
+        entry = data[type].get(key)
+        if ref is None or ref.local != local or ref.remote != remote or entry is None:
+            # 其他进程创建的转发也重新执行一次，adb server重启后转发会丢失
+            self._device.exec(*args)
+            if entry is None or entry["local"] != local or entry["remote"] != remote:
+                entry = data[type][key] = {
+                    "serial": self._device.id, "local": local, "remote": remote, "pids": [],
+                }
+            if ref is None or ref.local != local or ref.remote != remote:
+                ref = self._refs[(type, key)] = _ForwardRef(local, remote)
+        if os.getpid() not in entry["pids"]:
+            entry["pids"].append(os.getpid())
+        ref.count += 1
+        _logger.debug(f"Acquire {type} {local} -> {remote}, refs: {ref.count}")
+
+    def _release(self, type: str, key: str) -> None:
+        with self._lock:
+            ref = self._refs.get((type, key))
+            if ref is None:
+                return
+            ref.count -= 1
+            _logger.debug(f"Release {type} {ref.local} -> {ref.remote}, refs: {ref.count}")
+            if ref.count > 0:
+                return
+            self._refs.pop((type, key))
+            with self._registry.transaction() as data:
+                entry = data[type].get(key)
+                if entry is not None:
+                    if os.getpid() in entry["pids"]:
+                        entry["pids"].remove(os.getpid())
+                    if entry["pids"]:
+                        return
+                    data[type].pop(key)
+                    port = _parse_port(ref.local)
+                    if type == "forward" and port is not None:
+                        data["ports"].pop(str(port), None)
+            self._remove(type, ref.local if type == "forward" else ref.remote)
+
+    def _remove(self, type: str, address: str) -> None:
+        self._device.exec(type, "--remove", address, ignore_errors=True)
+
+    def _cleanup(self, data: dict) -> None:
+        """
+        清理已经退出的进程遗留的转发，每台设备只检查一次
+        """
+        if self._cleaned:
+            return
+        self._cleaned = True
+        for type in ("forward", "reverse"):
+            entries = data[type]
+            keys = [key for key, entry in entries.items() if entry["serial"] == self._device.id]
+            if not keys:
+                continue
+            try:
+                listed = self._list(type)
+            except AdbError as e:
+                _logger.debug(f"List {type} failed: {e}")
+                continue
+            for key in keys:
+                entry = entries[key]
+                address = entry["local"] if type == "forward" else entry["remote"]
+                if listed.get(address) != (entry["remote"] if type == "forward" else entry["local"]):
+                    # adb server重启过，转发已经不存在了
+                    entries.pop(key)
+                elif not entry["pids"]:
+                    _logger.debug(f"Remove stale {type}: {entry['local']} -> {entry['remote']}")
+                    self._remove(type, address)
+                    entries.pop(key)
+
+    def _list(self, type: str) -> Dict[str, str]:
+        """
+        :return: forward返回本地地址到远程地址的映射，reverse返回远程地址到本地地址的映射
+        """
+        result = {}
+        if type == "forward":
+            # adb forward --list会列出所有设备的转发: <serial> <local> <remote>
+            for line in self._device.exec("forward", "--list").splitlines():
+                items = line.split()
+                if len(items) == 3 and items[0] == self._device.id:
+                    result[items[1]] = items[2]
+        else:
+            # adb reverse --list: <transport> <remote> <local>
+            for line in self._device.exec("reverse", "--list").splitlines():
+                items = line.split()
+                if len(items) >= 3:
+                    result[items[-2]] = items[-1]
+        return result
+
+    def __repr__(self):
+        return f"ForwardManager<{self._device.id}>"
+
+
+forward_registry = ForwardRegistry()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import concurrent.futures
+import inspect
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Iterable, List, Optional, Generator, Union
+
+from .adb import Adb
+from .. import utils
+
+if TYPE_CHECKING:
+    from .adb import Device
+
+
+class DeviceResult:
+
+    __slots__ = ("device", "result", "error", "start_time", "end_time")
+
+    def __init__(self, device: "Device"):
+        self.device = device
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.start_time: Optional[float] = None
+        self.end_time: Optional[float] = None
+
+    @property
+    def is_success(self) -> bool:
+        return self.end_time is not None and self.error is None
+
+    @property
+    def elapsed(self) -> Optional[float]:
+        """
+        执行耗时，没有开始执行返回None
+        """
+        if self.start_time is None:
+            return None
+        return (self.end_time or time.time()) - self.start_time
+
+    def get(self) -> Any:
+        """
+        获取执行结果，执行出错时抛出对应的异常
+        """
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def __repr__(self):
+        state = "success" if self.is_success else f"error={self.error!r}"
+        elapsed = f"{self.elapsed:.3f}s" if self.elapsed is not None else "-"
+        return f"DeviceResult<{self.device.id}, {state}, elapsed={elapsed}>"
+
+
+class DeviceGroup:
+    """
+    多台设备并发执行同一个操作
+    """
+
+    def __init__(self, devices: "Iterable[Device]" = None, adb: Adb = None):
+        """
+        :param devices: 设备列表，为空则使用所有在线的设备
+        :param adb: 获取设备列表使用的adb对象
+        """
+        if devices is None:
+            devices = (adb or Adb()).list_devices(alive=True)
+        self._devices: "List[Device]" = list(devices)
+        self._cancel_event = threading.Event()
+
+    @property
+    def devices(self) -> "List[Device]":
+        return list(self._devices)
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+
+    def cancel(self) -> None:
+        """
+        取消正在进行的执行，还没有开始执行的设备不再执行，正在执行的设备结果会被标记为取消
+        """
+        self._cancel_event.set()
+
+    @utils.timeoutable
+    def map(self, fn: "Callable[..., Any]", max_workers: int = None, device_timeout: float = None,
+            timeout: utils.Timeout = None) -> List[DeviceResult]:
+        """
+        每台设备并发执行fn，如果fn声明了timeout参数，会传入该设备剩余的超时时间
+        :param fn: 执行的函数，第一个参数为设备
+        :param max_workers: 最大并发数，为空则所有设备同时执行
+        :param device_timeout: 单台设备的超时时间，从该设备开始执行时计算
+        :param timeout: 所有设备总的超时时间
+        :return: 每台设备的执行结果，顺序与设备列表一致
+        """
+        results = list(self.iter_map(fn, max_workers=max_workers, device_timeout=device_timeout, timeout=timeout))
+        return sorted(results, key=lambda result: self._devices.index(result.device))
+
+    @utils.timeoutable
+    def iter_map(self, fn: "Callable[..., Any]", max_workers: int = None, device_timeout: float = None,
+                 timeout: utils.Timeout = None) -> Generator[DeviceResult, None, None]:
+        """
+        与map相同，但是按照完成的先后顺序逐个返回结果
+        """
+        # cancel只对当前这次执行有效，之后可以继续复用
+        self._cancel_event.clear()
+        results = [DeviceResult(device) for device in self._devices]
+        if not results:
+            return
+
+        pass_timeout = self._accept_timeout(fn)
+
+        def run(result: DeviceResult):
+            if self._cancel_event.is_set():
+                raise concurrent.futures.CancelledError()
+            result.start_time = time.time()
+            try:
+                kwargs = {}
+                if pass_timeout:
+                    remains = [t for t in (device_timeout, timeout.remain) if t is not None]
+                    kwargs["timeout"] = utils.Timeout(min(remains) if remains else None)
+                return fn(result.device, **kwargs)
+            finally:
+                result.end_time = time.time()
+
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers or len(results),
+            thread_name_prefix="device-group",
+        )
+        try:
+            pending = {executor.submit(run, result): result for result in results}
+            while pending:
+                wait_time = self._get_wait_time(pending.values(), device_timeout, timeout)
+                done, _ = concurrent.futures.wait(
+                    pending.keys(), timeout=wait_time,
+                    return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    result = pending.pop(future)
+                    try:
+                        result.result = future.result()
+                    except BaseException as e:
+                        result.error = e
+                    yield result
+
+                now = time.time()
+                for future, result in list(pending.items()):
+                    if self._cancel_event.is_set():
+                        error = concurrent.futures.CancelledError()
+                    elif not timeout.check():
+                        error = TimeoutError(f"timeout after {now - (result.start_time or now):.3f}s")
+                    elif device_timeout is not None and result.start_time is not None \
+                            and now - result.start_time > device_timeout:
+                        error = TimeoutError(f"device timeout after {device_timeout}s")
+                    else:
+                        continue
+                    # 线程无法强制结束，这里只是不再等待它的结果
+                    future.cancel()
+                    pending.pop(future)
+                    result.error = error
+                    if result.start_time is not None and result.end_time is None:
+                        result.end_time = now
+                    yield result
+
+        except BaseException:
+            # 比如ctrl+c，剩下的设备都不再执行
+            self._cancel_event.set()
+            raise
+
+        finally:
+            executor.shutdown(wait=False)
+
+    @utils.timeoutable
+    def install(self, path_or_url: "Union[str, Iterable[str]]", opts: [str] = (), max_workers: int = None,
+                device_timeout: float = None, timeout: utils.Timeout = None) -> List[DeviceResult]:
+        """
+        所有设备同时安装同一个apk，apk只读取一次，然后流式传给每台设备
+        :param path_or_url: apk文件路径，split apk传入路径列表
+        :param opts: 安装参数
+        :param max_workers: 最大并发数
+        :param device_timeout: 单台设备的超时时间
+        :param timeout: 总超时时间
+        :return: 每台设备的安装结果
+        """
+        from .install import resolve_apks
+        apks = resolve_apks(path_or_url, load=True)
+        return self.map(
+            lambda device, timeout: device.install(apks, opts, timeout=timeout),
+            max_workers=max_workers,
+            device_timeout=device_timeout,
+            timeout=timeout,
+        )
+
+    @classmethod
+    def _accept_timeout(cls, fn: "Callable[..., Any]") -> bool:
+        try:
+            parameters = inspect.signature(fn).parameters
+        except (TypeError, ValueError):
+            return False
+        return "timeout" in parameters
+
+    def _get_wait_time(self, results: Iterable[DeviceResult], device_timeout: Optional[float],
+                       timeout: utils.Timeout) -> Optional[float]:
+        wait_time = timeout.remain
+        if device_timeout is not None:
+            now = time.time()
+            for result in results:
+                if result.start_time is not None:
+                    remain = max(result.start_time + device_timeout - now, 0)
+                    wait_time = remain if wait_time is None else min(wait_time, remain)
+        if self._cancel_event.is_set():
+            return 0
+        # 定期检查是否被取消或者有设备开始执行
+        return .5 if wait_time is None else min(wait_time, .5)
+
+    def __iter__(self):
+        return iter(self._devices)
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __repr__(self):
+        return f"DeviceGroup<{', '.join(device.id for device in self._devices)}>"
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import io
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from typing import TYPE_CHECKING, Any, BinaryIO, Iterable, List, Optional, Union
+
+from .adb import AdbError
+from .. import utils, environ
+
+if TYPE_CHECKING:
+    from .adb import Device
+
+_logger = environ.get_logger("android.install")
+
+_session_pattern = re.compile(r"\[(\d+)]")
+
+
+class InstallError(AdbError):
+    pass
+
+
+class ApkFile:
+    """
+    待安装的apk，可以预先读取到内存中，安装到多台设备时只需要读取一次本地文件
+    """
+
+    __slots__ = ("path", "name", "size", "_data")
+
+    def __init__(self, path: str, data: bytes = None):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = len(data) if data is not None else os.path.getsize(path)
+        self._data = data
+
+    @classmethod
+    def load(cls, path: str) -> "ApkFile":
+        return cls(path, utils.read_file(path, binary=True))
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._data is not None
+
+    def open(self) -> BinaryIO:
+        if self._data is not None:
+            return io.BytesIO(self._data)
+        return open(self.path, "rb")
+
+    def __repr__(self):
+        return f"ApkFile<{self.path}, size={self.size}>"
+
+
+def resolve_apks(path_or_urls: "Union[str, ApkFile, Iterable[Union[str, ApkFile]]]", load: bool = False) \
+        -> List[ApkFile]:
+    """
+    把apk路径、url或者split apk列表转换成ApkFile
+    :param path_or_urls: apk路径或url，split apk传入列表
+    :param load: 是否把文件内容读取到内存中
+    :return: apk列表
+    """
+    if isinstance(path_or_urls, (str, ApkFile)):
+        path_or_urls = [path_or_urls]
+    apks = []
+    for path_or_url in path_or_urls:
+        if isinstance(path_or_url, ApkFile):
+            apks.append(path_or_url)
+            continue
+        path = path_or_url
+        if path_or_url.startswith("http://") or path_or_url.startswith("https://"):
+            environ.logger.info(f"Download file: {path_or_url}")
+            file = environ.get_url_file(path_or_url)
+            path = file.save()
+            environ.logger.info(f"Save file to local: {path}")
+        apks.append(ApkFile.load(path) if load else ApkFile(path))
+    if not apks:
+        raise InstallError("no apk to install")
+    return apks
+
+
+def is_streaming_supported(device: "Device") -> bool:
+    """
+    android 7.0开始支持cmd package install -S从stdin读取apk，
+    没有native客户端时通过adb shell转发stdin，还需要shell_v2
+    """
+    features = device.features
+    if "cmd" not in features:
+        return False
+    return device.adb.client is not None or "shell_v2" in features
+
+
+@utils.timeoutable
+def stream_install(device: "Device", apks: List[ApkFile], opts: [str] = (),
+                   timeout: utils.Timeout = None) -> str:
+    """
+    通过stdin把apk直接传给package manager，不需要先推送到设备上，split apk使用install session安装
+    :param device: 设备
+    :param apks: apk列表
+    :param opts: 安装参数
+    :param timeout: 超时时间
+    :return: 安装输出
+    """
+    opts = list(opts or ())
+    if len(apks) == 1:
+        apk = apks[0]
+        _logger.debug(f"Stream install {apk} to {device.id}")
+        return _check_success(_exec_in(device, ["cmd", "package", "install", "-S", apk.size, *opts], apk, timeout))
+
+    total_size = sum(apk.size for apk in apks)
+    out = _check_success(_exec_in(device, ["cmd", "package", "install-create", "-S", total_size, *opts], None, timeout))
+    match = _session_pattern.search(out)
+    if not match:
+        raise InstallError(f"unable to create install session: {out}")
+    session = match.group(1)
+    _logger.debug(f"Stream install {len(apks)} apks to {device.id}, session: {session}")
+
+    try:
+        for index, apk in enumerate(apks):
+            # 同一个session中的文件名不能重复
+            name = f"{index}_{apk.name}"
+            _check_success(_exec_in(device, ["cmd", "package", "install-write", "-S", apk.size, session, name, "-"],
+                                    apk, timeout))
+        return _check_success(_exec_in(device, ["cmd", "package", "install-commit", session], None, timeout))
+    except:
+        utils.ignore_error(_exec_in, args=(device, ["cmd", "package", "install-abandon", session], None, timeout))
+        raise
+
+
+@utils.timeoutable
+def push_install(device: "Device", apks: List[ApkFile], opts: [str] = (),
+                 timeout: utils.Timeout = None, **kwargs) -> None:
+    """
+    先把apk推送到设备上再安装，用于不支持流式安装的设备
+    :param device: 设备
+    :param apks: apk列表
+    :param opts: 安装参数
+    :param timeout: 超时时间
+    """
+    opts = list(opts or ())
+    remote_dir = device.get_data_path("apk", str(int(time.time() * 1000)))
+    remote_paths = [f"{remote_dir}/{index}_{apk.name}" for index, apk in enumerate(apks)]
+    try:
+        for apk, remote_path in zip(apks, remote_paths):
+            environ.logger.debug(f"Push file to remote: {remote_path}")
+            device.push(apk.path, remote_path, timeout=timeout, **kwargs)
+    except Exception:
+        device.shell("rm", "-rf", remote_dir, ignore_errors=True)
+        raise
+
+    if len(apks) == 1:
+        commands = [["pm", "install", *opts, remote_paths[0]]]
+    else:
+        # 在同一个脚本里创建session，session id保存在shell变量中
+        total_size = sum(apk.size for apk in apks)
+        create = utils.list2cmdline(["pm", "install-create", "-S", str(total_size), *opts])
+        commands = [f"__session=$({create} | sed -n 's/.*\\[\\([0-9]*\\)\\].*/\\1/p'); [ -n \"$__session\" ]"]
+        for apk, remote_path in zip(apks, remote_paths):
+            args = ["-S", str(apk.size), os.path.basename(remote_path), remote_path]
+            commands.append(f"pm install-write $__session {utils.list2cmdline(args)}")
+        commands.append("pm install-commit $__session")
+
+    # 安装和清理临时文件合并成一次adb调用
+    environ.logger.debug(f"Install and clear remote dir: {remote_dir}")
+    device.shell_batch([*commands, ["rm", "-rf", remote_dir]], timeout=timeout, **kwargs)
+
+
+def _check_success(out: str) -> str:
+    out = out.strip()
+    if not out.startswith("Success"):
+        raise InstallError(out or "install failed")
+    return out
+
+
+def _exec_in(device: "Device", args: [Any], apk: Optional[ApkFile], timeout: utils.Timeout) -> str:
+    command = utils.list2cmdline([str(arg) for arg in args])
+    client = device.adb.client
+    if client is not None:
+        if apk is None:
+            return client.exec_out(device.id, command, timeout=timeout).decode(errors="ignore")
+        with apk.open() as fd:
+            return client.exec_in(device.id, command, fd.read, timeout=timeout).decode(errors="ignore")
+
+    process = device.popen("shell", command, stdin=subprocess.PIPE, capture_output=True)
+
+    def write():
+        try:
+            if apk is not None:
+                with apk.open() as fd:
+                    shutil.copyfileobj(fd, process.stdin)
+        except (OSError, ValueError) as e:
+            _logger.debug(f"Write apk to stdin failed: {e}")
+        finally:
+            utils.ignore_error(process.stdin.close)
+
+    thread = threading.Thread(target=write, daemon=True)
+    thread.start()
+    try:
+        out, err = process.exec(timeout=timeout)
+    finally:
+        process.kill()
+    if isinstance(out, bytes):
+        out = out.decode(errors="ignore")
+    if isinstance(err, bytes):
+        err = err.decode(errors="ignore")
+    return (out or "") + (err or "")
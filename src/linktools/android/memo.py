@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import asyncio
+import copy
+import functools
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .. import environ
+from ..metadata import __missing__
+
+if TYPE_CHECKING:
+    from typing import TypeVar
+    from .adb import Device
+
+    T = TypeVar("T")
+
+
+class MemoCache:
+    """
+    按设备号缓存Device方法的返回值，同一个进程中的Device对象共享；
+    超过ttl的结果失效，超过最大数量时淘汰最久没有使用的结果，修改设备状态的方法调用后按分组清除；
+    在设备外修改了状态（如手动安装应用）时缓存结果会过时，所以需要通过ANDROID_MEMO_CACHE显式开启
+    """
+
+    def __init__(self, maxsize: int = None):
+        """
+        :param maxsize: 最多缓存的结果数，为空则读取ANDROID_MEMO_MAXSIZE配置
+        """
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        # (设备号, 分组, 方法名, 参数) -> (返回值, 过期时间)
+        self._entries: "OrderedDict[Tuple, Tuple[Any, float]]" = OrderedDict()
+        self._counters: Dict[str, List[int]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return environ.get_config("ANDROID_MEMO_CACHE", type=bool, default=False)
+
+    @property
+    def ttl(self) -> float:
+        return environ.get_config("ANDROID_MEMO_TTL", type=float, default=30)
+
+    @property
+    def maxsize(self) -> int:
+        if self._maxsize is not None:
+            return self._maxsize
+        return environ.get_config("ANDROID_MEMO_MAXSIZE", type=int, default=256)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """
+        命中统计，methods中为每个方法的命中和未命中次数
+        """
+        with self._lock:
+            methods = {name: {"hits": hits, "misses": misses} for name, (hits, misses) in self._counters.items()}
+            return {
+                "hits": sum(counter["hits"] for counter in methods.values()),
+                "misses": sum(counter["misses"] for counter in methods.values()),
+                "size": len(self._entries),
+                "methods": methods,
+            }
+
+    def get(self, key: Tuple) -> Any:
+        """
+        获取缓存结果，没有命中或者已过期返回__missing__
+        """
+        name = key[2]
+        with self._lock:
+            counter = self._counters.setdefault(name, [0, 0])
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expire_time = entry
+                if expire_time > time.time():
+                    self._entries.move_to_end(key)
+                    counter[0] += 1
+                    return value
+                del self._entries[key]
+            counter[1] += 1
+            return __missing__
+
+    def put(self, key: Tuple, value: Any, ttl: float) -> None:
+        maxsize = self.maxsize
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, serial: str, groups: Iterable[str] = None) -> None:
+        """
+        清除设备的缓存结果
+        :param serial: 设备号
+        :param groups: 需要清除的分组，为空则清除该设备的所有结果
+        """
+        groups = set(groups) if groups is not None else None
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == serial and (groups is None or key[1] in groups)]:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._counters.clear()
+
+
+memo_cache = MemoCache()
+
+
+def _make_key(serial: str, group: str, name: str, args: Tuple, kwargs: Dict[str, Any],
+              bypass: str = None) -> Optional[Tuple]:
+    # timeout和强制刷新参数不影响结果，不作为键的一部分；参数不能hash时不缓存
+    items = tuple(sorted((k, v) for k, v in kwargs.items() if k != "timeout" and k != bypass))
+    key = (serial, group, name, args, items)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def memoize(group: str, ttl: float = None, bypass: str = None):
+    """
+    缓存Device方法的返回值，只适用于结果在短时间内不会变化的查询，也可以用在AsyncDevice的协程方法上
+    :param group: 分组，调用invalidates标记的方法后清除同组的结果
+    :param ttl: 有效时间（秒），为空则读取ANDROID_MEMO_TTL配置
+    :param bypass: 参数名，该参数为真时不读取缓存，但会用新结果更新缓存，之后不带该参数的调用也能拿到新结果
+    """
+
+    def decorator(fn: "Callable[..., T]") -> "Callable[..., T]":
+        name = fn.__qualname__
+
+        def get_key(self: "Device", args: Tuple, kwargs: Dict[str, Any]) -> Optional[Tuple]:
+            if not memo_cache.enabled:
+                return None
+            return _make_key(self.id, group, name, args, kwargs, bypass)
+
+        def get_value(key: Optional[Tuple], kwargs: Dict[str, Any]) -> Any:
+            if key is None or (bypass and kwargs.get(bypass)):
+                return __missing__
+            value = memo_cache.get(key)
+            # 返回深拷贝，调用方修改结果（包括列表中的对象）不会影响缓存
+            return copy.deepcopy(value) if value is not __missing__ else __missing__
+
+        def put_value(key: Optional[Tuple], value: Any) -> None:
+            if key is not None:
+                memo_cache.put(key, copy.deepcopy(value), ttl if ttl is not None else memo_cache.ttl)
+
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(self: "Device", *args: Any, **kwargs: Any) -> "T":
+                key = get_key(self, args, kwargs)
+                value = get_value(key, kwargs)
+                if value is __missing__:
+                    value = await fn(self, *args, **kwargs)
+                    put_value(key, value)
+                return value
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(self: "Device", *args: Any, **kwargs: Any) -> "T":
+            key = get_key(self, args, kwargs)
+            value = get_value(key, kwargs)
+            if value is __missing__:
+                value = fn(self, *args, **kwargs)
+                put_value(key, value)
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+def invalidates(*groups: str):
+    """
+    标记修改设备状态的Device方法，调用后（无论是否成功）清除这些分组的缓存
+    :param groups: 需要清除的分组
+    """
+
+    def decorator(fn: "Callable[..., T]") -> "Callable[..., T]":
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(self: "Device", *args: Any, **kwargs: Any) -> "T":
+                try:
+                    return await fn(self, *args, **kwargs)
+                finally:
+                    memo_cache.invalidate(self.id, groups)
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(self: "Device", *args: Any, **kwargs: Any) -> "T":
+            try:
+                return fn(self, *args, **kwargs)
+            finally:
+                memo_cache.invalidate(self.id, groups)
+
+        return wrapper
+
+    return decorator
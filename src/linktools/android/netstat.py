@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import ipaddress
+import time
+from typing import TYPE_CHECKING, Dict, Generator, Iterable, List, Optional, Tuple, Union
+
+from .adb import AdbError
+from .struct import InetSocket, UnixSocket
+from .. import utils, environ
+
+if TYPE_CHECKING:
+    from .adb import Device
+
+_logger = environ.get_logger("android.netstat")
+
+_proc_net_files = {
+    "tcp": ("/proc/net/tcp", "/proc/net/tcp6"),
+    "udp": ("/proc/net/udp", "/proc/net/udp6"),
+    "raw": ("/proc/net/raw", "/proc/net/raw6"),
+    "unix": ("/proc/net/unix",),
+}
+
+_tcp_states = {
+    0: "", 1: "ESTABLISHED", 2: "SYN_SENT", 3: "SYN_RECV", 4: "FIN_WAIT1", 5: "FIN_WAIT2", 6: "TIME_WAIT",
+    7: "CLOSE", 8: "CLOSE_WAIT", 9: "LAST_ACK", 10: "LISTEN", 11: "CLOSING",
+}
+
+_udp_states = {
+    1: "ESTABLISHED", 7: "CLOSE",
+}
+
+_unix_types = {
+    1: "STREAM", 2: "DGRAM", 3: "RAW", 4: "RDM", 5: "SEQPACKET",
+}
+
+_unix_states = {
+    0: "FREE", 1: "", 2: "CONNECTING", 3: "CONNECTED", 4: "DISCONNECTING",
+}
+
+_UNIX_FLAG_ACCEPTCON = 1 << 16
+_UNIX_FLAG_WAITDATA = 1 << 17
+_UNIX_FLAG_NOSPACE = 1 << 18
+
+# 多用户设备上uid = user_id * 100000 + app_id
+_PER_USER_RANGE = 100000
+_FIRST_APPLICATION_UID = 10000
+
+_address_cache: Dict[str, Tuple[str, bool]] = {}
+
+
+def _parse_address(hex_address: str) -> Tuple[str, bool]:
+    """
+    /proc/net中的地址按照4字节为一组的小端序保存
+    :return: (地址, 是否为0.0.0.0/::)
+    """
+    result = _address_cache.get(hex_address)
+    if result is None:
+        data = bytes.fromhex(hex_address)
+        data = b"".join(data[i:i + 4][::-1] for i in range(0, len(data), 4))
+        address = ipaddress.ip_address(data)
+        result = _address_cache[hex_address] = (str(address), address.is_unspecified)
+        if len(_address_cache) > 4096:
+            _address_cache.clear()
+    return result
+
+
+def parse_inet_sockets(proto: str, lines: Iterable[str]) -> List[InetSocket]:
+    """
+    解析/proc/net/{tcp,tcp6,udp,udp6,raw,raw6}，和agent中的解析逻辑保持一致
+    :param proto: 协议，如tcp、tcp6
+    :param lines: 文件内容，包含表头
+    :return: socket列表
+    """
+    result = []
+    iterator = iter(lines)
+    next(iterator, None)  # 跳过表头
+    for line in iterator:
+        detail = line.split()
+        if len(detail) < 10:
+            continue
+        try:
+            local_address, local_port = detail[1].split(":")
+            remote_address, remote_port = detail[2].split(":")
+            transmit_queue, receive_queue = detail[4].split(":")
+            local_address, _ = _parse_address(local_address)
+            remote_address, remote_unspecified = _parse_address(remote_address)
+            state = int(detail[3], 16)
+            remote_port = int(remote_port, 16)
+        except ValueError:
+            _logger.debug(f"Invalid {proto} socket: {line}")
+            continue
+        if proto.startswith("tcp"):
+            state, listening = _tcp_states.get(state, "UNKNOWN"), remote_port == 0
+        elif proto.startswith("udp"):
+            state, listening = _udp_states.get(state, "UNKNOWN"), remote_unspecified
+        else:
+            state, listening = str(state), remote_unspecified
+        result.append(InetSocket({
+            "proto": proto,
+            "state": state,
+            "inode": utils.int(detail[9], default=0),
+            "listening": listening,
+            "localAddress": local_address,
+            "localPort": int(local_port, 16),
+            "remoteAddress": remote_address,
+            "remotePort": remote_port,
+            "uid": utils.int(detail[7], default=0),
+            "transmitQueue": int(transmit_queue, 16),
+            "receiveQueue": int(receive_queue, 16),
+        }))
+    return result
+
+
+def parse_unix_sockets(lines: Iterable[str]) -> List[UnixSocket]:
+    """
+    解析/proc/net/unix，在pc端解析时无法判断路径是否可读写，readable和writable始终为False
+    :param lines: 文件内容，包含表头
+    :return: socket列表
+    """
+    result = []
+    iterator = iter(lines)
+    next(iterator, None)  # 跳过表头
+    for line in iterator:
+        detail = line.split(None, 7)
+        if len(detail) < 7:
+            continue
+        try:
+            ref_cnt, protocol, flags, type, state = (int(value, 16) for value in detail[1:6])
+        except ValueError:
+            _logger.debug(f"Invalid unix socket: {line}")
+            continue
+        listening = state == 1 and (flags & _UNIX_FLAG_ACCEPTCON) != 0
+        flag_names = [name for flag, name in ((_UNIX_FLAG_ACCEPTCON, "ACC"),
+                                              (_UNIX_FLAG_WAITDATA, "W"),
+                                              (_UNIX_FLAG_NOSPACE, "N")) if flags & flag]
+        result.append(UnixSocket({
+            "proto": "unix" if protocol == 0 else "??",
+            "state": "LISTENING" if listening else _unix_states.get(state, "UNKNOWN"),
+            "inode": utils.int(detail[6], default=0),
+            "listening": listening,
+            "refCnt": ref_cnt,
+            "flags": "[ " + "".join(f"{name} " for name in flag_names) + "]",
+            "type": _unix_types.get(type, "UNKNOWN"),
+            "path": detail[7].strip() if len(detail) > 7 else "",
+        }))
+    return result
+
+
+class UidPackageMap:
+    """
+    缓存uid到包名的映射，遇到未知的app uid时才重新获取包列表
+    """
+
+    def __init__(self, device: "Device", refresh_interval: float = None):
+        """
+        :param device: 设备
+        :param refresh_interval: 两次刷新包列表的最小间隔
+        """
+        self._device = device
+        self._refresh_interval = refresh_interval or \
+            environ.get_config("ANDROID_UID_MAP_REFRESH_INTERVAL", type=float, default=10)
+        self._packages: Dict[int, List[str]] = {}
+        self._refresh_time = None
+
+    def refresh(self, **kwargs) -> None:
+        packages = {}
+        # 刷新间隔比查询缓存的有效时间短，需要跳过缓存，否则新安装应用的uid要等缓存过期才能解析
+        kwargs.setdefault("refresh", True)
+        for package in self._device.get_packages(simple=True, **kwargs):
+            packages.setdefault(package.user_id, []).append(package.name)
+        self._packages = packages
+        self._refresh_time = time.time()
+
+    def get(self, uid: int) -> List[str]:
+        """
+        获取uid对应的所有包名
+        :param uid: uid
+        :return: 包名列表，系统uid或者找不到时返回空列表
+        """
+        app_id = uid % _PER_USER_RANGE
+        if app_id < _FIRST_APPLICATION_UID:
+            return []
+        names = self._packages.get(app_id)
+        if names is None:
+            if self._refresh_time is None or time.time() - self._refresh_time >= self._refresh_interval:
+                try:
+                    self.refresh()
+                except AdbError as e:
+                    _logger.debug(f"Refresh packages failed: {e}")
+                    self._refresh_time = time.time()
+                names = self._packages.get(app_id)
+        return names or []
+
+
+class SocketChange:
+    """
+    socket变化事件
+    """
+
+    OPEN = "open"
+    CLOSE = "close"
+
+    __slots__ = ("action", "socket", "packages", "time")
+
+    def __init__(self, action: str, socket: "Union[InetSocket, UnixSocket]", packages: List[str], time: float):
+        self.action = action
+        self.socket = socket
+        self.packages = packages
+        self.time = time
+
+    @property
+    def package(self) -> Optional[str]:
+        return self.packages[0] if self.packages else None
+
+    def __repr__(self):
+        socket = self.socket
+        if isinstance(socket, InetSocket):
+            desc = f"{socket.proto} {socket.local_address}:{socket.local_port} " \
+                   f"-> {socket.remote_address}:{socket.remote_port} {socket.state} uid={socket.uid}"
+        else:
+            desc = f"{socket.proto} {socket.type} {socket.path or socket.inode} {socket.state}"
+        return f"SocketChange<{self.action} {desc}, package={self.package}>"
+
+
+class SocketMonitor:
+    """
+    一次adb调用读取所有/proc/net文件，在pc端解析并与上一次结果比较，只输出新建和关闭的连接，
+    比每次都通过agent获取完整的socket列表快很多
+    """
+
+    def __init__(self, device: "Device", protos: Iterable[str] = ("tcp", "udp", "unix"),
+                 privilege: bool = False, include_existing: bool = False, resolve_packages: bool = True):
+        """
+        :param device: 设备
+        :param protos: 需要监控的协议，支持tcp、udp、raw、unix
+        :param privilege: 是否以root权限读取，高版本设备shell用户无法读取/proc/net
+        :param include_existing: 第一次获取时，已存在的连接是否也作为新建连接输出
+        :param resolve_packages: 是否把uid转换成包名
+        """
+        self._device = device
+        self._files: List[Tuple[str, str]] = []
+        for proto in protos:
+            if proto not in _proc_net_files:
+                raise AdbError(f"unsupported socket protocol: {proto}")
+            for path in _proc_net_files[proto]:
+                self._files.append((path.rsplit("/", 1)[-1], path))
+        self._privilege = privilege
+        self._include_existing = include_existing
+        self._uid_map = UidPackageMap(device) if resolve_packages else None
+        self._sockets: Optional[Dict[tuple, Union[InetSocket, UnixSocket]]] = None
+
+    @property
+    def sockets(self) -> List[Union[InetSocket, UnixSocket]]:
+        """
+        上一次获取到的所有socket
+        """
+        return list(self._sockets.values()) if self._sockets else []
+
+    @utils.timeoutable
+    def snapshot(self, timeout: utils.Timeout = None) -> Dict[tuple, Union[InetSocket, UnixSocket]]:
+        """
+        读取并解析当前所有socket，不和上一次结果比较
+        :param timeout: 超时时间
+        :return: 连接标识到socket的映射
+        """
+        results = self._device.shell_batch(
+            [f"cat {path}" for _, path in self._files],
+            privilege=self._privilege, timeout=timeout, ignore_errors=True,
+        )
+        sockets = {}
+        for (proto, path), result in zip(self._files, results):
+            if not result.is_success:
+                # 部分设备没有ipv6相关文件
+                _logger.debug(f"Read {path} failed: {result.err.strip()}")
+                continue
+            lines = result.out.splitlines()
+            if proto == "unix":
+                for socket in parse_unix_sockets(lines):
+                    sockets[(proto, socket.inode)] = socket
+            else:
+                for socket in parse_inet_sockets(proto, lines):
+                    key = (proto, socket.local_address, socket.local_port, socket.remote_address, socket.remote_port)
+                    sockets[key] = socket
+        return sockets
+
+    @utils.timeoutable
+    def poll(self, timeout: utils.Timeout = None) -> List[SocketChange]:
+        """
+        获取和上一次相比新建和关闭的连接
+        :param timeout: 超时时间
+        :return: 变化列表
+        """
+        now = time.time()
+        sockets = self.snapshot(timeout=timeout)
+        last_sockets, self._sockets = self._sockets, sockets
+        if last_sockets is None:
+            if not self._include_existing:
+                return []
+            last_sockets = {}
+
+        changes = []
+        for key, socket in sockets.items():
+            if key not in last_sockets:
+                changes.append(SocketChange(SocketChange.OPEN, socket, self._get_packages(socket), now))
+        for key, socket in last_sockets.items():
+            if key not in sockets:
+                changes.append(SocketChange(SocketChange.CLOSE, socket, self._get_packages(socket), now))
+        return changes
+
+    def watch(self, interval: float = 1) -> Generator[SocketChange, None, None]:
+        """
+        持续获取连接变化
+        :param interval: 获取间隔
+        :return: 变化事件
+        """
+        while True:
+            start = time.time()
+            yield from self.poll()
+            time.sleep(max(interval - (time.time() - start), 0))
+
+    def _get_packages(self, socket: "Union[InetSocket, UnixSocket]") -> List[str]:
+        if self._uid_map is None or not isinstance(socket, InetSocket):
+            return []
+        return self._uid_map.get(socket.uid)
+
+    def __repr__(self):
+        return f"SocketMonitor<{self._device.id}, files={[path for _, path in self._files]}>"
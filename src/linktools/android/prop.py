@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import json
+import os
+import re
+import threading
+import time
+from typing import Optional, Dict, Callable
+
+from .. import utils, environ
+
+_logger = environ.get_logger("android.prop")
+
+_prop_pattern = re.compile(r"^\[([^\]]+)\]: \[(.*?)\]$", re.MULTILINE | re.DOTALL)
+
+
+def parse_props(output: str) -> Dict[str, str]:
+    """
+    解析getprop的全量输出，格式为[name]: [value]，value可能跨行
+    """
+    return {name: value for name, value in _prop_pattern.findall(output.replace("\r\n", "\n"))}
+
+
+def is_readonly_prop(name: str) -> bool:
+    """
+    ro.*属性在设备重启之前都不会变化
+    """
+    return name.startswith("ro.")
+
+
+class PropSnapshot:
+
+    def __init__(self, props: Dict[str, str], time: float, complete: bool = True):
+        """
+        :param props: 属性
+        :param time: 获取时间
+        :param complete: 是否为全量属性，磁盘缓存中只保存了只读属性
+        """
+        self.props = props
+        self.time = time
+        self.complete = complete
+
+    def get(self, name: str, ttl: float) -> Optional[str]:
+        """
+        获取属性值，只读属性不受ttl限制，缓存中没有或已过期返回None
+        """
+        if is_readonly_prop(name):
+            if name in self.props or self.complete:
+                return self.props.get(name, "")
+            return None
+        if self.complete and time.time() - self.time < ttl:
+            return self.props.get(name, "")
+        return None
+
+
+class PropCache:
+    """
+    按设备号缓存getprop的全量结果，同一个进程中的Device对象共享，可选持久化只读属性到磁盘
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshots: Dict[str, PropSnapshot] = {}
+
+    @property
+    def ttl(self) -> float:
+        return environ.get_config("ANDROID_PROP_CACHE_TTL", type=float, default=5)
+
+    @property
+    def disk_enabled(self) -> bool:
+        return environ.get_config("ANDROID_PROP_DISK_CACHE", type=bool, default=False)
+
+    def get(self, serial: str, name: str,
+            fingerprint: Callable[[], str] = None,
+            connection: Callable[[], Optional[str]] = None) -> Optional[str]:
+        """
+        从缓存中获取属性，没有命中返回None
+        :param serial: 设备号
+        :param name: 属性名
+        :param fingerprint: 获取设备当前ro.build.fingerprint的函数，读取磁盘缓存时用来确认还是同一个系统，
+                            设备号可能被复用（如emulator-5554），设备也可能被刷机，为空则不读取磁盘缓存
+        :param connection: 获取当前连接标识（adb server分配的transport_id）的函数，只需要访问本机adb server，
+                           与磁盘缓存中记录的一致说明设备没有断开重连过，可以跳过fingerprint校验
+        """
+        with self._lock:
+            snapshot = self._snapshots.get(serial)
+        if snapshot is None and self.disk_enabled and is_readonly_prop(name) and fingerprint is not None:
+            snapshot = self._load(serial, fingerprint, connection)
+            if snapshot is not None:
+                with self._lock:
+                    snapshot = self._snapshots.setdefault(serial, snapshot)
+        if snapshot is None:
+            return None
+        return snapshot.get(name, self.ttl)
+
+    def put(self, serial: str, props: Dict[str, str], connection: Callable[[], Optional[str]] = None) -> None:
+        """
+        更新设备的全量属性
+        :param serial: 设备号
+        :param props: 全量属性
+        :param connection: 获取当前连接标识的函数，写入磁盘缓存供下次快速校验
+        """
+        with self._lock:
+            self._snapshots[serial] = PropSnapshot(props, time.time())
+        if self.disk_enabled:
+            self._save(serial, props, connection() if connection is not None else None)
+
+    def invalidate(self, serial: str) -> None:
+        """
+        清除设备的属性缓存（只读属性不会变化，磁盘缓存保留）
+        """
+        with self._lock:
+            self._snapshots.pop(serial, None)
+
+    @classmethod
+    def _get_path(cls, serial: str) -> str:
+        return environ.get_data_path("cache", "prop", f"{utils.get_md5(serial)}.json", create_parent=True)
+
+    def _load(self, serial: str,
+              fingerprint: Callable[[], str],
+              connection: Callable[[], Optional[str]] = None) -> Optional[PropSnapshot]:
+        path = self._get_path(serial)
+        if not os.path.exists(path):
+            return None
+        try:
+            data = json.loads(utils.read_file(path, binary=False))
+            if data.get("serial") != serial:
+                return None
+            snapshot = PropSnapshot(data["props"], data["time"], complete=False)
+            current = utils.ignore_error(connection) if connection is not None else None
+            if current and data.get("connection") == current:
+                # 连接没有变化，直接使用磁盘缓存；adb server重启后transport_id会从头分配，
+                # 有极小概率碰上同一个设备号的另一台设备，所以在后台再校验一次fingerprint
+                threading.Thread(
+                    target=self._verify,
+                    args=(serial, data.get("fingerprint"), fingerprint, snapshot),
+                    daemon=True,
+                ).start()
+                return snapshot
+            if data.get("fingerprint") != fingerprint():
+                _logger.debug(f"Fingerprint of {serial} changed, discard prop cache")
+                utils.ignore_error(os.remove, args=(path,))
+                return None
+            if current:
+                data["connection"] = current
+                utils.write_file(path, json.dumps(data))
+            return snapshot
+        except Exception as e:
+            _logger.debug(f"Load prop cache failed: {e}")
+            return None
+
+    def _verify(self, serial: str, expected: str, fingerprint: Callable[[], str], snapshot: PropSnapshot) -> None:
+        try:
+            if fingerprint() == expected:
+                return
+        except Exception as e:
+            _logger.debug(f"Verify prop cache failed: {e}")
+            return
+        _logger.debug(f"Fingerprint of {serial} changed, discard prop cache")
+        utils.ignore_error(os.remove, args=(self._get_path(serial),))
+        with self._lock:
+            if self._snapshots.get(serial) is snapshot:
+                self._snapshots.pop(serial)
+
+    def _save(self, serial: str, props: Dict[str, str], connection: Optional[str] = None) -> None:
+        fingerprint = props.get("ro.build.fingerprint", "")
+        path = self._get_path(serial)
+        try:
+            if os.path.exists(path):
+                data = json.loads(utils.read_file(path, binary=False))
+                if data.get("serial") == serial and data.get("fingerprint") == fingerprint \
+                        and data.get("connection") == connection:
+                    return
+            utils.write_file(path, json.dumps({
+                "serial": serial,
+                "fingerprint": fingerprint,
+                "connection": connection,
+                "time": time.time(),
+                "props": {k: v for k, v in props.items() if is_readonly_prop(k)},
+            }))
+        except Exception as e:
+            _logger.debug(f"Save prop cache failed: {e}")
+
+
+prop_cache = PropCache()
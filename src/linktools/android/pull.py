@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import os
+import posixpath
+import shlex
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Callable, List, Optional
+
+from .adb import AdbError
+from .stream import ExecStream
+from .sync import stat_remote_files, list_remote_files
+from .. import utils, environ
+
+if TYPE_CHECKING:
+    from .adb import Device
+
+_logger = environ.get_logger("android.pull")
+
+# 进度回调：(名称, 总大小, 已传输大小)，与scp的进度回调保持一致
+ProgressCallback = Callable[[str, Optional[int], int], Any]
+
+_buffer_size = 256 * 1024
+
+
+def pull_file(device: "Device", remote_path: str, local_path: str, privilege: bool = False,
+              size: int = None, progress: ProgressCallback = None) -> str:
+    """
+    通过exec-out cat把远程文件直接写到本地，不需要先复制到sdcard
+    :param device: 设备
+    :param remote_path: 远程文件路径
+    :param local_path: 本地文件或目录
+    :param privilege: 是否以root权限读取
+    :param size: 远程文件大小，为空则先获取一次
+    :param progress: 进度回调
+    :return: 本地文件路径
+    """
+    if size is None:
+        info = stat_remote_files(device, [remote_path], privilege=privilege).get(remote_path)
+        if info is None:
+            raise AdbError(f"{remote_path}: No such file or directory")
+        size = info.size
+    if os.path.isdir(local_path):
+        local_path = os.path.join(local_path, posixpath.basename(remote_path))
+
+    # exec-out拿不到返回码，读取失败时通过大小判断
+    temp_path = f"{local_path}.linktools-partial"
+    transferred = 0
+    with ExecStream(device, f"cat {shlex.quote(remote_path)} 2>/dev/null", privilege=privilege) as stream, \
+            open(temp_path, "wb") as fd:
+        buffer = bytearray(_buffer_size)
+        view = memoryview(buffer)
+        while True:
+            length = stream.readinto(buffer)
+            if length <= 0:
+                break
+            fd.write(view[:length])
+            transferred += length
+            if progress is not None:
+                progress(remote_path, size, transferred)
+
+    if transferred != size:
+        utils.ignore_error(os.remove, args=(temp_path,))
+        raise AdbError(f"pull {remote_path} failed: expected {size} bytes, got {transferred}")
+    os.replace(temp_path, local_path)
+    return local_path
+
+
+def pull_tree(device: "Device", remote_dir: str, local_dir: str, privilege: bool = False,
+              progress: ProgressCallback = None) -> List[str]:
+    """
+    通过exec-out tar把远程目录打包后直接在本地解包，只需要一次adb调用
+    :param device: 设备
+    :param remote_dir: 远程目录
+    :param local_dir: 本地目录
+    :param privilege: 是否以root权限读取
+    :param progress: 进度回调
+    :return: 拉取到的本地文件路径
+    """
+    remote_dir = remote_dir.rstrip("/") or "/"
+    total = sum(info.size for info in list_remote_files(device, remote_dir, privilege=privilege).values())
+    os.makedirs(local_dir, exist_ok=True)
+
+    # python3.12开始extract需要指定filter，data filter会去掉属主和危险的权限位
+    kwargs = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+    result, transferred = [], 0
+    command = f"cd {shlex.quote(remote_dir)} && tar cf - . 2>/dev/null"
+    with ExecStream(device, command, privilege=privilege) as stream:
+        try:
+            with tarfile.open(fileobj=stream, mode="r|", bufsize=_buffer_size) as tar:
+                for member in tar:
+                    if not _is_safe_member(member):
+                        _logger.debug(f"Skip {member.name} in {remote_dir}")
+                        continue
+                    tar.extract(member, local_dir, **kwargs)
+                    if member.isfile():
+                        result.append(os.path.join(local_dir, os.path.normpath(member.name)))
+                        transferred += member.size
+                        if progress is not None:
+                            progress(remote_dir, total, transferred)
+        except tarfile.ReadError as e:
+            raise AdbError(f"pull {remote_dir} failed: {e}")
+    return result
+
+
+def _is_safe_member(member: tarfile.TarInfo) -> bool:
+    # 只解包普通文件和目录，忽略链接、设备文件以及路径越界的文件
+    if not (member.isfile() or member.isdir()):
+        return False
+    name = posixpath.normpath(member.name)
+    return not posixpath.isabs(name) and name != ".." and not name.startswith("../")
+
+
+@utils.timeoutable
+def get_apk_paths(device: "Device", package: str, timeout: utils.Timeout = None) -> List[str]:
+    """
+    获取包的所有apk路径，包括split apk
+    :param device: 设备
+    :param package: 包名
+    :param timeout: 超时时间
+    :return: apk路径列表，base.apk在最前面
+    """
+    out = device.shell("pm", "path", package, timeout=timeout)
+    return [line[len("package:"):].strip() for line in out.splitlines() if line.startswith("package:")]
+
+
+def pull_apks(device: "Device", package: str, local_dir: str, privilege: bool = False,
+              max_workers: int = 4, progress: ProgressCallback = None) -> List[str]:
+    """
+    并行拉取包的所有apk
+    :param device: 设备
+    :param package: 包名
+    :param local_dir: 本地目录
+    :param privilege: 是否以root权限读取
+    :param max_workers: 同时拉取的文件数
+    :param progress: 进度回调
+    :return: 本地apk路径
+    """
+    paths = get_apk_paths(device, package)
+    if not paths:
+        raise AdbError(f"{package} not found")
+    infos = stat_remote_files(device, paths, privilege=privilege)
+    missing = [path for path in paths if path not in infos]
+    if missing:
+        raise AdbError(f"{', '.join(missing)}: No such file or directory")
+
+    os.makedirs(local_dir, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=max(min(max_workers, len(paths)), 1)) as executor:
+        futures = [
+            executor.submit(pull_file, device, path, os.path.join(local_dir, posixpath.basename(path)),
+                            privilege=privilege, size=infos[path].size, progress=progress)
+            for path in paths
+        ]
+        return [future.result() for future in futures]
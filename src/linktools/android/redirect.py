@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import threading
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Union
+
+from .adb import AdbError
+from .. import utils, environ
+from ..reactor import Stoppable
+
+if TYPE_CHECKING:
+    from .adb import Device
+
+_logger = environ.get_logger("android.redirect")
+
+# iptables multiport最多支持15个端口
+_MULTIPORT_LIMIT = 15
+
+
+class RedirectRule:
+    """
+    一条重定向规则，多个uid或端口会展开成多条iptables规则
+    """
+
+    __slots__ = ("destination", "proto", "uids", "ports", "exclude_loopback")
+
+    def __init__(self, destination: str, proto: str = "tcp", uids: "Iterable[Union[int, str]]" = None,
+                 ports: Iterable[int] = None, exclude_loopback: bool = True):
+        """
+        :param destination: 重定向的目标地址，如192.168.1.2:8080
+        :param proto: 协议，tcp或udp
+        :param uids: 只重定向这些uid的流量，支持10000-10999这样的范围，为空则重定向所有流量
+        :param ports: 只重定向访问这些目标端口的流量，为空则不限制
+        :param exclude_loopback: 不重定向访问lo网卡的流量
+        """
+        if proto not in ("tcp", "udp"):
+            raise AdbError(f"unsupported redirect protocol: {proto}")
+        self.destination = destination
+        self.proto = proto
+        self.uids = [str(uid) for uid in uids] if uids else []
+        self.ports = [int(port) for port in ports] if ports else []
+        self.exclude_loopback = exclude_loopback
+
+    @classmethod
+    def dns(cls, destination: str, uids: "Iterable[Union[int, str]]" = None) -> "RedirectRule":
+        """
+        把dns查询重定向到指定地址
+        """
+        return cls(destination, proto="udp", uids=uids, ports=[53])
+
+    def to_args(self, chain: str) -> List[List[str]]:
+        """
+        转换成iptables-restore中的规则
+        """
+        result = []
+        port_groups = [self.ports[i:i + _MULTIPORT_LIMIT] for i in range(0, len(self.ports), _MULTIPORT_LIMIT)]
+        for uid in self.uids or [None]:
+            for ports in port_groups or [None]:
+                args = ["-A", chain, "-p", self.proto]
+                if self.exclude_loopback:
+                    args += ["!", "-o", "lo"]
+                if uid is not None:
+                    args += ["-m", "owner", "--uid-owner", uid]
+                if ports:
+                    if len(ports) == 1:
+                        args += ["--dport", str(ports[0])]
+                    else:
+                        args += ["-m", "multiport", "--dports", ",".join(str(port) for port in ports)]
+                args += ["-j", "DNAT", "--to-destination", self.destination]
+                result.append(args)
+        return result
+
+    def __repr__(self):
+        return f"RedirectRule<{self.proto} -> {self.destination}, uids={self.uids}, ports={self.ports}>"
+
+
+class RedirectEngine:
+    """
+    iptables重定向规则管理，只修改自己的链，不会影响nat表中的其他规则：
+    OUTPUT -> LINKTOOLS -> LINKTOOLS_0/LINKTOOLS_1，
+    每次更新规则时先在另一条链中写好，再把LINKTOOLS中唯一的跳转规则指过去，
+    整个过程通过一次iptables-restore --noflush原子完成。
+    同一台设备上的多个重定向共用一个引擎（见RedirectEngine.get），
+    链中写入的是所有重定向规则的合集，移除一个重定向不会影响其他重定向
+    """
+
+    _engines: Dict[str, "RedirectEngine"] = {}
+    _engines_lock = threading.Lock()
+
+    def __init__(self, device: "Device", chain: str = None):
+        """
+        :param device: 设备
+        :param chain: 自定义链名
+        """
+        self._device = device
+        self._chain = chain or environ.get_config("ANDROID_REDIRECT_CHAIN", type=str, default="LINKTOOLS")
+        self._lock = threading.RLock()
+        self._generation: Optional[int] = None
+        self._rules: List[RedirectRule] = []
+        self._owners: Dict[Any, List[RedirectRule]] = {}
+
+    @classmethod
+    def get(cls, device: "Device") -> "RedirectEngine":
+        """
+        同一个进程中同一台设备共用一个RedirectEngine
+        """
+        with cls._engines_lock:
+            engine = cls._engines.get(device.id)
+            if engine is None:
+                engine = cls._engines[device.id] = cls(device)
+            return engine
+
+    @property
+    def chain(self) -> str:
+        return self._chain
+
+    @property
+    def rules(self) -> List[RedirectRule]:
+        return list(self._rules)
+
+    def _get_chain(self, generation: int) -> str:
+        return f"{self._chain}_{generation % 2}"
+
+    def make_restore_script(self, rules: Iterable[RedirectRule], generation: int) -> str:
+        """
+        生成iptables-restore的输入，声明已有的自定义链时会清空该链
+        """
+        chain = self._get_chain(generation)
+        lines = ["*nat", f":{self._chain} - [0:0]", f":{chain} - [0:0]"]
+        for rule in rules:
+            for args in rule.to_args(chain):
+                lines.append(utils.list2cmdline(args))
+        lines.append(f"-A {self._chain} -j {chain}")
+        lines.append("COMMIT")
+        return "\n".join(lines)
+
+    @utils.timeoutable
+    def apply(self, rules: Iterable[RedirectRule], timeout: utils.Timeout = None) -> None:
+        """
+        原子替换所有重定向规则，一次adb调用完成
+        :param rules: 新的规则
+        :param timeout: 超时时间
+        """
+        rules = list(rules)
+        with self._lock:
+            generation = 0 if self._generation is None else self._generation + 1
+            old_chain = self._get_chain(generation + 1)
+            script = self.make_restore_script(rules, generation)
+            commands = [
+                # 第一次使用时创建主链并挂到OUTPUT上，已经存在则跳过
+                f"iptables -t nat -N {self._chain} 2>/dev/null; "
+                f"iptables -t nat -C OUTPUT -j {self._chain} 2>/dev/null || "
+                f"iptables -t nat -I OUTPUT 1 -j {self._chain}",
+                # 替换成功后跳转已经指向新链，旧链可以安全删除
+                f"iptables-restore --noflush <<'__LINKTOOLS_EOF__' && "
+                f"{{ iptables -t nat -F {old_chain} 2>/dev/null; iptables -t nat -X {old_chain} 2>/dev/null; true; }}\n"
+                f"{script}\n"
+                f"__LINKTOOLS_EOF__",
+            ]
+            _logger.debug(f"Apply redirect rules to {self._device.id}: {rules}")
+            results = self._device.shell_batch(commands, privilege=True, ignore_errors=True, timeout=timeout)
+            for result in results:
+                # 没有返回码说明命令没有执行完（超时或者su失败）
+                if result.exit_code != 0:
+                    raise AdbError(f"apply redirect rules failed: {(result.err or result.out).strip() or 'no exit code'}")
+            self._generation = generation
+            self._rules = rules
+
+    @utils.timeoutable
+    def clear(self, timeout: utils.Timeout = None) -> None:
+        """
+        移除自己的链，nat表中的其他规则不受影响
+        :param timeout: 超时时间
+        """
+        with self._lock:
+            chains = [self._chain, self._get_chain(0), self._get_chain(1)]
+            commands = [
+                f"while iptables -t nat -D OUTPUT -j {self._chain} 2>/dev/null; do :; done",
+                *(f"iptables -t nat -F {chain} 2>/dev/null" for chain in chains),
+                *(f"iptables -t nat -X {chain} 2>/dev/null" for chain in chains),
+            ]
+            self._device.shell_batch(commands, privilege=True, ignore_errors=True, timeout=timeout)
+            self._generation = None
+            self._rules = []
+
+    @utils.timeoutable
+    def update(self, owner: Any, rules: Iterable[RedirectRule], timeout: utils.Timeout = None) -> None:
+        """
+        替换owner的规则，并与其他owner的规则一起写入链中
+        :param owner: 规则的所有者，通常是Redirect对象
+        :param rules: owner的新规则
+        :param timeout: 超时时间
+        """
+        with self._lock:
+            owners = dict(self._owners)
+            owners[owner] = list(rules)
+            self.apply([rule for rules in owners.values() for rule in rules], timeout=timeout)
+            self._owners = owners
+
+    @utils.timeoutable
+    def remove(self, owner: Any, timeout: utils.Timeout = None) -> None:
+        """
+        移除owner的规则，其他owner的规则保持不变，没有剩余规则时移除整条链
+        :param owner: 规则的所有者
+        :param timeout: 超时时间
+        """
+        with self._lock:
+            if owner not in self._owners:
+                return
+            owners = dict(self._owners)
+            owners.pop(owner)
+            if owners:
+                self.apply([rule for rules in owners.values() for rule in rules], timeout=timeout)
+            else:
+                self.clear(timeout=timeout)
+            self._owners = owners
+
+    def __repr__(self):
+        return f"RedirectEngine<{self._device.id}, chain={self._chain}>"
+
+
+class Redirect(Stoppable):
+    """
+    Device.redirect返回的重定向对象，可以随时切换需要重定向的uid和端口
+    """
+
+    def __init__(self, engine: RedirectEngine, local_address: str, local_port: int, destination: str,
+                 remote_port: int = None, reverse: Stoppable = None, reserved: bool = False):
+        """
+        :param engine: 设备共用的重定向引擎
+        :param local_address: 本地监听地址
+        :param local_port: 本地监听端口
+        :param destination: 重定向的目标地址
+        :param remote_port: reverse占用的设备端口
+        :param reverse: reverse转发，stop时一起停止
+        :param reserved: local_port是否通过forward_registry.reserve_port预留，stop时释放
+        """
+        self._engine = engine
+        self._destination = destination
+        self._reverse = reverse
+        self._reserved = reserved
+        self.local_address = local_address
+        self.local_port = local_port
+        self.remote_port = remote_port
+
+    @property
+    def engine(self) -> RedirectEngine:
+        return self._engine
+
+    @property
+    def destination(self) -> str:
+        return self._destination
+
+    def make_rules(self, uids: "Iterable[Union[int, str]]" = None, ports: Iterable[int] = None,
+                   udp: bool = False, dns: str = None) -> List[RedirectRule]:
+        rules = []
+        if dns:
+            rules.append(RedirectRule.dns(dns, uids=uids))
+        rules.append(RedirectRule(self._destination, "tcp", uids=uids, ports=ports))
+        if udp:
+            rules.append(RedirectRule(self._destination, "udp", uids=uids, ports=ports))
+        return rules
+
+    @utils.timeoutable
+    def update(self, uids: "Iterable[Union[int, str]]" = None, ports: Iterable[int] = None,
+               udp: bool = False, dns: str = None, timeout: utils.Timeout = None) -> None:
+        """
+        切换需要重定向的流量，只需要一次iptables-restore
+        :param uids: 需要重定向的uid，为空则重定向所有流量
+        :param ports: 需要重定向的目标端口，为空则不限制
+        :param udp: 是否同时重定向udp流量
+        :param dns: dns查询重定向到的地址
+        :param timeout: 超时时间
+        """
+        self._engine.update(self, self.make_rules(uids, ports, udp, dns), timeout=timeout)
+
+    def stop(self):
+        try:
+            self._engine.remove(self)
+        finally:
+            # 如果占用reverse端口，则释放端口
+            if self._reverse is not None:
+                self._reverse.stop()
+                self._reverse = None
+            # 如果预留了本地端口，则释放端口
+            if self._reserved:
+                from .forward import forward_registry
+                forward_registry.release_port(self.local_port)
+                self._reserved = False
+
+    def __repr__(self):
+        return f"Redirect<{self._destination}>"
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import array
+import csv
+import json
+import shlex
+import subprocess
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Set, TextIO, Tuple
+
+from .adb import AdbError
+from .. import utils, environ
+from ..reactor import Stoppable
+
+if TYPE_CHECKING:
+    from .adb import Device
+
+_logger = environ.get_logger("android.sampler")
+
+
+class ProcessSample:
+
+    __slots__ = ("pid", "ppid", "name", "state", "cpu", "rss", "rss_delta", "shared", "threads")
+
+    def __init__(self, pid: int, ppid: int, name: str, state: str, cpu: float,
+                 rss: int, rss_delta: int, shared: int, threads: int):
+        self.pid = pid
+        self.ppid = ppid
+        self.name = name
+        self.state = state
+        self.cpu = cpu
+        self.rss = rss
+        self.rss_delta = rss_delta
+        self.shared = shared
+        self.threads = threads
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"ProcessSample<{self.pid}, {self.name}, cpu={self.cpu:.1f}%, rss={self.rss}KB>"
+
+
+class ProcessSnapshot:
+
+    __slots__ = ("time", "uptime", "cpu_count", "cpu", "processes")
+
+    def __init__(self, time: float, uptime: float, cpu_count: int, cpu: float, processes: List[ProcessSample]):
+        """
+        :param time: 采样时间（本机时间戳）
+        :param uptime: 设备开机时间
+        :param cpu_count: cpu核数
+        :param cpu: 整机cpu占用，100%表示所有核满载
+        :param processes: 进程列表
+        """
+        self.time = time
+        self.uptime = uptime
+        self.cpu_count = cpu_count
+        self.cpu = cpu
+        self.processes = processes
+
+    def top(self, limit: int = None, key: str = "cpu") -> List[ProcessSample]:
+        """
+        按照指定字段排序，返回前limit个进程
+        """
+        processes = sorted(self.processes, key=lambda p: getattr(p, key), reverse=True)
+        return processes[:limit] if limit else processes
+
+    def __repr__(self):
+        return f"ProcessSnapshot<time={self.time:.3f}, cpu={self.cpu:.1f}%, processes={len(self.processes)}>"
+
+
+class _ProcessTable:
+    """
+    按pid分配槽位，上一次采样的数据保存在定长数组中，避免每次采样都创建大量对象
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self._slots: Dict[int, int] = {}
+        self._free: List[int] = []
+        self._start_time = array.array("Q", bytes(8 * capacity))
+        self._cpu_time = array.array("Q", bytes(8 * capacity))
+        self._rss = array.array("q", bytes(8 * capacity))
+
+    def _alloc(self, pid: int) -> int:
+        if self._free:
+            slot = self._free.pop()
+        else:
+            slot = len(self._slots)
+            if slot >= len(self._cpu_time):
+                for values in (self._start_time, self._cpu_time, self._rss):
+                    values.extend(values)
+        self._slots[pid] = slot
+        return slot
+
+    def update(self, pid: int, start_time: int, cpu_time: int, rss: int) -> Tuple[Optional[int], int]:
+        """
+        更新进程数据
+        :return: (cpu时间增量, rss增量)，新进程返回(None, 0)
+        """
+        slot = self._slots.get(pid)
+        if slot is None:
+            slot = self._alloc(pid)
+        elif self._start_time[slot] == start_time:
+            cpu_delta = cpu_time - self._cpu_time[slot]
+            rss_delta = rss - self._rss[slot]
+            self._cpu_time[slot], self._rss[slot] = cpu_time, rss
+            return cpu_delta, rss_delta
+        # pid被复用了，当成新进程处理
+        self._start_time[slot], self._cpu_time[slot], self._rss[slot] = start_time, cpu_time, rss
+        return None, 0
+
+    def retain(self, pids: Set[int]) -> None:
+        for pid in [pid for pid in self._slots if pid not in pids]:
+            self._free.append(self._slots.pop(pid))
+
+
+class ProcessSampler(Stoppable):
+    """
+    在一个常驻的adb shell中定时读取/proc/stat、/proc/*/stat和/proc/*/statm，
+    在本机计算每个进程的cpu占用和内存变化，每次采样完成后回调
+    """
+
+    def __init__(self, device: "Device", interval: float = 1, privilege: bool = False,
+                 callback: Callable[[ProcessSnapshot], Any] = None):
+        """
+        :param device: 设备
+        :param interval: 采样间隔
+        :param privilege: 是否以root权限读取，部分设备上shell用户看不到其他用户的进程
+        :param callback: 采样回调，在采样线程中执行
+        """
+        self._device = device
+        self._interval = interval
+        self._privilege = privilege
+        self._callbacks: List[Callable[[ProcessSnapshot], Any]] = []
+        self._mark = f"__linktools_{utils.make_uuid()}__"
+        self._process: Optional[subprocess.Popen] = None
+        self._thread: Optional[threading.Thread] = None
+        self._table = _ProcessTable()
+        self._page_size = 4
+        self._last_total: Optional[int] = None
+        self._last_snapshot: Optional[ProcessSnapshot] = None
+        self._cond = threading.Condition()
+        if callback is not None:
+            self.add_callback(callback)
+
+    @property
+    def is_running(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    @property
+    def last_snapshot(self) -> Optional[ProcessSnapshot]:
+        return self._last_snapshot
+
+    def add_callback(self, fn: Callable[[ProcessSnapshot], Any]) -> None:
+        self._callbacks.append(fn)
+
+    def _make_script(self) -> str:
+        mark = self._mark
+        return (
+            f"echo {mark} page $(getconf PAGESIZE 2>/dev/null || echo 4096); "
+            f"while true; do "
+            f"echo {mark} begin $(cat /proc/uptime); "
+            f"grep '^cpu' /proc/stat; "
+            f"echo {mark} stat; "
+            f"cat /proc/[0-9]*/stat 2>/dev/null; "
+            f"echo; echo {mark} statm; "
+            f"grep -H '' /proc/[0-9]*/statm 2>/dev/null; "
+            f"echo {mark} end; "
+            f"sleep {self._interval}; "
+            f"done"
+        )
+
+    def start(self) -> "ProcessSampler":
+        if self.is_running:
+            return self
+        # 脚本原样交给设备上的shell执行，不能经过list2cmdline转义
+        script = self._make_script()
+        if self._privilege and self._device.uid != 0:
+            script = f"su -c {shlex.quote(script)}"
+        self._process = self._device.popen(
+            "shell", script,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self._thread = threading.Thread(target=self._read_loop, args=(self._process,), name="process-sampler")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        process, self._process = self._process, None
+        if process is not None:
+            utils.ignore_error(process.kill)
+            utils.ignore_error(process.wait, args=(1,))
+
+    @utils.timeoutable
+    def wait_snapshot(self, timeout: utils.Timeout = None) -> Optional[ProcessSnapshot]:
+        """
+        等待下一次采样结果
+        """
+        with self._cond:
+            snapshot = self._last_snapshot
+            self._cond.wait_for(lambda: self._last_snapshot is not snapshot or not self.is_running, timeout.remain)
+            return self._last_snapshot if self._last_snapshot is not snapshot else None
+
+    def _read_loop(self, process: subprocess.Popen) -> None:
+        section, uptime, cpu_lines, stat_lines, statm_lines = None, 0.0, [], [], []
+        prefix = self._mark + " "
+        try:
+            for line in iter(process.stdout.readline, b""):
+                line = line.decode(errors="ignore").rstrip("\r\n")
+                if line.startswith(prefix):
+                    splits = line[len(prefix):].split()
+                    section = splits[0] if splits else None
+                    if section == "page":
+                        self._page_size = max(utils.int(splits[1], default=4096) // 1024, 1)
+                    elif section == "begin":
+                        uptime = utils.cast(float, splits[1], default=0.0) if len(splits) > 1 else 0.0
+                        cpu_lines, stat_lines, statm_lines = [], [], []
+                    elif section == "end":
+                        self._on_sample(uptime, cpu_lines, stat_lines, statm_lines)
+                elif section == "begin":
+                    cpu_lines.append(line)
+                elif section == "stat":
+                    stat_lines.append(line)
+                elif section == "statm":
+                    statm_lines.append(line)
+        except (OSError, ValueError) as e:
+            _logger.debug(f"Process sampler read error: {e}")
+        finally:
+            with self._cond:
+                self._cond.notify_all()
+
+    def _on_sample(self, uptime: float, cpu_lines: List[str], stat_lines: List[str], statm_lines: List[str]):
+        total, cpu_count = 0, 0
+        for line in cpu_lines:
+            splits = line.split()
+            if splits and splits[0] == "cpu":
+                total = sum(utils.int(value, default=0) for value in splits[1:8])
+            elif splits and splits[0].startswith("cpu"):
+                cpu_count += 1
+        cpu_count = max(cpu_count, 1)
+        total_delta = total - self._last_total if self._last_total is not None else 0
+        self._last_total = total
+
+        memory = {}
+        for line in statm_lines:
+            # /proc/123/statm:size resident shared text lib data dt
+            path, _, values = line.partition(":")
+            pid = utils.int(path[6:-6], default=None)
+            values = values.split()
+            if pid is not None and len(values) >= 3:
+                memory[pid] = (utils.int(values[1], default=0), utils.int(values[2], default=0))
+
+        processes = []
+        pids = set()
+        for line in stat_lines:
+            sample = self._parse_stat(line, memory, total_delta, cpu_count)
+            if sample is not None:
+                pids.add(sample.pid)
+                processes.append(sample)
+        self._table.retain(pids)
+
+        busy = sum(p.cpu for p in processes) / cpu_count
+        snapshot = ProcessSnapshot(time.time(), uptime, cpu_count, min(busy, 100.0), processes)
+        with self._cond:
+            self._last_snapshot = snapshot
+            self._cond.notify_all()
+        for callback in self._callbacks:
+            try:
+                callback(snapshot)
+            except Exception as e:
+                _logger.warning(f"Process sampler callback error: {e}")
+
+    def _parse_stat(self, line: str, memory: Dict[int, Tuple[int, int]], total_delta: int,
+                    cpu_count: int) -> Optional[ProcessSample]:
+        # 进程名可能包含空格和括号，以最后一个右括号为界
+        begin, end = line.find("("), line.rfind(")")
+        if begin < 0 or end < 0:
+            return None
+        pid = utils.int(line[:begin].strip(), default=None)
+        fields = line[end + 2:].split()
+        if pid is None or len(fields) < 22:
+            return None
+        name = line[begin + 1:end]
+        cpu_time = utils.int(fields[11], default=0) + utils.int(fields[12], default=0)
+        start_time = utils.int(fields[19], default=0)
+        rss_pages, shared_pages = memory.get(pid, (utils.int(fields[21], default=0), 0))
+        rss = rss_pages * self._page_size
+        cpu_delta, rss_delta = self._table.update(pid, start_time, cpu_time, rss)
+        # 与top一致，单核满载为100%
+        cpu = cpu_delta * 100.0 * cpu_count / total_delta if cpu_delta is not None and total_delta > 0 else 0.0
+        return ProcessSample(
+            pid=pid,
+            ppid=utils.int(fields[1], default=0),
+            name=name,
+            state=fields[0],
+            cpu=round(cpu, 2),
+            rss=rss,
+            rss_delta=rss_delta,
+            shared=shared_pages * self._page_size,
+            threads=utils.int(fields[17], default=0),
+        )
+
+    def __repr__(self):
+        return f"ProcessSampler<{self._device.id}, interval={self._interval}>"
+
+
+class SnapshotWriter:
+    """
+    把采样结果保存为时间序列，每个进程一行，支持csv和ndjson
+    """
+
+    fields = ("time", "pid", "ppid", "name", "state", "cpu", "rss", "rss_delta", "shared", "threads")
+
+    def __init__(self, file: TextIO, format: str = "csv"):
+        """
+        :param file: 输出文件
+        :param format: csv或ndjson
+        """
+        if format not in ("csv", "ndjson"):
+            raise AdbError(f"unsupported format: {format}")
+        self._file = file
+        self._format = format
+        self._writer = None
+        if format == "csv":
+            self._writer = csv.writer(file)
+            self._writer.writerow(self.fields)
+
+    def __call__(self, snapshot: ProcessSnapshot) -> None:
+        for process in snapshot.processes:
+            if self._format == "csv":
+                self._writer.writerow([round(snapshot.time, 3), *(getattr(process, f) for f in self.fields[1:])])
+            else:
+                self._file.write(json.dumps({"time": round(snapshot.time, 3), **process.to_dict()}) + "\n")
+        self._file.flush()
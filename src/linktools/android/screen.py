@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import struct
+import threading
+import time
+from typing import TYPE_CHECKING, Any, BinaryIO, Callable, Generator, Optional, Union
+
+from .adb import AdbError
+from .stream import ExecStream
+from .. import utils, environ
+from ..reactor import Stoppable
+
+if TYPE_CHECKING:
+    from .adb import Device
+
+_logger = environ.get_logger("android.screen")
+
+# screencap原始输出的像素格式，见android.graphics.PixelFormat
+_bytes_per_pixel = {
+    1: 4,  # RGBA_8888
+    2: 4,  # RGBX_8888
+    3: 3,  # RGB_888
+    4: 2,  # RGB_565
+}
+
+_png_signature = b"\x89PNG\r\n\x1a\n"
+# png最后一定是长度为0的IEND块
+_png_end = b"\x00\x00\x00\x00IEND\xae\x42\x60\x82"
+
+
+class ScreenFrame:
+    """
+    screencap输出的一帧原始图像
+    """
+
+    __slots__ = ("width", "height", "format", "data", "time")
+
+    def __init__(self, width: int, height: int, format: int, data: bytearray, time: float):
+        self.width = width
+        self.height = height
+        self.format = format
+        self.data = data
+        self.time = time
+
+    @property
+    def bytes_per_pixel(self) -> int:
+        return _bytes_per_pixel.get(self.format, 4)
+
+    def __repr__(self):
+        return f"ScreenFrame<{self.width}x{self.height}, format={self.format}>"
+
+
+def _get_header_size(device: "Device") -> int:
+    # android 9开始，screencap在宽、高、格式之后多输出了4字节的dataspace
+    sdk = utils.int(device.get_prop("ro.build.version.sdk"), default=0)
+    return 16 if sdk >= 28 else 12
+
+
+@utils.timeoutable
+def screencap(device: "Device", png: bool = True, timeout: utils.Timeout = None) -> bytes:
+    """
+    截图，直接通过exec-out读取screencap输出，不需要在设备上保存文件
+    :param device: 设备
+    :param png: 输出png格式，否则输出原始数据
+    :param timeout: 超时时间
+    :return: 图片内容
+    """
+    out = None
+    client = device.adb.client
+    if client is not None:
+        from .client import AdbConnectionError
+        try:
+            out = client.exec_out(device.id, "screencap -p" if png else "screencap", timeout=timeout)
+        except AdbConnectionError as e:
+            _logger.debug(f"Fallback to adb command: {e}")
+            device.adb.mark_unavailable()
+
+    if out is None:
+        # 没有native客户端时通过adb exec-out读取，超时后直接关闭输出流
+        with ExecStream(device, "screencap -p" if png else "screencap") as stream:
+            timer = None
+            if timeout.remain is not None:
+                timer = threading.Timer(timeout.remain, stream.close)
+                timer.daemon = True
+                timer.start()
+            try:
+                out = stream.read_all()
+            finally:
+                if timer is not None:
+                    timer.cancel()
+
+    if not out:
+        raise AdbError("screencap returned nothing")
+    # 超时后读到的是不完整的内容，不能当成截图返回
+    if png:
+        if not out.startswith(_png_signature) or not out.endswith(_png_end):
+            raise AdbError(f"screencap output incomplete: {len(out)} bytes")
+    else:
+        header_size = _get_header_size(device)
+        if len(out) < header_size:
+            raise AdbError(f"screencap output incomplete: {len(out)} bytes")
+        width, height, format = struct.unpack_from("<III", out)
+        size = header_size + width * height * _bytes_per_pixel.get(format, 4)
+        if len(out) < size:
+            raise AdbError(f"screencap output incomplete: {len(out)}/{size} bytes")
+    return out
+
+
+def iter_frames(device: "Device", fps: float = None) -> Generator[ScreenFrame, None, None]:
+    """
+    持续获取原始帧，设备上循环执行screencap，所有帧都通过同一个exec-out连接返回，
+    每帧的数据直接读取到新分配的缓冲区中，不会再做拷贝
+    :param device: 设备
+    :param fps: 帧率上限，为空则尽可能快
+    :return: 帧生成器，关闭生成器时结束截图
+    """
+    header_size = _get_header_size(device)
+    delay = f"sleep {1 / fps:.3f}; " if fps else ""
+    header = bytearray(header_size)
+    with ExecStream(device, f"while true; do screencap; {delay}done") as stream:
+        while True:
+            try:
+                stream.read_exactly(header)
+            except EOFError:
+                return
+            width, height, format = struct.unpack_from("<III", header)
+            if format not in _bytes_per_pixel:
+                raise AdbError(f"unsupported pixel format: {format}")
+            data = bytearray(width * height * _bytes_per_pixel[format])
+            stream.read_exactly(data)
+            yield ScreenFrame(width, height, format, data, time.time())
+
+
+class ScreenRecorder(Stoppable):
+    """
+    通过screenrecord --output-format=h264把h264裸流直接写到本地文件或者回调中
+    """
+
+    def __init__(self, device: "Device", output: "Union[str, BinaryIO, Callable[[bytes], Any]]",
+                 bit_rate: int = None, size: str = None, time_limit: int = None):
+        """
+        :param device: 设备
+        :param output: 本地文件路径、可写的文件对象，或者接收数据块的回调
+        :param bit_rate: 码率，如4000000
+        :param size: 分辨率，如1280x720
+        :param time_limit: 最长录制时间（秒），不填则使用screenrecord默认值
+        """
+        self._device = device
+        self._output = output
+        self._args = ["screenrecord", "--output-format=h264"]
+        if bit_rate:
+            self._args.append(f"--bit-rate={int(bit_rate)}")
+        if size:
+            self._args.append(f"--size={size}")
+        if time_limit:
+            self._args.append(f"--time-limit={int(time_limit)}")
+        self._args.append("-")
+        self._stream: Optional[ExecStream] = None
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[Exception] = None
+        self._bytes = 0
+
+    @property
+    def bytes_written(self) -> int:
+        return self._bytes
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> "ScreenRecorder":
+        if self._thread is not None:
+            raise AdbError(f"{self} is already started")
+        self._stream = ExecStream(self._device, " ".join(self._args))
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self) -> None:
+        output, close_file = self._output, False
+        if isinstance(output, str):
+            output, close_file = open(output, "wb"), True
+        # 写文件时直接写缓冲区切片，回调需要自己持有数据，只能拷贝一次
+        write, copy = (output, True) if callable(output) else (output.write, False)
+
+        buffer = bytearray(256 * 1024)
+        view = memoryview(buffer)
+        try:
+            while True:
+                size = self._stream.readinto(buffer)
+                if size <= 0:
+                    break
+                write(bytes(view[:size]) if copy else view[:size])
+                self._bytes += size
+        except Exception as e:
+            _logger.debug(f"{self} failed: {e}")
+            self._error = e
+        finally:
+            self._stream.close()
+            if close_file:
+                output.close()
+
+    @utils.timeoutable
+    def wait(self, timeout: utils.Timeout = None) -> bool:
+        """
+        等待录制结束（达到最长录制时间或者被stop）
+        :param timeout: 超时时间
+        :return: 是否已经结束
+        """
+        if self._thread is not None:
+            self._thread.join(timeout.remain)
+            if self._thread.is_alive():
+                return False
+        if self._error is not None:
+            raise AdbError(f"screen record failed: {self._error}")
+        return True
+
+    def stop(self) -> None:
+        if self._stream is not None:
+            self._stream.close()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def __repr__(self):
+        return f"ScreenRecorder<{self._device.id}>"
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import atexit
+import contextlib
+import itertools
+import os
+import re
+import subprocess
+import threading
+import time
+from typing import TYPE_CHECKING, Optional, Any, Dict, List, Tuple, Generator
+
+from .adb import AdbError
+from .struct import ShellResult
+from .. import utils, environ
+from ..reactor import Stoppable
+
+if TYPE_CHECKING:
+    from .adb import Device
+
+_logger = environ.get_logger("android.session")
+
+
+class ShellSessionError(AdbError):
+    """
+    shell会话不可用（设备不支持、su失败、会话意外退出），命令还没有发送，调用方可以回退到普通的shell调用
+    """
+    pass
+
+
+class ShellSessionLostError(AdbError):
+    """
+    命令发送之后会话意外退出，命令可能已经执行，调用方不能再重试
+    """
+    pass
+
+
+class ShellSession(Stoppable):
+    """
+    常驻的adb shell（或su shell）进程，命令通过stdin写入，执行结果通过分隔标记从stdout/stderr中切分出来
+    """
+
+    def __init__(self, device: "Device", privilege: bool = False, user: str = None):
+        """
+        :param device: 设备
+        :param privilege: 是否以root权限运行
+        :param user: 以指定user运行
+        """
+        self._device = device
+        self._privilege = privilege
+        self._user = user
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._process: Optional[subprocess.Popen] = None
+        self._out = bytearray()
+        self._err = bytearray()
+        self._eof = False
+        self._ids = itertools.count(1)
+        self._mark = f"__linktools_{utils.make_uuid()}__"
+        self.last_used = time.time()
+
+    @property
+    def is_alive(self) -> bool:
+        return self._process is not None and self._process.poll() is None and not self._eof
+
+    @utils.timeoutable
+    def start(self, timeout: utils.Timeout = None) -> None:
+        """
+        启动shell进程，需要root时在shell中切换到su
+        """
+        # -T禁用pty，否则stdin会被回显，stdout和stderr也会混在一起
+        self._process = self._device.popen(
+            "shell", "-T",
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        for io, buffer in ((self._process.stdout, self._out), (self._process.stderr, self._err)):
+            thread = threading.Thread(target=self._read_loop, args=(io, buffer))
+            thread.daemon = True
+            thread.start()
+
+        try:
+            if self._privilege or self._user:
+                uid = self.run("id", "-u", timeout=timeout).out.strip()
+                if self._privilege and uid != "0":
+                    self._write("su\n")
+                elif self._user:
+                    self._write(f"su {self._user}\n")
+                # su可能需要用户授权，这里确认一下是否切换成功
+                uid = self.run("id", "-u", timeout=timeout).out.strip()
+                if self._privilege and uid != "0":
+                    raise ShellSessionError(f"su failed, uid: {uid}")
+            else:
+                result = self.run("echo", "-n", "1", timeout=timeout)
+                if result.out != "1":
+                    raise ShellSessionError(f"shell session not ready: {result.err.strip()}")
+        except:
+            self.stop()
+            raise
+
+    def _read_loop(self, io, buffer: bytearray) -> None:
+        try:
+            while True:
+                data = os.read(io.fileno(), 64 * 1024)
+                if not data:
+                    break
+                with self._cond:
+                    buffer.extend(data)
+                    self._cond.notify_all()
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self._cond:
+                self._eof = True
+                self._cond.notify_all()
+
+    def _write(self, data: str) -> None:
+        try:
+            self._process.stdin.write(data.encode())
+            self._process.stdin.flush()
+        except (OSError, ValueError) as e:
+            raise ShellSessionError(f"shell session closed: {e}")
+
+    @utils.timeoutable
+    def run(self, *args: [Any], timeout: utils.Timeout = None) -> ShellResult:
+        """
+        在会话中执行命令
+        :param args: shell命令
+        :param timeout: 超时时间，超时后会话会被关闭，返回已读取的内容，
+                        为空则使用ANDROID_SHELL_SESSION_TIMEOUT配置（默认300秒）
+        :return: 执行结果
+        """
+        command = utils.list2cmdline([str(arg) for arg in args])
+        if timeout.remain is None:
+            # 命令不完整（如引号不匹配）时shell会一直等待后续输入，不能无限等下去
+            timeout = utils.Timeout(environ.get_config("ANDROID_SHELL_SESSION_TIMEOUT", type=float, default=300))
+        with self._lock:
+            if not self.is_alive:
+                raise ShellSessionError("shell session closed")
+
+            id = next(self._ids)
+            out_pattern = re.compile(rb"\n%s:%d:(\d+)\n" % (self._mark.encode(), id))
+            err_pattern = re.compile(rb"\n%s:%d:e\n" % (self._mark.encode(), id))
+            with self._cond:
+                self._out.clear()
+                self._err.clear()
+
+            # 在子shell中执行，cd、export等不会影响之后的命令，行为与单独的adb shell一致；
+            # stdin需要留给会话本身，所以命令的stdin重定向到/dev/null
+            self._write(
+                f"( {command}\n) </dev/null\n"
+                f"__rc=$?; echo; echo {self._mark}:{id}:$__rc; echo >&2; echo {self._mark}:{id}:e >&2\n"
+            )
+
+            with self._cond:
+                while True:
+                    out_match = out_pattern.search(self._out)
+                    err_match = err_pattern.search(self._err)
+                    if out_match and err_match:
+                        break
+                    if self._eof:
+                        received = bool(self._out or self._err)
+                        self.stop()
+                        if not received:
+                            raise ShellSessionLostError(f"shell session closed while running: {command}")
+                        break
+                    if not self._cond.wait(timeout.remain):
+                        # 会话状态已经不可控了，直接关掉，下次重新创建
+                        _logger.debug(f"Shell session command timeout: {command}")
+                        self.stop()
+                        break
+
+                out = bytes(self._out[:out_match.start()] if out_match else self._out)
+                err = bytes(self._err[:err_match.start()] if err_match else self._err)
+                exit_code = int(out_match.group(1)) if out_match else None
+                self._out.clear()
+                self._err.clear()
+
+            self.last_used = time.time()
+            return ShellResult(command, out.decode(errors="ignore"), err.decode(errors="ignore"), exit_code)
+
+    @utils.timeoutable
+    def shell(self, *args: [Any], timeout: utils.Timeout = None,
+              ignore_errors: bool = False, log_output: bool = False) -> str:
+        """
+        在会话中执行命令，行为与Device.shell一致
+        :param args: shell命令
+        :param timeout: 超时时间
+        :param ignore_errors: 忽略错误，报错不会抛异常
+        :param log_output: 把输出打印到logger中
+        :return: 输出结果
+        """
+        result = self.run(*args, timeout=timeout)
+        if log_output:
+            for line in result.out.splitlines():
+                if line.rstrip():
+                    _logger.info(line.rstrip())
+            for line in result.err.splitlines():
+                if line.rstrip():
+                    _logger.error(line.rstrip())
+        if not ignore_errors and result.exit_code not in (0, None):
+            err = result.err.strip()
+            if err:
+                raise AdbError(err)
+        return result.out.strip()
+
+    def stop(self) -> None:
+        process, self._process = self._process, None
+        if process is not None:
+            utils.ignore_error(process.stdin.close)
+            utils.ignore_error(process.kill)
+            utils.ignore_error(process.wait, args=(1,))
+
+    def __repr__(self):
+        return f"ShellSession<{self._device.id}, privilege={self._privilege}, user={self._user}>"
+
+
+class ShellSessionPool:
+    """
+    同一台设备、同一个用户的shell会话池，空闲会话超时后自动关闭
+    """
+
+    def __init__(self, device: "Device", privilege: bool = False, user: str = None,
+                 max_idle: int = 2, idle_timeout: float = 60):
+        """
+        :param device: 设备
+        :param privilege: 是否以root权限运行
+        :param user: 以指定user运行
+        :param max_idle: 最多保留几个空闲会话
+        :param idle_timeout: 空闲会话多久后关闭
+        """
+        self._device = device
+        self._privilege = privilege
+        self._user = user
+        self._max_idle = max_idle
+        self._idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._idle: List[ShellSession] = []
+        self._supported: Optional[bool] = None
+
+    @property
+    def is_supported(self) -> bool:
+        """
+        会话依赖shell_v2（禁用pty且stdout/stderr分离），老设备不支持
+        """
+        if self._supported is None:
+            self._supported = "shell_v2" in self._device.features
+        return self._supported
+
+    @utils.timeoutable
+    def acquire(self, timeout: utils.Timeout = None) -> ShellSession:
+        if not self.is_supported:
+            raise ShellSessionError(f"device {self._device.id} does not support shell_v2")
+        with self._lock:
+            while self._idle:
+                session = self._idle.pop()
+                if session.is_alive:
+                    return session
+                session.stop()
+        _logger.debug(f"Start shell session: {self._device.id}, privilege={self._privilege}, user={self._user}")
+        session = ShellSession(self._device, privilege=self._privilege, user=self._user)
+        session.start(timeout=timeout)
+        return session
+
+    def release(self, session: ShellSession) -> None:
+        if session.is_alive:
+            with self._lock:
+                if len(self._idle) < self._max_idle:
+                    self._idle.append(session)
+                    return
+        session.stop()
+
+    def prune(self) -> None:
+        """
+        关闭超时的空闲会话
+        """
+        now = time.time()
+        with self._lock:
+            expired = [s for s in self._idle if not s.is_alive or now - s.last_used > self._idle_timeout]
+            self._idle = [s for s in self._idle if s not in expired]
+        for session in expired:
+            session.stop()
+
+    def close(self) -> None:
+        with self._lock:
+            sessions, self._idle = self._idle, []
+        for session in sessions:
+            session.stop()
+
+
+_pools: Dict[Tuple, ShellSessionPool] = {}
+_pools_lock = threading.Lock()
+_pruner: Optional[threading.Thread] = None
+
+
+def _prune_loop():
+    while True:
+        time.sleep(5)
+        with _pools_lock:
+            pools = list(_pools.values())
+        for pool in pools:
+            pool.prune()
+
+
+def _close_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close()
+
+
+def get_pool(device: "Device", privilege: bool = False, user: str = None) -> ShellSessionPool:
+    """
+    获取设备对应的会话池，同一台设备的不同Device对象共用一个会话池
+    """
+    global _pruner
+    key = (tuple(str(option) for option in device.adb.options), device.id, privilege, user)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ShellSessionPool(
+                device, privilege=privilege, user=user,
+                idle_timeout=environ.get_config("ANDROID_SHELL_SESSION_IDLE_TIMEOUT", type=float, default=60),
+            )
+        if _pruner is None:
+            _pruner = threading.Thread(target=_prune_loop, name="shell-session-pruner")
+            _pruner.daemon = True
+            _pruner.start()
+            atexit.register(_close_pools)
+    return pool
+
+
+@contextlib.contextmanager
+def open_session(device: "Device", privilege: bool = False, user: str = None,
+                 timeout: utils.Timeout = None) -> Generator[ShellSession, None, None]:
+    pool = get_pool(device, privilege=privilege, user=user)
+    session = pool.acquire(timeout=timeout)
+    try:
+        yield session
+    finally:
+        pool.release(session)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import shlex
+import socket
+import subprocess
+from typing import TYPE_CHECKING, Optional, Union
+
+from .. import utils, environ
+
+if TYPE_CHECKING:
+    from .adb import Device
+    from .client import AdbConnection
+
+_logger = environ.get_logger("android.stream")
+
+
+class ExecStream:
+    """
+    exec-out命令的原始输出流，数据直接从adb连接读取，不经过设备上的临时文件；
+    有native客户端时通过exec:服务读取，否则通过adb exec-out子进程读取
+    """
+
+    def __init__(self, device: "Device", command: str, privilege: bool = False):
+        """
+        :param device: 设备
+        :param command: 在设备上执行的命令，原样交给设备shell执行
+        :param privilege: 是否以root权限执行
+        """
+        if privilege and device.uid != 0:
+            command = f"su -c {shlex.quote(command)}"
+        self._device = device
+        self._command = command
+        self._connection: "Optional[AdbConnection]" = None
+        self._process: "Optional[utils.Popen]" = None
+        self._closed = False
+
+        client = device.adb.client
+        if client is not None:
+            from .client import AdbConnectionError
+            try:
+                self._connection = client.open(device.id, f"exec:{command}", timeout=client.connect_timeout)
+                self._connection.settimeout(None)
+                return
+            except AdbConnectionError as e:
+                _logger.debug(f"Fallback to adb command: {e}")
+                device.adb.mark_unavailable()
+
+        self._process = device.popen(
+            "exec-out", command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    @property
+    def command(self) -> str:
+        return self._command
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def readinto(self, buffer: Union[bytearray, memoryview]) -> int:
+        """
+        读取数据到buffer中，避免额外的拷贝
+        :param buffer: 可写的缓冲区
+        :return: 读取的字节数，0表示已经结束
+        """
+        if self._closed:
+            return 0
+        try:
+            if self._connection is not None:
+                return self._connection.socket.recv_into(buffer)
+            return self._process.stdout.readinto1(buffer)
+        except (OSError, ValueError):
+            # 其他线程调用close后，读取会抛出异常
+            if self._closed:
+                return 0
+            raise
+
+    def read(self, size: int = 65536) -> bytes:
+        buffer = bytearray(size)
+        return bytes(buffer[:self.readinto(buffer)])
+
+    def read_exactly(self, buffer: Union[bytearray, memoryview]) -> None:
+        """
+        填满buffer，数据不够时抛出EOFError
+        """
+        view = memoryview(buffer).cast("B")
+        offset = 0
+        while offset < len(view):
+            size = self.readinto(view[offset:])
+            if size <= 0:
+                raise EOFError(f"stream closed, expected {len(view)} bytes, got {offset}")
+            offset += size
+
+    def read_all(self) -> bytes:
+        buffer = bytearray()
+        chunk = bytearray(65536)
+        while True:
+            size = self.readinto(chunk)
+            if size <= 0:
+                break
+            buffer += memoryview(chunk)[:size]
+        return bytes(buffer)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self._connection is not None:
+            # 先shutdown，让其他线程中阻塞的recv返回
+            utils.ignore_error(self._connection.socket.shutdown, args=(socket.SHUT_RDWR,))
+            self._connection.close()
+        if self._process is not None:
+            utils.ignore_error(self._process.kill)
+            utils.ignore_error(self._process.stdout.close)
+            utils.ignore_error(self._process.wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        return f"ExecStream<{self._device.id}, {self._command}>"
+
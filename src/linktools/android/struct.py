@@ -26,13 +26,42 @@
   / ==ooooooooooooooo==.o.  ooo= //   ,`\--{)B     ,"
  /_==__==========__==_ooo__ooo=_/'   /___________,"
 """
-from typing import Optional
+from typing import Optional, Type, Any
 
 from .. import utils
 
 
+class _LazyList:
+    """
+    第一次访问时才把原始列表解析成对象，解析结果保存在"_"开头的同名slot中
+    """
+
+    def __init__(self, key: str, type: Type):
+        self.key = key
+        self.type = type
+        self.slot = None
+
+    def __set_name__(self, owner, name):
+        self.slot = f"_{name}"
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        try:
+            return getattr(instance, self.slot)
+        except AttributeError:
+            value = utils.get_list_item(instance._obj, self.key, type=self.type, default=[])
+            setattr(instance, self.slot, value)
+            return value
+
+    def __set__(self, instance, value: Any):
+        setattr(instance, self.slot, value)
+
+
 class PatternMatcher:
 
+    __slots__ = ("path", "type")
+
     def __init__(self, obj: dict):
         self.path = utils.get_item(obj, "path", type=str, default="")
         self.type = utils.get_item(obj, "type", type=str, default="literal")
@@ -43,6 +72,8 @@ class PatternMatcher:
 
 class PathPermission(PatternMatcher):
 
+    __slots__ = ("read_permission", "write_permission")
+
     def __init__(self, obj: dict):
         super().__init__(obj)
         self.read_permission = utils.get_item(obj, "readPermission", type=Permission, default=Permission.default())
@@ -54,6 +85,8 @@ class PathPermission(PatternMatcher):
 
 class AuthorityEntry:
 
+    __slots__ = ("host", "port")
+
     def __init__(self, obj: dict):
         self.host = utils.get_item(obj, "host", type=str, default="")
         self.port = utils.get_item(obj, "port", type=int, default=0)
@@ -64,6 +97,9 @@ class AuthorityEntry:
 
 class IntentFilter:
 
+    __slots__ = ("actions", "categories", "data_schemes", "data_scheme_specific_parts",
+                 "data_authorities", "data_paths", "data_types")
+
     def __init__(self, obj: dict):
         self.actions = utils.get_list_item(obj, "actions", type=str, default=[])
         self.categories = utils.get_list_item(obj, "categories", type=str, default=[])
@@ -77,6 +113,8 @@ class IntentFilter:
 
 class Permission:
 
+    __slots__ = ("name", "protection")
+
     @staticmethod
     def default() -> "Permission":
         return Permission({"name": "", "protection": "normal"})
@@ -97,11 +135,15 @@ class Permission:
 
 class Component:
 
+    __slots__ = ("_obj", "name", "exported", "enabled", "_intents")
+
+    intents = _LazyList("intents", IntentFilter)
+
     def __init__(self, obj: dict):
+        self._obj = obj
         self.name = utils.get_item(obj, "name", type=str, default="")
         self.exported = utils.get_item(obj, "exported", type=bool, default=False)
         self.enabled = utils.get_item(obj, "enabled", type=bool, default=False)
-        self.intents = utils.get_list_item(obj, "intents", type=IntentFilter, default=[])
 
     def is_dangerous(self):
         return True
@@ -112,6 +154,8 @@ class Component:
 
 class Activity(Component):
 
+    __slots__ = ("permission",)
+
     def __init__(self, obj: dict):
         super().__init__(obj)
         self.permission = utils.get_item(obj, "permission", type=Permission, default=Permission.default())
@@ -122,6 +166,8 @@ class Activity(Component):
 
 class Service(Component):
 
+    __slots__ = ("permission",)
+
     def __init__(self, obj: dict):
         super().__init__(obj)
         self.permission = utils.get_item(obj, "permission", type=Permission, default=Permission.default())
@@ -132,6 +178,8 @@ class Service(Component):
 
 class Receiver(Component):
 
+    __slots__ = ("permission",)
+
     def __init__(self, obj: dict):
         super().__init__(obj)
         self.permission = utils.get_item(obj, "permission", type=Permission, default=Permission.default())
@@ -142,14 +190,16 @@ class Receiver(Component):
 
 class Provider(Component):
 
+    __slots__ = ("authority", "read_permission", "write_permission", "_uri_permission_patterns", "_path_permissions")
+
+    uri_permission_patterns = _LazyList("uriPermissionPatterns", PatternMatcher)
+    path_permissions = _LazyList("pathPermissions", PathPermission)
+
     def __init__(self, obj: dict):
         super().__init__(obj)
         self.authority = utils.get_item(obj, "authority", type=str, default="")
         self.read_permission = utils.get_item(obj, "readPermission", type=Permission, default=Permission.default())
         self.write_permission = utils.get_item(obj, "writePermission", type=Permission, default=Permission.default())
-        self.uri_permission_patterns = utils.get_list_item(obj, "uriPermissionPatterns", type=PatternMatcher,
-                                                           default=[])
-        self.path_permissions = utils.get_list_item(obj, "pathPermissions", type=PathPermission, default=[])
 
     def is_dangerous(self):
         if not self.exported:
@@ -164,7 +214,20 @@ class Provider(Component):
 
 class Package:
 
+    __slots__ = ("_obj", "name", "app_name", "user_id", "gids", "source_dir", "version_code", "version_name",
+                 "last_update_time", "enabled", "system", "debuggable", "allow_backup",
+                 "_requested_permissions", "_permissions", "_activities", "_services", "_receivers", "_providers")
+
+    # 组件信息只有在第一次访问时才会解析
+    requested_permissions = _LazyList("requestedPermissions", Permission)
+    permissions = _LazyList("permissions", Permission)
+    activities = _LazyList("activities", Activity)
+    services = _LazyList("services", Service)
+    receivers = _LazyList("receivers", Receiver)
+    providers = _LazyList("providers", Provider)
+
     def __init__(self, obj: dict):
+        self._obj = obj
         self.name = utils.get_item(obj, "name", type=str, default="")
         self.app_name = utils.get_item(obj, "appName", type=str, default="")
         self.user_id = utils.get_item(obj, "userId", type=int, default=0)
@@ -172,18 +235,12 @@ class Package:
         self.source_dir = utils.get_item(obj, "sourceDir", type=str, default="")
         self.version_code = utils.get_item(obj, "versionCode", type=str, default="")
         self.version_name = utils.get_item(obj, "versionName", type=str, default="")
+        self.last_update_time = utils.get_item(obj, "lastUpdateTime", type=int, default=0)
         self.enabled = utils.get_item(obj, "enabled", type=bool, default=False)
         self.system = utils.get_item(obj, "system", type=bool, default=False)
         self.debuggable = utils.get_item(obj, "debuggable", type=bool, default=False)
         self.allow_backup = utils.get_item(obj, "allowBackup", type=bool, default=False)
 
-        self.requested_permissions = utils.get_list_item(obj, "requestedPermissions", type=Permission, default=[])
-        self.permissions = utils.get_list_item(obj, "permissions", type=Permission, default=[])
-        self.activities = utils.get_list_item(obj, "activities", type=Activity, default=[])
-        self.services = utils.get_list_item(obj, "services", type=Service, default=[])
-        self.receivers = utils.get_list_item(obj, "receivers", type=Receiver, default=[])
-        self.providers = utils.get_list_item(obj, "providers", type=Provider, default=[])
-
     def get_launch_activity(self) -> Optional[Activity]:
         for activity in self.activities:
             for intent in activity.intents:
@@ -243,6 +300,8 @@ class Package:
 
 class Socket:
 
+    __slots__ = ("proto", "state", "inode", "listening")
+
     def __init__(self, obj: dict):
         self.proto = utils.get_item(obj, "proto", type=str, default="")
         self.state = utils.get_item(obj, "state", type=str, default="")
@@ -255,6 +314,9 @@ class Socket:
 
 class InetSocket(Socket):
 
+    __slots__ = ("local_address", "local_port", "remote_address", "remote_port", "uid",
+                 "transmit_queue", "receive_queue")
+
     def __init__(self, obj: dict):
         super().__init__(obj)
         self.local_address = utils.get_item(obj, "localAddress", type=str, default="")
@@ -268,6 +330,8 @@ class InetSocket(Socket):
 
 class UnixSocket(Socket):
 
+    __slots__ = ("ref_cnt", "flags", "type", "path", "readable", "writable")
+
     def __init__(self, obj: dict):
         super().__init__(obj)
         self.ref_cnt = utils.get_item(obj, "refCnt", type=int, default=0)
@@ -283,6 +347,9 @@ class UnixSocket(Socket):
 
 class Process:
 
+    __slots__ = ("pid", "uid", "gid", "state", "cmd", "name", "ppid", "pgid", "sid", "tty",
+                 "utime", "stime", "nice", "start_time", "vsz", "rss")
+
     def __init__(self, obj: dict):
         self.pid = utils.get_item(obj, "pid", type=int, default=0)
         self.uid = utils.get_item(obj, "uid", type=int, default=0)
@@ -300,3 +367,21 @@ class Process:
         self.start_time = utils.get_item(obj, "startTime", type=int, default=0)
         self.vsz = utils.get_item(obj, "vsz", type=int, default=0)
         self.rss = utils.get_item(obj, "rss", type=int, default=0)
+
+
+class ShellResult:
+
+    __slots__ = ("command", "out", "err", "exit_code")
+
+    def __init__(self, command: str, out: str, err: str, exit_code: Optional[int]):
+        self.command = command
+        self.out = out
+        self.err = err
+        self.exit_code = exit_code
+
+    @property
+    def is_success(self) -> bool:
+        return self.exit_code == 0
+
+    def __repr__(self):
+        return f"ShellResult<{self.command}, exit_code={self.exit_code}>"
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import concurrent.futures
+import hashlib
+import io
+import os
+import posixpath
+import stat
+import tempfile
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional, Iterable, Tuple
+
+from .adb import AdbError
+from .. import utils, environ
+
+if TYPE_CHECKING:
+    from .adb import Device
+
+_logger = environ.get_logger("android.sync")
+
+_PARTIAL_SUFFIX = ".linktools-partial"
+
+
+class FileInfo:
+
+    __slots__ = ("path", "size", "mtime", "md5")
+
+    def __init__(self, path: str, size: int, mtime: int, md5: str = None):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.md5 = md5
+
+    def __repr__(self):
+        return f"FileInfo<{self.path}, size={self.size}, mtime={self.mtime}>"
+
+
+class SyncResult:
+
+    def __init__(self):
+        self.transferred: List[str] = []
+        self.skipped: List[str] = []
+        self.errors: Dict[str, BaseException] = {}
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    @property
+    def is_success(self) -> bool:
+        return not self.errors
+
+    def __repr__(self):
+        return f"SyncResult<transferred={len(self.transferred)}, skipped={len(self.skipped)}, " \
+               f"errors={len(self.errors)}, bytes={self.bytes}, elapsed={self.elapsed:.3f}s>"
+
+
+def get_local_md5(path: str) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(1024 * 1024), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+@utils.timeoutable
+def stat_remote_files(device: "Device", paths: Iterable[str], checksum: bool = False, privilege: bool = False,
+                      timeout: utils.Timeout = None) -> Dict[str, FileInfo]:
+    """
+    一次adb调用获取多个远程文件的大小、修改时间以及md5
+    :param device: 设备
+    :param paths: 远程文件路径
+    :param checksum: 是否计算md5
+    :param privilege: 是否以root权限获取
+    :return: 路径和文件信息，不存在的文件不会返回
+    """
+    paths = list(paths)
+    if not paths:
+        return {}
+    commands = [("stat", "-c", "%s %Y %f %n", *paths)]
+    if checksum:
+        commands.append(("md5sum", *paths))
+    results = device.shell_batch(commands, privilege=privilege, ignore_errors=True, timeout=timeout)
+    return _parse_remote_files(results[0].out, results[1].out if checksum else None)
+
+
+@utils.timeoutable
+def list_remote_files(device: "Device", remote_dir: str, checksum: bool = False, privilege: bool = False,
+                      timeout: utils.Timeout = None) -> Dict[str, FileInfo]:
+    """
+    一次adb调用递归获取远程目录下所有文件的信息
+    :param device: 设备
+    :param remote_dir: 远程目录
+    :param checksum: 是否计算md5
+    :param privilege: 是否以root权限获取
+    :return: 相对路径和文件信息
+    """
+    remote_dir = remote_dir.rstrip("/") or "/"
+    cd = f"cd {utils.list2cmdline([remote_dir])} 2>/dev/null &&"
+    commands = [f"{cd} find . -type f -exec stat -c '%s %Y %f %n' {{}} +"]
+    if checksum:
+        commands.append(f"{cd} find . -type f -exec md5sum {{}} +")
+    results = device.shell_batch(commands, privilege=privilege, ignore_errors=True, timeout=timeout)
+    files = {}
+    for path, info in _parse_remote_files(results[0].out, results[1].out if checksum else None).items():
+        path = posixpath.normpath(path)
+        info.path = posixpath.join(remote_dir, path)
+        files[path] = info
+    return files
+
+
+def _parse_remote_files(stat_out: str, md5_out: Optional[str]) -> Dict[str, FileInfo]:
+    files = {}
+    for line in stat_out.splitlines():
+        splits = line.split(" ", 3)
+        try:
+            size, mtime, mode = int(splits[0]), int(splits[1]), int(splits[2], 16)
+        except (ValueError, IndexError):
+            continue
+        # 只保留普通文件
+        if not stat.S_ISREG(mode):
+            continue
+        files[splits[3]] = FileInfo(splits[3], size, mtime)
+    if md5_out is not None:
+        for line in md5_out.splitlines():
+            splits = line.split(maxsplit=1)
+            if len(splits) == 2 and splits[1] in files:
+                files[splits[1]].md5 = splits[0]
+    return files
+
+
+def list_local_files(local_dir: str) -> Dict[str, FileInfo]:
+    files = {}
+    for root, _, names in os.walk(local_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            if name.endswith(_PARTIAL_SUFFIX) or not os.path.isfile(path):
+                continue
+            st = os.stat(path)
+            rel_path = os.path.relpath(path, local_dir).replace(os.sep, "/")
+            files[rel_path] = FileInfo(path, st.st_size, int(st.st_mtime))
+    return files
+
+
+class SyncEngine:
+    """
+    本地和设备之间的增量同步，只传输大小、修改时间（或md5）不一致的文件，
+    多个文件通过多条sync连接并发传输，大文件支持断点续传
+    """
+
+    def __init__(self, device: "Device", checksum: bool = False, max_workers: int = 4,
+                 resume: bool = True, chunk_size: int = 8 * 1024 * 1024):
+        """
+        :param device: 设备
+        :param checksum: 通过md5判断文件是否变化，否则比较大小和修改时间
+        :param max_workers: 最多同时传输的文件数
+        :param resume: 大于chunk_size的文件是否分块传输，传输中断后下次可以继续
+        :param chunk_size: 分块大小
+        """
+        self._device = device
+        self._checksum = checksum
+        self._max_workers = max_workers
+        self._resume = resume
+        self._chunk_size = chunk_size
+
+    def is_changed(self, local: FileInfo, remote: Optional[FileInfo]) -> bool:
+        if remote is None or local.size != remote.size:
+            return True
+        if self._checksum:
+            if local.md5 is None:
+                local.md5 = get_local_md5(local.path)
+            return local.md5 != remote.md5
+        return local.mtime != remote.mtime
+
+    @utils.timeoutable
+    def push(self, local_path: str, remote_path: str, timeout: utils.Timeout = None) -> SyncResult:
+        """
+        同步本地文件或目录到设备
+        """
+        if os.path.isdir(local_path):
+            local_files = list_local_files(local_path)
+            remote_files = list_remote_files(self._device, remote_path, checksum=self._checksum, timeout=timeout)
+            tasks = [
+                (rel_path, local, posixpath.join(remote_path, rel_path), remote_files.get(rel_path))
+                for rel_path, local in local_files.items()
+            ]
+        else:
+            st = os.stat(local_path)
+            local = FileInfo(local_path, st.st_size, int(st.st_mtime))
+            remote_files = stat_remote_files(self._device, [remote_path], checksum=self._checksum, timeout=timeout)
+            tasks = [(remote_path, local, remote_path, remote_files.get(remote_path))]
+
+        return self._run(
+            [(rel_path, local.size, (self._push_file, local, dst, timeout))
+             for rel_path, local, dst, remote in tasks if self.is_changed(local, remote)],
+            [rel_path for rel_path, local, dst, remote in tasks if not self.is_changed(local, remote)],
+            timeout,
+        )
+
+    @utils.timeoutable
+    def pull(self, remote_path: str, local_path: str, timeout: utils.Timeout = None) -> SyncResult:
+        """
+        同步设备上的文件或目录到本地
+        """
+        remote_files = stat_remote_files(self._device, [remote_path], checksum=self._checksum, timeout=timeout)
+        if remote_path in remote_files:
+            if os.path.isdir(local_path):
+                local_path = os.path.join(local_path, posixpath.basename(remote_path))
+            tasks = [(remote_path, remote_files[remote_path], local_path)]
+        else:
+            remote_files = list_remote_files(self._device, remote_path, checksum=self._checksum, timeout=timeout)
+            tasks = [
+                (rel_path, remote, os.path.join(local_path, *rel_path.split("/")))
+                for rel_path, remote in remote_files.items()
+            ]
+
+        transfers, skipped = [], []
+        for rel_path, remote, dst in tasks:
+            if os.path.isfile(dst):
+                st = os.stat(dst)
+                if not self.is_changed(FileInfo(dst, st.st_size, int(st.st_mtime)), remote):
+                    skipped.append(rel_path)
+                    continue
+            transfers.append((rel_path, remote.size, (self._pull_file, remote, dst, timeout)))
+        return self._run(transfers, skipped, timeout)
+
+    def _run(self, transfers: List[Tuple], skipped: List[str], timeout: utils.Timeout) -> SyncResult:
+        result = SyncResult()
+        result.skipped.extend(skipped)
+        start_time = time.time()
+        if transfers:
+            # 每个传输任务都使用同一个timeout，超时后自行退出，这里不等待线程池结束
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers)
+            futures = {
+                executor.submit(fn, *args): (rel_path, size)
+                for rel_path, size, (fn, *args) in transfers
+            }
+            try:
+                for future in concurrent.futures.as_completed(futures, timeout=timeout.remain):
+                    self._collect(result, future, *futures.pop(future))
+            except concurrent.futures.TimeoutError:
+                for future, (rel_path, size) in futures.items():
+                    if future.done():
+                        self._collect(result, future, rel_path, size)
+                    else:
+                        future.cancel()
+                        result.errors[rel_path] = TimeoutError(f"sync {rel_path} timeout")
+            finally:
+                executor.shutdown(wait=False)
+        result.elapsed = time.time() - start_time
+        _logger.debug(f"Sync {self._device.id} finished: {result}")
+        return result
+
+    @classmethod
+    def _collect(cls, result: SyncResult, future: concurrent.futures.Future, rel_path: str, size: int) -> None:
+        try:
+            future.result()
+            result.transferred.append(rel_path)
+            result.bytes += size
+        except Exception as e:
+            _logger.debug(f"Sync {rel_path} failed: {e}")
+            result.errors[rel_path] = e
+
+    def _push_file(self, local: FileInfo, dst: str, timeout: utils.Timeout) -> None:
+        if self._resume and local.size > self._chunk_size:
+            self._push_file_chunked(local, dst, timeout)
+            return
+        _logger.debug(f"Push {local.path} to {dst}")
+        client = self._device.adb.client
+        if client is not None:
+            client.push(self._device.id, local.path, dst, timeout=timeout)
+        else:
+            self._device.push(local.path, dst, timeout=timeout)
+
+    def _push_file_chunked(self, local: FileInfo, dst: str, timeout: utils.Timeout) -> None:
+        # adb sync协议不支持偏移写入，所以分块推送后在设备上追加到临时文件，中断后从临时文件大小处继续
+        partial = dst + _PARTIAL_SUFFIX
+        chunk_path = partial + ".chunk"
+        remote = stat_remote_files(self._device, [partial], timeout=timeout).get(partial)
+        offset = remote.size if remote is not None and remote.size <= local.size else 0
+        if offset == 0:
+            self._device.shell("mkdir", "-p", posixpath.dirname(dst), "&&", "rm", "-f", partial, timeout=timeout)
+        else:
+            _logger.debug(f"Resume pushing {local.path} from {offset} bytes")
+
+        with open(local.path, "rb") as fd:
+            fd.seek(offset)
+            while offset < local.size:
+                timeout.ensure()
+                chunk = fd.read(self._chunk_size)
+                self._push_bytes(chunk, chunk_path, timeout)
+                self._device.shell("cat", chunk_path, ">>", partial, "&&", "rm", chunk_path, timeout=timeout)
+                offset += len(chunk)
+
+        # 修改时间与本地保持一致，这样下次同步时可以跳过
+        stamp = time.strftime("%Y%m%d%H%M.%S", time.gmtime(local.mtime))
+        self._device.shell("mv", partial, dst, "&&", "TZ=UTC", "touch", "-m", "-t", stamp, dst, timeout=timeout)
+
+    def _push_bytes(self, data: bytes, dst: str, timeout: utils.Timeout) -> None:
+        client = self._device.adb.client
+        if client is not None:
+            client.sync(self._device.id, lambda c: c.push(io.BytesIO(data).read, dst), timeout=timeout)
+            return
+        fd, path = tempfile.mkstemp(dir=environ.get_temp_dir(create=True))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            self._device.push(path, dst, timeout=timeout)
+        finally:
+            utils.ignore_error(os.remove, args=(path,))
+
+    def _pull_file(self, remote: FileInfo, dst: str, timeout: utils.Timeout) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+        partial = dst + _PARTIAL_SUFFIX
+        offset = os.path.getsize(partial) if self._resume and os.path.isfile(partial) else 0
+        if offset > remote.size:
+            offset = 0
+        # 直接写入临时文件，中断后已经传输的部分会保留下来，下次从文件末尾继续读取
+        with open(partial, "ab" if offset > 0 else "wb") as fd:
+            if offset > 0:
+                _logger.debug(f"Resume pulling {remote.path} from {offset} bytes")
+                self._read_remote(remote.path, offset, fd, timeout)
+            else:
+                _logger.debug(f"Pull {remote.path} to {dst}")
+                client = self._device.adb.client
+                if client is not None:
+                    client.sync(self._device.id, lambda c: c.pull(remote.path, fd.write), timeout=timeout)
+                else:
+                    # adb pull失败时会删除目标文件，所以同样通过exec-out读取
+                    self._read_remote(remote.path, 0, fd, timeout)
+
+        if os.path.getsize(partial) != remote.size:
+            raise AdbError(f"pull {remote.path} incomplete: {os.path.getsize(partial)}/{remote.size} bytes")
+        os.replace(partial, dst)
+        os.utime(dst, (remote.mtime, remote.mtime))
+
+    def _read_remote(self, path: str, offset: int, fd, timeout: utils.Timeout) -> None:
+        command = utils.list2cmdline(["tail", "-c", f"+{offset + 1}", path])
+        client = self._device.adb.client
+        if client is not None:
+            with client.open(self._device.id, f"exec:{command}", timeout=timeout) as connection:
+                connection.settimeout(timeout)
+                while True:
+                    data = connection.recv(64 * 1024)
+                    if not data:
+                        break
+                    fd.write(data)
+            return
+        process = self._device.popen("exec-out", command, stdout=fd)
+        try:
+            process.wait(timeout=timeout.remain)
+        finally:
+            process.kill()
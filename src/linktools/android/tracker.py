@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import socket
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple
+
+from .adb import parse_device_states, _alive_states
+from .. import utils, environ
+from ..device import DeviceTracker
+
+if TYPE_CHECKING:
+    from .adb import Adb
+    from .client import AdbConnection
+
+_logger = environ.get_logger("android.tracker")
+
+
+class AdbDeviceTracker(DeviceTracker):
+    """
+    通过host:track-devices长连接跟踪设备，adb server每次设备变化都会推送完整的设备列表；
+    没有开启native时定时执行adb devices
+    """
+
+    def __init__(self, adb: "Adb", interval: float = None):
+        """
+        :param adb: adb对象
+        :param interval: 不支持长连接时获取设备列表的间隔
+        """
+        super().__init__(alive_states=_alive_states)
+        self._adb = adb
+        self._interval = interval or environ.get_config("ANDROID_TRACKER_INTERVAL", type=float, default=1)
+        self._connection: "Optional[AdbConnection]" = None
+
+    def _run(self) -> None:
+        client = self._adb.client
+        if client is None:
+            while not self._stop_event.is_set():
+                self._update(self._to_devices(self._adb.get_device_states()))
+                self._stop_event.wait(self._interval)
+            return
+
+        connection = client.connect(timeout=client.connect_timeout)
+        try:
+            connection.request("host:track-devices")
+            connection.settimeout(None)
+            self._connection = connection
+            if self._stop_event.is_set():
+                return
+            _logger.debug(f"Track devices: {client}")
+            while not self._stop_event.is_set():
+                self._update(self._to_devices(parse_device_states(connection.recv_string().splitlines())))
+        finally:
+            self._connection = None
+            connection.close()
+
+    def _interrupt(self) -> None:
+        connection = self._connection
+        if connection is not None:
+            utils.ignore_error(connection.socket.shutdown, args=(socket.SHUT_RDWR,))
+
+    def _get_retry_interval(self) -> float:
+        # adb server重启时需要等一会儿才能连上
+        return self._interval
+
+    @classmethod
+    def _to_devices(cls, states: Dict[str, str]) -> Dict[str, Tuple[str, Any]]:
+        return {id: (state, None) for id, state in states.items()}
+
+    def __repr__(self):
+        return f"AdbDeviceTracker<{self._adb.options}>"
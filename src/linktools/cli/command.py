@@ -44,6 +44,7 @@ from rich import get_console
 from rich.tree import Tree
 
 from .argparse import BooleanOptionalAction
+from .. import utils
 from .._environ import environ
 from ..decorator import cached_property
 from ..metadata import __missing__
@@ -102,11 +103,19 @@ class LogCommandMixin:
                         handler.show_level = value
                     environ.set_config("SHOW_LOG_LEVEL", value)
 
+        class TraceAction(Action):
+
+            def __call__(self, parser, namespace, values, option_string=None):
+                utils.start_tracing(values)
+
         group = parser.add_argument_group(title="log options")
         group.add_argument("--verbose", action=VerboseAction, nargs=0, const=True, dest=SUPPRESS,
                            help="increase log verbosity")
         group.add_argument("--debug", action=DebugAction, nargs=0, const=True, dest=SUPPRESS,
                            help=f"increase {self.environ.name}'s log verbosity, and enable debug mode")
+        group.add_argument("--trace", metavar="FILE", action=TraceAction, dest=SUPPRESS,
+                           help="record subprocess and adb calls to FILE, which can be opened in Perfetto "
+                                "(chrome trace format, or one event per line if FILE ends with .ndjson)")
 
         if LogHandler.get_instance():
             group.add_argument("--time", action=LogTimeAction, dest=SUPPRESS,
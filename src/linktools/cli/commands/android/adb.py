@@ -29,6 +29,9 @@
 from argparse import ArgumentParser, Namespace
 from typing import Optional
 
+from linktools import utils
+
+from linktools.android import DeviceGroup, Device
 from linktools.cli import AndroidCommand
 
 
@@ -58,10 +61,19 @@ class Command(AndroidCommand):
         return super().main(*args, **kwargs)
 
     def init_arguments(self, parser: ArgumentParser) -> None:
+        parser.add_argument("--all", action="store_true", default=False,
+                            help="run on all online devices concurrently")
+        parser.add_argument("--parallel", metavar="N", type=int, default=None,
+                            help="max number of devices running at the same time (implies --all)")
+        parser.add_argument("--timeout", metavar="SECONDS", type=float, default=None,
+                            help="timeout for each device when running on all devices")
         parser.add_argument("adb_args", nargs="...", metavar="args", help="adb args")
 
     def run(self, args: Namespace) -> Optional[int]:
         adb_args = args.adb_args
+        if args.all or args.parallel:
+            return self._run_all(args, adb_args)
+
         if adb_args and adb_args[0] not in self._GENERAL_COMMANDS and not adb_args[0].startswith("wait-for-"):
             device = args.device_picker.pick()
             process = device.popen(*adb_args, capture_output=False)
@@ -71,6 +83,35 @@ class Command(AndroidCommand):
         process = adb.popen(*adb_args, capture_output=False)
         return process.call()
 
+    def _run_all(self, args: Namespace, adb_args: [str]) -> Optional[int]:
+
+        def run(device: Device, timeout: utils.Timeout):
+            process = device.popen(*adb_args, capture_output=True)
+            try:
+                process.exec(
+                    timeout=timeout,
+                    on_stdout=lambda line: self.logger.info(f"[{device.id}] {line}"),
+                    on_stderr=lambda line: self.logger.error(f"[{device.id}] {line}"),
+                )
+                return process.wait(timeout=timeout.remain)
+            finally:
+                process.kill()
+
+        group = DeviceGroup(adb=args.device_picker.bridge)
+        if len(group) == 0:
+            self.logger.error("no devices/emulators found")
+            return 1
+
+        exit_code = 0
+        for result in group.map(run, max_workers=args.parallel, device_timeout=args.timeout):
+            if result.is_success and result.result == 0:
+                self.logger.info(f"[{result.device.id}] finished in {result.elapsed:.2f}s")
+            else:
+                error = result.error or f"exit code {result.result}"
+                self.logger.error(f"[{result.device.id}] failed: {error}")
+                exit_code = 1
+        return exit_code
+
 
 command = Command()
 if __name__ == "__main__":
@@ -249,6 +249,8 @@ class Command(AndroidCommand):
                             help='display simple info only')
         parser.add_argument('--dangerous', action='store_true', default=False,
                             help='display dangerous permissions and components only')
+        parser.add_argument('--refresh', action='store_true', default=False,
+                            help='ignore cached package info and fetch it again')
         parser.add_argument('-o', '--order-by', metavar="field", action='store', nargs='+', default=['userId', 'name'],
                             choices=['name', 'appName', 'userId', 'sourceDir',
                                      'enabled', 'system', 'debuggable', 'allowBackup'],
@@ -258,17 +260,17 @@ class Command(AndroidCommand):
         device = args.device_picker.pick()
 
         if not utils.is_empty(args.packages):
-            packages = device.get_packages(*args.packages, simple=args.simple)
+            packages = device.get_packages(*args.packages, simple=args.simple, refresh=args.refresh)
         elif not utils.is_empty(args.uids):
-            packages = device.get_packages_for_uid(*args.uids, simple=args.simple)
+            packages = device.get_packages_for_uid(*args.uids, simple=args.simple, refresh=args.refresh)
         elif args.system:
-            packages = device.get_packages(system=True, simple=args.simple)
+            packages = device.get_packages(system=True, simple=args.simple, refresh=args.refresh)
         elif args.non_system:
-            packages = device.get_packages(system=False, simple=args.simple)
+            packages = device.get_packages(system=False, simple=args.simple, refresh=args.refresh)
         elif args.all:
-            packages = device.get_packages(simple=args.simple)
+            packages = device.get_packages(simple=args.simple, refresh=args.refresh)
         else:
-            packages = device.get_packages(device.get_current_package(), simple=args.simple)
+            packages = device.get_packages(device.get_current_package(), simple=args.simple, refresh=args.refresh)
 
         if not utils.is_empty(args.order_by):
             packages = sorted(packages, key=lambda x: [utils.get_item(x, k, default="") for k in args.order_by])
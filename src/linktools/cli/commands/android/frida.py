@@ -31,6 +31,7 @@ from argparse import ArgumentParser, Namespace
 from typing import Optional, List, Type
 
 from linktools import utils, environ, DownloadError
+from linktools.android.forward import forward_registry
 from linktools.cli import CommandError, AndroidCommand
 from linktools.cli.argparse import range_type, KeyValueAction
 from linktools.frida import FridaApplication, FridaShareScript, FridaScriptFile, FridaEvalCode
@@ -100,7 +101,7 @@ class Command(AndroidCommand):
                     if args.auto_start:
                         app.load_script(app.device.spawn(package), resume=True)
 
-        with AndroidFridaServer(device=device, local_port=utils.pick_unused_port()) as server:
+        with AndroidFridaServer(device=device, local_port=forward_registry.reserve_port()) as server:
 
             # 如果没有填包名，则找到顶层应用
             if utils.is_empty(package):
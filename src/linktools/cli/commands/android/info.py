@@ -63,11 +63,11 @@ files = (
 )
 
 cmds = (
-    ("uname", ("uname -a",)),
-    ("magisk df", ("df | grep /sbin/.magisk",)),
-    ("magisk mount", ("mount | grep /sbin/.magisk",)),
-    ("magisk process", ("df | ps | grep magisk",)),
-    ("ip", ("ip a",)),
+    ("uname", "uname -a"),
+    ("magisk df", "df | grep /sbin/.magisk"),
+    ("magisk mount", "mount | grep /sbin/.magisk"),
+    ("magisk process", "df | ps | grep magisk"),
+    ("ip", "ip a"),
 )
 
 
@@ -82,24 +82,34 @@ class Command(AndroidCommand):
     def run(self, args: Namespace) -> Optional[int]:
         device = args.device_picker.pick()
 
+        # 所有属性、文件和命令合并成一次adb调用
+        results = iter(device.shell_batch(
+            [
+                *[("getprop", prop) for prop in props],
+                *[("cat", file) for file in files],
+                *[cmd for _, cmd in cmds],
+            ],
+            ignore_errors=True,
+        ))
+
         environ.logger.info(f"Property", style="red")
         for prop in props:
             environ.logger.info(
-                f"{prop}: {device.get_prop(prop)}",
+                f"{prop}: {next(results).out.strip()}",
                 indent=2
             )
 
         environ.logger.info(f"File", style="red")
         for file in files:
             environ.logger.info(
-                f"{file}: {device.shell('cat', file, ignore_errors=True).strip()}",
+                f"{file}: {next(results).out.strip()}",
                 indent=2
             )
 
         environ.logger.info(f"Cmdline", style="red")
-        for cmd in cmds:
+        for name, _ in cmds:
             environ.logger.info(
-                f"{cmd[0]}: {device.shell(*cmd[1], ignore_errors=True).strip()}",
+                f"{name}: {next(results).out.strip()}",
                 indent=2
             )
 
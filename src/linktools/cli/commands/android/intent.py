@@ -28,7 +28,7 @@
 """
 import os
 from argparse import ArgumentParser, Namespace
-from typing import Optional
+from typing import Optional, List
 
 from linktools import utils
 from linktools.cli import subcommand, subcommand_argument, AndroidCommand
@@ -95,10 +95,10 @@ class Command(AndroidCommand):
                      log_output=True)
 
     @subcommand("install", help="install apk file (require \'/data/local/tmp\' write permission)", pass_args=True)
-    @subcommand_argument("path")
-    def on_install(self, args: Namespace, path: str):
+    @subcommand_argument("paths", metavar="PATH", nargs="+", help="apk path or url, split apks can be passed together")
+    def on_install(self, args: Namespace, paths: List[str]):
         device = args.device_picker.pick()
-        device.install(path,
+        device.install(paths,
                        opts=["-r", "-t", "-d", "-f"],
                        log_output=True)
 
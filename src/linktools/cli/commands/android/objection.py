@@ -30,6 +30,7 @@ from argparse import ArgumentParser, Namespace
 from typing import Optional, List, Type
 
 from linktools import utils, environ, DownloadError
+from linktools.android.forward import forward_registry
 from linktools.cli import CommandError, AndroidCommand
 from linktools.cli.argparse import range_type
 from linktools.frida.android import AndroidFridaServer
@@ -67,7 +68,7 @@ class Command(AndroidCommand):
     def run(self, args: Namespace) -> Optional[int]:
         device = args.device_picker.pick()
 
-        with AndroidFridaServer(device=device, local_port=utils.pick_unused_port()) as server:
+        with AndroidFridaServer(device=device, local_port=forward_registry.reserve_port()) as server:
 
             objection_args = ["objection"]
             if environ.debug:
@@ -28,12 +28,17 @@
 """
 
 import datetime
+import os
 import sys
 from argparse import ArgumentParser, Namespace
 from typing import Optional
 
 from linktools import utils, environ
+from linktools.android import Device
+from linktools.android.pull import get_apk_paths, pull_file
+from linktools.android.sampler import ProcessSampler, ProcessSnapshot, SnapshotWriter
 from linktools.cli import AndroidCommand
+from linktools.rich import create_progress
 
 
 class Command(AndroidCommand):
@@ -55,11 +60,27 @@ class Command(AndroidCommand):
                            help='pull current apk file')
         group.add_argument('--screen', metavar='DEST', action='store', type=str, nargs='?', default=".",
                            help='capture screen and pull file')
+        group.add_argument('--watch', action='store_true', default=False,
+                           help='sample cpu and memory usage of all processes continuously')
+
+        watch_group = parser.add_argument_group(title="watch options")
+        watch_group.add_argument('--interval', metavar='SECONDS', action='store', type=float, default=1,
+                                 help='sampling interval')
+        watch_group.add_argument('--limit', metavar='N', action='store', type=int, default=20,
+                                 help='show top N processes')
+        watch_group.add_argument('--sort', action='store', choices=('cpu', 'rss', 'rss_delta'), default='cpu',
+                                 help='sort processes by field')
+        watch_group.add_argument('--output', metavar='FILE', action='store', type=str, default=None,
+                                 help='export time series to file (.csv or .ndjson)')
+        watch_group.add_argument('--root', action='store_true', default=False,
+                                 help='read /proc as root')
 
     def run(self, args: Namespace) -> Optional[int]:
         device = args.device_picker.pick()
 
-        if args.package:
+        if args.watch:
+            return self._watch(device, args)
+        elif args.package:
             environ.logger.info(device.get_current_package())
         elif args.activity:
             environ.logger.info(device.get_current_activity())
@@ -72,21 +93,35 @@ class Command(AndroidCommand):
             environ.logger.info("find current package: {}".format(package_name))
             package = utils.get_item(device.get_packages(package_name, simple=True), 0)
             if package is not None:
-                environ.logger.info("find current apk path: {}".format(package.source_dir))
-                path = device.get_storage_path("{}_{}.apk".format(package.name, package.version_name))
                 dest = args.apk if not utils.is_empty(args.apk) else "."
-                device.shell("mkdir", "-p", device.get_storage_path(), log_output=True)
-                device.shell("cp", package.source_dir, path, log_output=True)
-                device.pull(path, dest, log_output=True)
-                device.shell("rm", path)
+                name = "{}_{}".format(package.name, package.version_name)
+                with create_progress() as progress:
+                    tasks = {}
+
+                    def update_progress(path, total, transferred):
+                        if path not in tasks:
+                            tasks[path] = progress.add_task(os.path.basename(path), total=total)
+                        progress.update(tasks[path], completed=transferred)
+
+                    paths = get_apk_paths(device, package.name)
+                    if len(paths) == 1:
+                        environ.logger.info("find current apk path: {}".format(paths[0]))
+                        if os.path.isdir(dest):
+                            dest = os.path.join(dest, f"{name}.apk")
+                        pull_file(device, paths[0], dest, progress=update_progress)
+                    else:
+                        environ.logger.info("find {} apks of current package".format(len(paths)))
+                        if os.path.isdir(dest):
+                            dest = os.path.join(dest, name)
+                        device.pull_apks(package.name, dest, progress=update_progress)
+                environ.logger.info(f"save apk to: {dest}")
         elif "--screen" in sys.argv:
             now = datetime.datetime.now()
-            path = device.get_storage_path("screenshot-" + now.strftime("%Y-%m-%d-%H-%M-%S") + ".png")
             dest = args.screen if not utils.is_empty(args.screen) else "."
-            device.shell("mkdir", "-p", device.get_storage_path(), log_output=True)
-            device.shell("screencap", "-p", path, log_output=True)
-            device.pull(path, dest, log_output=True)
-            device.shell("rm", path)
+            if os.path.isdir(dest):
+                dest = os.path.join(dest, "screenshot-" + now.strftime("%Y-%m-%d-%H-%M-%S") + ".png")
+            utils.write_file(dest, device.screencap())
+            environ.logger.info(f"save screenshot to: {dest}")
         else:
             package = device.get_current_package()
             environ.logger.info("package:  ", package)
@@ -95,6 +130,38 @@ class Command(AndroidCommand):
 
         return
 
+    def _watch(self, device: Device, args: Namespace) -> Optional[int]:
+        from rich.live import Live
+        from rich.table import Table
+
+        def make_table(snapshot: ProcessSnapshot) -> Table:
+            table = Table(title=f"{device.id}  cpu {snapshot.cpu:.1f}% ({snapshot.cpu_count} cores)")
+            for name in ("PID", "NAME", "S", "CPU%", "RSS(KB)", "ΔRSS(KB)", "THR"):
+                table.add_column(name, justify="left" if name in ("NAME", "S") else "right")
+            for p in snapshot.top(args.limit, key=args.sort):
+                table.add_row(str(p.pid), p.name, p.state, f"{p.cpu:.1f}", str(p.rss), f"{p.rss_delta:+d}", str(p.threads))
+            return table
+
+        output = None
+        sampler = ProcessSampler(device, interval=args.interval, privilege=args.root)
+        try:
+            if args.output:
+                output = open(args.output, "w", newline="")
+                sampler.add_callback(SnapshotWriter(output, "ndjson" if args.output.endswith(".ndjson") else "csv"))
+            sampler.start()
+            with Live(auto_refresh=False) as live:
+                while sampler.is_running:
+                    snapshot = sampler.wait_snapshot(timeout=max(args.interval * 5, 5))
+                    if snapshot is not None:
+                        live.update(make_table(snapshot), refresh=True)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sampler.stop()
+            if output is not None:
+                output.close()
+        return 0
+
 
 command = Command()
 if __name__ == "__main__":
@@ -29,7 +29,7 @@
 import json
 import subprocess
 from argparse import ArgumentParser, Namespace
-from typing import Optional, Type, List
+from typing import Optional, Type, List, Dict
 
 from linktools import ToolError, DownloadError
 from linktools.cli import BaseCommand
@@ -59,6 +59,10 @@ class Command(BaseCommand):
                            help="show the config of tool")
         group.add_argument("--download", action="store_true", default=False,
                            help="download tool files")
+        parser.add_argument("--all", action="store_true", default=False,
+                            help="download all tools supported on this platform (only with --download)")
+        parser.add_argument("--parallel", metavar="N", type=int, default=None,
+                            help="max number of tools downloading at the same time")
         group.add_argument("--clear", action="store_true", default=False,
                            help="clear tool files")
         group.add_argument("-d", "--daemon", action="store_true", default=False,
@@ -66,7 +70,8 @@ class Command(BaseCommand):
 
         tool_names = sorted([tool.name for tool in iter(self.environ.tools)])
         subparsers = parser.add_subparsers(metavar="TOOL", help=f"{{{','.join(tool_names)}}}")
-        subparsers.required = True
+        # 下载所有工具时不需要指定工具名
+        subparsers.required = False
         for tool_name in tool_names:
             tool_parser = subparsers.add_parser(tool_name, prefix_chars=chr(0))
             tool_parser.add_argument("tool_args", metavar="args", nargs="...")
@@ -74,7 +79,17 @@ class Command(BaseCommand):
 
     def run(self, args: Namespace) -> Optional[int]:
 
-        tool_name, tool_args = args.tool_name, args.tool_args
+        tool_name = getattr(args, "tool_name", None)
+        if args.all:
+            # --all只能与--download一起使用，也不能再指定工具名
+            if not args.download or tool_name is not None:
+                self._argument_parser.error("argument --all: only allowed with --download and without TOOL")
+            return self._download_tools(self.environ.tools.prepare(parallel=args.parallel))
+
+        if tool_name is None:
+            self._argument_parser.error("the following arguments are required: TOOL")
+
+        tool_args = args.tool_args
         tool = self.environ.get_tool(tool_name, **(args.configs or {}))
 
         if args.config:
@@ -82,7 +97,11 @@ class Command(BaseCommand):
             return 0
 
         elif args.download:
-            if not tool.exists:
+            if args.parallel:
+                # 依赖和工具本身并发下载
+                if self._download_tools(self.environ.tools.prepare(tool, parallel=args.parallel)) != 0:
+                    return 1
+            elif not tool.exists:
                 tool.prepare()
             self.logger.info(f"Download tool files success: {tool.absolute_path}")
             return 0
@@ -105,6 +124,14 @@ class Command(BaseCommand):
             process = tool.popen(*tool_args)
             return process.call()
 
+    def _download_tools(self, errors: Dict[str, BaseException]) -> int:
+        for name, error in sorted(errors.items()):
+            self.logger.error(f"Download {name} failed: {error}")
+        if errors:
+            return 1
+        self.logger.info(f"Download tool files success")
+        return 0
+
 
 command = Command()
 if __name__ == "__main__":
@@ -1,26 +1,271 @@
 #!/usr/bin/env python3
 # -*- coding:utf-8 -*-
 
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Any, Generator, TypeVar, Type
+from typing import Any, Generator, TypeVar, Type, Callable, Dict, List, Optional, Tuple
 
-from . import utils, Tool
+from . import utils, environ, Tool
+from .reactor import Stoppable
 
 BridgeType = TypeVar("BridgeType", bound="Bridge")
 DeviceType = TypeVar("DeviceType", bound="BaseDevice")
 
+_logger = environ.get_logger("device")
+
+utils.skip_trace_caller(__file__)
+
 
 class BridgeError(Exception):
     pass
 
 
+class TrackedDevice:
+
+    __slots__ = ("id", "state", "info", "update_time")
+
+    def __init__(self, id: str, state: str, info: Any = None):
+        self.id = id
+        self.state = state
+        self.info = info
+        self.update_time = time.time()
+
+    def __repr__(self):
+        return f"TrackedDevice<{self.id}, {self.state}>"
+
+
+class DeviceEvent:
+    ATTACH = "attach"
+    DETACH = "detach"
+    CHANGE = "change"
+
+    __slots__ = ("type", "id", "state", "old_state", "info")
+
+    def __init__(self, type: str, id: str, state: Optional[str], old_state: Optional[str], info: Any = None):
+        self.type = type
+        self.id = id
+        self.state = state
+        self.old_state = old_state
+        self.info = info
+
+    def __repr__(self):
+        return f"DeviceEvent<{self.type}, {self.id}, {self.old_state} -> {self.state}>"
+
+
+class DeviceTracker(Stoppable):
+    """
+    在后台维护设备列表，设备接入、断开或者状态变化时回调，子类负责在_run中获取设备列表并调用_update
+    """
+
+    def __init__(self, alive_states: Tuple[str, ...]):
+        """
+        :param alive_states: 哪些状态算作在线
+        """
+        self._alive_states = alive_states
+        self._lock = threading.RLock()
+        self._devices: Dict[str, TrackedDevice] = {}
+        self._listeners: List[Callable[[DeviceEvent], Any]] = []
+        self._ready = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive() and not self._stop_event.is_set()
+
+    @property
+    def is_ready(self) -> bool:
+        """
+        是否已经获取到设备列表，没有准备好时不能使用设备表
+        """
+        return self.is_running and self._ready.is_set()
+
+    def is_alive(self, state: str) -> bool:
+        return state in self._alive_states
+
+    def add_listener(self, fn: Callable[[DeviceEvent], Any], replay: bool = True) -> Callable[[DeviceEvent], Any]:
+        """
+        添加设备变化的回调，回调在tracker线程中执行，不要在回调中做耗时操作
+        :param fn: 回调函数
+        :param replay: 是否对当前已有的设备补发attach事件
+        :return: 回调函数，方便作为装饰器使用
+        """
+        with self._lock:
+            self._listeners.append(fn)
+            devices = list(self._devices.values()) if replay else []
+        for device in devices:
+            self._notify(fn, DeviceEvent(DeviceEvent.ATTACH, device.id, device.state, None, device.info))
+        return fn
+
+    def remove_listener(self, fn: Callable[[DeviceEvent], Any]) -> None:
+        with self._lock:
+            if fn in self._listeners:
+                self._listeners.remove(fn)
+
+    def on_attach(self, fn: Callable[[DeviceEvent], Any]) -> Callable[[DeviceEvent], Any]:
+        return self.add_listener(lambda event: fn(event) if event.type == DeviceEvent.ATTACH else None)
+
+    def on_detach(self, fn: Callable[[DeviceEvent], Any]) -> Callable[[DeviceEvent], Any]:
+        return self.add_listener(lambda event: fn(event) if event.type == DeviceEvent.DETACH else None, replay=False)
+
+    def get_devices(self, alive: bool = None) -> List[TrackedDevice]:
+        """
+        从设备表中获取设备，不会有任何io操作
+        :param alive: 只返回在线的设备
+        """
+        with self._lock:
+            devices = list(self._devices.values())
+        if alive is None:
+            return devices
+        return [device for device in devices if alive == self.is_alive(device.state)]
+
+    def get_device(self, id: str) -> Optional[TrackedDevice]:
+        with self._lock:
+            return self._devices.get(id)
+
+    def start(self) -> "DeviceTracker":
+        with self._lock:
+            if not self.is_running:
+                self._stop_event.clear()
+                self._ready.clear()
+                self._thread = threading.Thread(target=self._run_loop, name=f"{self.__class__.__name__}")
+                self._thread.daemon = True
+                self._thread.start()
+        return self
+
+    @utils.timeoutable
+    def wait_ready(self, timeout: utils.Timeout = None) -> bool:
+        """
+        等待第一次获取到设备列表
+        """
+        return self._ready.wait(timeout.remain)
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._interrupt()
+
+    def _run_loop(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                self._run()
+            except Exception as e:
+                _logger.debug(f"{self.__class__.__name__} error: {e}")
+            # 连接断开或出错时，设备表已经不可信了，等重新获取到设备列表后再提供服务
+            self._ready.clear()
+            self._stop_event.wait(self._get_retry_interval())
+        self._ready.clear()
+
+    @abstractmethod
+    def _run(self) -> None:
+        """
+        获取设备列表，每次获取到完整的设备列表后调用_update，停止时返回
+        """
+        pass
+
+    def _interrupt(self) -> None:
+        """
+        停止时打断_run中的阻塞操作
+        """
+        pass
+
+    def _get_retry_interval(self) -> float:
+        return 1
+
+    def _update(self, devices: Dict[str, Tuple[str, Any]]) -> None:
+        """
+        用完整的设备列表更新设备表，并触发回调
+        :param devices: 设备号 -> (状态, 附加信息)
+        """
+        events = []
+        with self._lock:
+            for id, (state, info) in devices.items():
+                device = self._devices.get(id)
+                if device is None:
+                    self._devices[id] = TrackedDevice(id, state, info)
+                    events.append(DeviceEvent(DeviceEvent.ATTACH, id, state, None, info))
+                elif device.state != state:
+                    events.append(DeviceEvent(DeviceEvent.CHANGE, id, state, device.state, info))
+                    device.state, device.info, device.update_time = state, info, time.time()
+                else:
+                    device.info = info
+            for id in [id for id in self._devices if id not in devices]:
+                device = self._devices.pop(id)
+                events.append(DeviceEvent(DeviceEvent.DETACH, id, None, device.state, device.info))
+            listeners = list(self._listeners)
+            self._ready.set()
+        for event in events:
+            _logger.debug(f"{event}")
+            for listener in listeners:
+                self._notify(listener, event)
+
+    @classmethod
+    def _notify(cls, listener: Callable[[DeviceEvent], Any], event: DeviceEvent) -> None:
+        try:
+            listener(event)
+        except Exception as e:
+            _logger.warning(f"Device listener error: {e}")
+
+
+class PollingDeviceTracker(DeviceTracker, ABC):
+    """
+    不支持事件通知时，定时获取设备列表
+    """
+
+    def __init__(self, alive_states: Tuple[str, ...], interval: float = 1):
+        super().__init__(alive_states)
+        self._interval = interval
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            self._update(self._poll())
+            self._stop_event.wait(self._interval)
+
+    @abstractmethod
+    def _poll(self) -> Dict[str, Tuple[str, Any]]:
+        pass
+
+
 class Bridge:
 
+    _trackers: Dict[Tuple, DeviceTracker] = {}
+    _trackers_lock = threading.Lock()
+
     def __init__(self, tool: Tool = None, options: [str] = None, error_type: Type[BridgeError] = BridgeError):
         self._tool = tool
         self._options = options or []
         self._error_type = error_type
 
+    @property
+    def _tracker_key(self) -> Tuple:
+        return self.__class__.__name__, tuple(str(option) for option in self._options)
+
+    @property
+    def tracker(self) -> Optional[DeviceTracker]:
+        """
+        正在运行的设备跟踪器，同样参数的bridge对象共用一个
+        """
+        with self._trackers_lock:
+            tracker = self._trackers.get(self._tracker_key)
+        if tracker is not None and tracker.is_running:
+            return tracker
+        return None
+
+    def track_devices(self) -> DeviceTracker:
+        """
+        启动设备跟踪器，启动后list_devices直接从设备表中读取
+        :return: 设备跟踪器
+        """
+        with self._trackers_lock:
+            tracker = self._trackers.get(self._tracker_key)
+            if tracker is None or not tracker.is_running:
+                tracker = self._trackers[self._tracker_key] = self._create_tracker()
+            tracker.start()
+        return tracker
+
+    def _create_tracker(self) -> DeviceTracker:
+        raise self._error_type(f"{self.__class__.__name__} does not support device tracking")
+
     def list_devices(self, alive: bool = None) -> Generator["BaseDevice", None, None]:
         from .android import Adb
         from .ios import Sib
@@ -50,13 +295,25 @@ class Bridge:
         """
         if self._tool is None:
             raise self._error_type("tool not found")
-        return self._tool.exec(
-            *(*self._options, *args),
-            timeout=timeout,
-            ignore_errors=ignore_errors,
-            log_output=log_output,
-            error_type=self._error_type
-        )
+        tracer = utils.get_tracer()
+        if tracer is None:
+            return self._tool.exec(
+                *(*self._options, *args),
+                timeout=timeout,
+                ignore_errors=ignore_errors,
+                log_output=log_output,
+                error_type=self._error_type
+            )
+        argv = [str(arg) for arg in (*self._options, *args)]
+        serial = argv[argv.index("-s") + 1] if "-s" in argv[:-1] else None
+        with tracer.span(self._tool.name, "bridge", argv=argv, serial=serial):
+            return self._tool.exec(
+                *argv,
+                timeout=timeout,
+                ignore_errors=ignore_errors,
+                log_output=log_output,
+                error_type=self._error_type
+            )
 
 
 class BaseDevice(ABC):
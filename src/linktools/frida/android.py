@@ -19,6 +19,7 @@ from .server import FridaServer
 from .. import environ, utils
 from .._url import DownloadHttpError
 from ..android import Device
+from ..android.sync import stat_remote_files, get_local_md5
 from ..reactor import Stoppable
 
 _logger = environ.get_logger("frida.server.android")
@@ -62,17 +63,17 @@ class AndroidFridaServer(FridaServer):
                 f"tcp:{self._remote_port}"
             )
 
-            # 创建软链
-            self._device.sudo("mkdir", "-p", self._server_dir)
-            self._device.sudo("ln", "-s", server_path, self._server_path)
-
-            # 接下来新开一个进程运行frida server，并且输出一下是否出错
-            self._device.sudo(
-                self._server_path,
-                "-d", "fs-binaries",
-                "-l", f"0.0.0.0:{self._remote_port}",
-                "-D", "&",
-                ignore_errors=True,
+            # 创建软链，接下来新开一个进程运行frida server，并且输出一下是否出错
+            self._device.shell_batch(
+                [
+                    ("mkdir", "-p", self._server_dir),
+                    ("ln", "-s", server_path, self._server_path),
+                    (self._server_path,
+                     "-d", "fs-binaries",
+                     "-l", f"0.0.0.0:{self._remote_port}",
+                     "-D", "&"),
+                ],
+                privilege=True,
                 log_output=True,
             )
         finally:
@@ -108,10 +109,17 @@ class AndroidFridaServer(FridaServer):
     def _prepare_executable(self):
         executables = self._get_executables(self._device.abi, frida.__version__)
 
-        # 先判断设备上有没有现成的frida server，有的话直接返回
-        for executable in executables:
-            remote_path = self._device.get_data_path("fs", executable.name)
-            if self._device.is_file_exist(remote_path):
+        # 先判断设备上有没有现成的frida server，有的话直接返回，本地已经下载过的话还需要校验md5是否一致
+        remote_paths = [self._device.get_data_path("fs", executable.name) for executable in executables]
+        remote_files = stat_remote_files(self._device, remote_paths, checksum=True)
+        for executable, remote_path in zip(executables, remote_paths):
+            remote_file = remote_files.get(remote_path)
+            if remote_file is None or remote_file.size == 0:
+                continue
+            if not os.path.exists(executable.path):
+                return remote_path
+            if remote_file.size == os.path.getsize(executable.path) and \
+                    remote_file.md5 == get_local_md5(executable.path):
                 return remote_path
 
         # 设备上如果没有，那需要下载了，默认按照配置里的顺序进行下载
@@ -129,10 +137,18 @@ class AndroidFridaServer(FridaServer):
                 raise e
 
             _logger.info(f"Push {executable.name} to remote: {remote_path}")
-            self._device.push(executable.path, remote_temp_path, log_output=True)
-            self._device.sudo("mkdir", "-p", remote_dir, log_output=True)
-            self._device.sudo("mv", remote_temp_path, remote_path, log_output=True)
-            self._device.sudo("chmod", "755", remote_path, log_output=True)
+            result = self._device.sync(executable.path, remote_temp_path, checksum=True)
+            if not result.is_success:
+                raise result.errors[remote_temp_path]
+            self._device.shell_batch(
+                [
+                    ("mkdir", "-p", remote_dir),
+                    ("mv", remote_temp_path, remote_path),
+                    ("chmod", "755", remote_path),
+                ],
+                privilege=True,
+                log_output=True,
+            )
 
             return remote_path
 
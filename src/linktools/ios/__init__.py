@@ -8,4 +8,4 @@
 # Project   : link
 
 from .ipa import IPA, IPAError
-from .sib import SibError, Sib, Device
+from .sib import SibError, Sib, Device, SibDeviceTracker
@@ -5,16 +5,18 @@ import json
 import subprocess
 import time
 from subprocess import TimeoutExpired
-from typing import Any, Generator, List
+from typing import Any, Generator, List, Dict, Tuple
 
 from .. import utils
 from .._environ import environ
 from ..decorator import cached_property
-from ..device import BridgeError, Bridge, BaseDevice
+from ..device import BridgeError, Bridge, BaseDevice, PollingDeviceTracker
 from ..reactor import Stoppable
 
 _logger = environ.get_logger("android.adb")
 
+_alive_states = ("online",)
+
 
 class SibError(BridgeError):
     pass
@@ -31,19 +33,64 @@ class Sib(Bridge):
 
     def list_devices(self, alive: bool = None) -> Generator["Device", None, None]:
         """
-        获取所有设备列表
+        获取所有设备列表，设备跟踪器运行时直接从设备表中读取
         :param alive: 只显示在线的设备
         :return: 设备号数组
         """
+        tracker = self.tracker
+        if tracker is not None and tracker.is_ready:
+            for device in tracker.get_devices(alive=alive):
+                yield Device(device.id, device.info)
+            return
+        for id, (status, info) in self.get_device_states().items():
+            if alive is None:
+                yield Device(id, info)
+            elif alive == (status in _alive_states):
+                yield Device(id, info)
+
+    def get_device_states(self) -> Dict[str, Tuple[str, dict]]:
+        """
+        获取所有设备的状态
+        :return: 设备号 -> (状态, 设备信息)
+        """
         result = self.exec("devices", "--detail")
         result = utils.ignore_error(json.loads, args=(result,)) or []
+        states = {}
         for info in utils.get_list_item(result, "deviceList", default=[]):
             id = utils.get_item(info, "serialNumber")
-            status = utils.get_item(info, "status")
-            if alive is None:
-                yield Device(id, info)
-            elif alive == (status in ("online",)):
-                yield Device(id, info)
+            if id:
+                states[id] = (utils.get_item(info, "status"), info)
+        return states
+
+    def track_devices(self) -> "SibDeviceTracker":
+        """
+        启动设备跟踪器，sib没有事件通知，定时获取设备列表
+        :return: 设备跟踪器
+        """
+        return super().track_devices()
+
+    def _create_tracker(self) -> "SibDeviceTracker":
+        return SibDeviceTracker(self)
+
+
+class SibDeviceTracker(PollingDeviceTracker):
+
+    def __init__(self, sib: Sib, interval: float = None):
+        """
+        :param sib: sib对象
+        :param interval: 获取设备列表的间隔
+        """
+        super().__init__(
+            alive_states=_alive_states,
+            interval=interval or environ.get_config("IOS_TRACKER_INTERVAL", type=float, default=2),
+        )
+        self._sib = sib
+
+    def _poll(self) -> Dict[str, Tuple[str, dict]]:
+        return self._sib.get_device_states()
+
+    def _get_retry_interval(self) -> float:
+        return self._interval
 
 
 class Device(BaseDevice):
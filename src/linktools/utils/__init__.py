@@ -51,6 +51,11 @@ from ._subprocess import (
     list2cmdline,
 )
 
+from ._trace import (
+    Tracer, TraceSpan,
+    get_tracer, start_tracing, stop_tracing, skip_trace_caller,
+)
+
 from ._port import (
     is_port_free,
     pick_unused_port,
@@ -4,57 +4,60 @@
 import errno
 import os
 import queue
+import selectors
 import subprocess
+import sys
 import threading
+from io import BytesIO, TextIOWrapper
 from typing import AnyStr, Tuple, Optional, IO, Callable, Any
 
 from . import Timeout, timeoutable
+from ._trace import get_tracer, skip_trace_caller
 from .._environ import environ
 from ..decorator import cached_property
 
 
 list2cmdline = subprocess.list2cmdline
 
+skip_trace_caller(__file__)
+
 
 class Output:
+    """
+    读取子进程的stdout和stderr，按块读取到bytearray中，需要回调时才按行切分；
+    posix上在调用线程中通过selectors同时等待两个管道，windows的管道不支持select，
+    只能每个管道一个读取线程
+    """
+
     STDOUT = 1
     STDERR = 2
 
+    _chunk_size = 256 * 1024
+
     def __init__(self, stdout: IO[AnyStr], stderr: IO[AnyStr]):
-        self._queue = queue.Queue()
-        self._stdout_finished = None
-        self._stdout_thread = None
-        self._stderr_finished = None
-        self._stderr_thread = None
+        self._ios = {}
         if stdout:
-            self._stdout_finished = threading.Event()
-            self._stdout_thread = threading.Thread(
-                target=self._iter_lines,
-                args=(stdout, self.STDOUT, self._stdout_finished,)
-            )
-            self._stdout_thread.daemon = True
-            self._stdout_thread.start()
+            self._ios[self.STDOUT] = stdout
         if stderr:
-            self._stderr_finished = threading.Event()
-            self._stderr_thread = threading.Thread(
-                target=self._iter_lines,
-                args=(stderr, self.STDERR, self._stderr_finished,)
-            )
-            self._stderr_thread.daemon = True
-            self._stderr_thread.start()
+            self._ios[self.STDERR] = stderr
+        self._finished = set()
+        self._queue: Optional[queue.Queue] = None
+        if sys.platform == "win32" and self._ios:
+            self._queue = queue.Queue()
+            for flag, io in self._ios.items():
+                thread = threading.Thread(target=self._read_chunks, args=(io, flag))
+                thread.daemon = True
+                thread.start()
 
     @property
     def is_alive(self):
-        if self._stdout_finished and not self._stdout_finished.is_set():
-            return True
-        if self._stderr_finished and not self._stderr_finished.is_set():
-            return True
-        return False
+        return len(self._finished) < len(self._ios)
 
-    def _iter_lines(self, io: IO[AnyStr], flag: int, event: threading.Event):
+    def _read_chunks(self, io: IO[AnyStr], flag: int):
         try:
+            fd = io.fileno()
             while True:
-                data = io.readline()
+                data = os.read(fd, self._chunk_size)
                 if not data:
                     break
                 self._queue.put((flag, data))
@@ -62,32 +65,93 @@ class Output:
             if e.errno != errno.EBADF:
                 environ.logger.debug(f"Handle output error: {e}")
         finally:
-            event.set()
-            self._queue.put((None, None))
+            self._queue.put((flag, None))
 
-    def get_lines(self, timeout: Timeout):
+    def _iter_queue(self, timeout: Timeout):
         while self.is_alive:
             try:
-                # 给个1秒超时时间防止有多个线程消费的时候死锁
-                flag, data = self._queue.get(timeout=min(timeout.remain or 1, 1))
-                if flag is not None:
-                    yield flag, data
-            except queue.Empty:
-                if not timeout.check():
-                    break
-
-        while True:
-            try:
-                # 需要把剩余可消费的数据消费完
-                flag, data = self._queue.get_nowait()
-                if flag is not None:
-                    yield flag, data
+                flag, data = self._queue.get(timeout=timeout.remain)
             except queue.Empty:
                 break
+            if data is None:
+                self._finished.add(flag)
+            else:
+                yield flag, data
+
+    def _iter_selector(self, timeout: Timeout):
+        with selectors.DefaultSelector() as selector:
+            for flag, io in self._ios.items():
+                if flag not in self._finished:
+                    selector.register(io.fileno(), selectors.EVENT_READ, flag)
+            while self.is_alive:
+                events = selector.select(timeout.remain)
+                if not events:
+                    if not timeout.check():
+                        break
+                    continue
+                for key, _ in events:
+                    try:
+                        data = os.read(key.fd, self._chunk_size)
+                    except OSError as e:
+                        if e.errno not in (errno.EBADF, errno.EIO):
+                            environ.logger.debug(f"Handle output error: {e}")
+                        data = b""
+                    if not data:
+                        selector.unregister(key.fd)
+                        self._finished.add(key.data)
+                    else:
+                        yield key.data, data
+
+    def iter_chunks(self, timeout: Timeout):
+        """
+        读取数据块直到两个管道都关闭或者超时
+        :param timeout: 超时时间
+        :return: (STDOUT/STDERR, 数据块)
+        """
+        if self._queue is not None:
+            return self._iter_queue(timeout)
+        return self._iter_selector(timeout)
+
+    def decode(self, flag: int, data: bytes) -> AnyStr:
+        """
+        管道是文本模式时，与TextIOWrapper一样解码并转换换行符
+        """
+        io = self._ios[flag]
+        if isinstance(io, TextIOWrapper):
+            return TextIOWrapper(BytesIO(data), encoding=io.encoding, errors=io.errors).read()
+        return data
+
+
+class _LineSplitter:
+    """
+    把数据块拼成完整的行再回调，只有设置了回调才会切分
+    """
+
+    def __init__(self, callback: Callable[[str], Any]):
+        self._callback = callback
+        self._remain = b""
+
+    def feed(self, data: bytes):
+        lines = (self._remain + data).split(b"\n")
+        self._remain = lines.pop()
+        for line in lines:
+            self._emit(line)
+
+    def flush(self):
+        if self._remain:
+            self._emit(self._remain)
+            self._remain = b""
+
+    def _emit(self, line: bytes):
+        line = line.decode(errors="ignore").rstrip()
+        if line:
+            self._callback(line)
 
 
 class Popen(subprocess.Popen):
 
+    _trace_span = None
+
     def __init__(self, *args, **kwargs):
         capture_output = kwargs.pop("capture_output", False)
         if capture_output is True:
@@ -112,6 +176,22 @@ class Popen(subprocess.Popen):
 
         super().__init__(args, **kwargs)
 
+        tracer = get_tracer()
+        if tracer is not None:
+            self._trace_span = tracer.span(os.path.basename(args[0]), "process", argv=args, pid=self.pid)
+
+    def poll(self):
+        returncode = super().poll()
+        if returncode is not None and self._trace_span is not None:
+            self._trace_span.finish(exit_code=returncode)
+        return returncode
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout)
+        if self._trace_span is not None:
+            self._trace_span.finish(exit_code=returncode)
+        return returncode
+
     @timeoutable
     def call(self, timeout: Timeout = None) -> int:
         with self:
@@ -159,22 +239,39 @@ class Popen(subprocess.Popen):
 
         if self.stdout or self.stderr:
 
-            for flag, data in self._output.get_lines(timeout):
-                if flag == self._output.STDOUT:
-                    out = data if out is None else out + data
-                    if on_stdout:
-                        data = data.decode(errors="ignore") if isinstance(data, bytes) else data
-                        data = data.rstrip()
-                        if data:
-                            on_stdout(data)
-
-                elif flag == self._output.STDERR:
-                    err = data if err is None else err + data
-                    if on_stderr:
-                        data = data.decode(errors="ignore") if isinstance(data, bytes) else data
-                        data = data.rstrip()
-                        if data:
-                            on_stderr(data)
+            output = self._output
+            buffers = {output.STDOUT: bytearray(), output.STDERR: bytearray()}
+            splitters = {}
+            if on_stdout:
+                splitters[output.STDOUT] = _LineSplitter(on_stdout)
+            if on_stderr:
+                splitters[output.STDERR] = _LineSplitter(on_stderr)
+
+            for flag, data in output.iter_chunks(timeout):
+                buffers[flag] += data
+                splitter = splitters.get(flag)
+                if splitter:
+                    splitter.feed(data)
+            for splitter in splitters.values():
+                splitter.flush()
+
+            if self._trace_span is not None:
+                self._trace_span.args["stdout_bytes"] = \
+                    self._trace_span.args.get("stdout_bytes", 0) + len(buffers[output.STDOUT])
+                self._trace_span.args["stderr_bytes"] = \
+                    self._trace_span.args.get("stderr_bytes", 0) + len(buffers[output.STDERR])
+
+            if buffers[output.STDOUT]:
+                out = output.decode(output.STDOUT, bytes(buffers[output.STDOUT]))
+            if buffers[output.STDERR]:
+                err = output.decode(output.STDERR, bytes(buffers[output.STDERR]))
+
+            if not output.is_alive:
+                # 管道都已经关闭，进程通常也已经退出，等待一下以便调用方拿到返回码
+                try:
+                    self.wait(min(timeout.remain or 1, 1))
+                except subprocess.TimeoutExpired:
+                    pass
         else:
 
             try:
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, Optional
+
+# 只记录调用方时跳过这些文件中的栈帧
+_internal_files = set()
+
+
+class TraceSpan:
+    """
+    一段耗时记录，结束时写成一个chrome trace中的complete事件
+    """
+
+    __slots__ = ("_tracer", "name", "category", "args", "start", "tid", "_finished")
+
+    def __init__(self, tracer: "Tracer", name: str, category: str, args: Dict[str, Any]):
+        self._tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = time.time()
+        self.tid = threading.get_ident()
+        self._finished = False
+
+    def finish(self, **args: Any) -> None:
+        if self._finished:
+            return
+        self._finished = True
+        self.args.update(args)
+        self._tracer.write(self, time.time())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.args["error"] = f"{exc_type.__name__}: {exc_val}"
+        self.finish()
+
+
+class Tracer:
+    """
+    把子进程和adb调用的耗时写到文件中，可以直接用Perfetto或者chrome://tracing打开；
+    文件名以.ndjson/.jsonl结尾时每行一个事件，否则为chrome trace的JSON数组格式，
+    数组格式允许缺少结尾的]，进程异常退出时已经写入的事件仍然可以打开
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._ndjson = path.endswith((".ndjson", ".jsonl"))
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._fd = open(path, "w", encoding="utf-8")
+        self._count = 0
+        if not self._ndjson:
+            self._fd.write("[\n")
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def span(self, name: str, category: str, **args: Any) -> TraceSpan:
+        """
+        开始记录一段耗时，调用finish或者退出with时写入
+        """
+        args.setdefault("caller", get_caller())
+        return TraceSpan(self, name, category, args)
+
+    def write(self, span: TraceSpan, end: float) -> None:
+        event = {
+            "name": span.name,
+            "cat": span.category,
+            "ph": "X",
+            "ts": int(span.start * 1000000),
+            "dur": int((end - span.start) * 1000000),
+            "pid": self._pid,
+            "tid": span.tid,
+            "args": span.args,
+        }
+        data = json.dumps(event, ensure_ascii=False, default=str)
+        with self._lock:
+            if self._fd is None:
+                return
+            if self._ndjson:
+                self._fd.write(f"{data}\n")
+            else:
+                self._fd.write(f"{',' if self._count else ' '}{data}\n")
+            self._count += 1
+            self._fd.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._fd is None:
+                return
+            if not self._ndjson:
+                self._fd.write("]\n")
+            self._fd.close()
+            self._fd = None
+
+    def __repr__(self):
+        return f"Tracer<{self._path}>"
+
+
+def get_caller() -> str:
+    """
+    获取调用方位置，跳过tracing相关的内部调用
+    """
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename in _internal_files:
+        frame = frame.f_back
+    if frame is None:
+        return ""
+    return f"{frame.f_code.co_filename}:{frame.f_lineno} {frame.f_code.co_name}"
+
+
+def skip_trace_caller(path: str) -> None:
+    """
+    该文件中的调用不算作调用方，用于跳过Popen、Tool等封装层
+    """
+    _internal_files.add(path)
+
+
+skip_trace_caller(__file__)
+# timeoutable的包装函数
+skip_trace_caller(os.path.join(os.path.dirname(__file__), "_utils.py"))
+
+_tracer: Optional[Tracer] = None
+_tracer_lock = threading.Lock()
+_tracer_initialized = False
+
+
+def get_tracer() -> Optional[Tracer]:
+    """
+    获取当前的tracer，没有开启时返回None，调用方只需判断是否为None；
+    第一次调用时读取TRACE配置（环境变量LINKTOOLS_TRACE）
+    """
+    global _tracer_initialized
+    if not _tracer_initialized:
+        _tracer_initialized = True
+        from .._environ import environ
+        path = environ.get_config("TRACE", type=str, default=None)
+        if path and _tracer is None:
+            start_tracing(path)
+    return _tracer
+
+
+def start_tracing(path: str) -> Tracer:
+    """
+    开始记录，进程退出时自动结束
+    :param path: 输出文件，.ndjson/.jsonl为每行一个事件，否则为chrome trace格式
+    """
+    global _tracer, _tracer_initialized
+    with _tracer_lock:
+        _tracer_initialized = True
+        if _tracer is not None:
+            if _tracer.path == path:
+                return _tracer
+            _tracer.close()
+        _tracer = Tracer(path)
+        atexit.register(_tracer.close)
+        return _tracer
+
+
+def stop_tracing() -> None:
+    global _tracer
+    with _tracer_lock:
+        if _tracer is not None:
+            _tracer.close()
+            _tracer = None
@@ -0,0 +1,1378 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+import asyncio
+import concurrent.futures
+import csv
+import io
+import json
+import os
+import queue
+import re
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from linktools.android import Adb, Device, DeviceGroup, AdbClient, AdbError, InstallError, AsyncAdb
+from linktools.android.cache import PackageCache, package_cache
+from linktools.android.foreground import ForegroundTracker, parse_resumed_activity
+from linktools.android.forward import ForwardManager, ForwardRegistry, forward_registry
+from linktools.android.redirect import Redirect, RedirectEngine, RedirectRule
+from linktools.android.netstat import SocketMonitor, SocketChange, parse_inet_sockets, parse_unix_sockets
+from linktools.android.memo import MemoCache, memo_cache, memoize
+from linktools.android.prop import PropCache, prop_cache
+from linktools.android.session import ShellSessionLostError, get_pool
+from linktools.android.sampler import ProcessSampler, SnapshotWriter
+from linktools.android.agent import AgentDaemon, AgentDaemonError
+from linktools.android.adb import _iter_json_array, _make_agent_args, _PackageQuery, _package_names_max_length
+from linktools.android.aio import AsyncAdbClient
+from linktools.android.struct import Activity, InetSocket, Package, ShellResult
+from linktools.android.sync import SyncEngine
+from linktools import utils, environ
+from linktools.metadata import __missing__
+
+
+class FakeAdbServer(socketserver.ThreadingTCPServer):
+    """
+    模拟adb server，按照host协议返回预先设置好的结果
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, serial: str = "fake-serial", shell_v2: bool = True, latency: float = 0):
+        self.serial = serial
+        self.shell_v2 = shell_v2
+        self.latency = latency
+        self.transport_id = 1
+        self.commands = {}
+        self.files = {}
+        self.agents = {}
+        self.agent_tokens = {}
+        self.agent_outputs = {}
+        self.requests = []
+        self.execute = False
+        self.real_files = False
+        # 不为空时RECV只返回前recv_limit个字节就断开连接，模拟传输中断
+        self.recv_limit = None
+        self.stdin = {}
+        self.track_queue = queue.Queue()
+        super().__init__(("127.0.0.1", 0), _FakeAdbHandler)
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def add_command(self, command: str, stdout: bytes = b"", stderr: bytes = b"", exit_code: int = 0):
+        self.commands[command] = (stdout, stderr, exit_code)
+
+    def load_records(self, path: str):
+        """
+        加载从真机录制的输出：{"commands": {命令: stdout}, "agents": {agent参数: 输出}}
+        """
+        with open(path, "rb") as fd:
+            records = json.load(fd)
+        for command, stdout in records.get("commands", {}).items():
+            self.add_command(command, stdout=stdout.encode())
+        self.agent_outputs.update(records.get("agents", {}))
+
+    def call_agent(self, params):
+        return self.agent_outputs.get(" ".join(params), "")
+
+    def delay(self):
+        # 模拟usb连接的往返延迟，每个请求都会等待一次
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_command(self, command: str):
+        match = re.search(r" app_process / \S+ --start-flag (\S+) --end-flag (\S+) (.*)$", command)
+        if match and match.group(3) in self.agent_outputs:
+            # 单独启动agent进程时，输出在start_flag和end_flag之间
+            start_flag, end_flag, params = match.groups()
+            return f"{start_flag}{self.agent_outputs[params]}{end_flag}".encode(), b"", 0
+        if command not in self.commands and self.execute:
+            # 没有预设结果的命令交给本地shell执行
+            process = subprocess.run(["sh", "-c", command], capture_output=True)
+            return process.stdout, process.stderr, process.returncode
+        return self.commands.get(command, (b"", b"", 127))
+
+    def close(self):
+        self.track_queue.put(None)
+        self.shutdown()
+        self.server_close()
+
+
+class FakeAdbExecutable:
+    """
+    模拟adb命令行，native客户端不支持的命令（forward、reverse等）会调用它，
+    转发表保存在同目录的json文件中
+    """
+
+    script = r'''
+import json, os, sys, time
+
+time.sleep(LATENCY)
+path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "state.json")
+state = {"forward": {}, "reverse": {}, "calls": 0} if not os.path.exists(path) else json.load(open(path))
+state["calls"] += 1
+args, serial = sys.argv[1:], "fake-serial"
+while args and args[0] in ("-P", "-H", "-s"):
+    if args[0] == "-s":
+        serial = args[1]
+    args = args[2:]
+command, args = args[0], args[1:]
+if command == "shell":
+    # 交给本地shell执行，没有命令时为交互式shell
+    json.dump(state, open(path, "w"))
+    args = [arg for arg in args if arg not in ("-T", "-x")]
+    os.execvp("sh", ["sh", "-c", " ".join(args)] if args else ["sh"])
+elif command == "devices":
+    print("List of devices attached\n%s\tdevice" % serial)
+elif command in ("forward", "reverse"):
+    table = state[command]
+    if args == ["--list"]:
+        for local, remote in table.items():
+            print("%s %s %s" % (serial, local, remote))
+    elif args[0] == "--remove":
+        table.pop(args[1], None)
+    elif args[0] == "--remove-all":
+        table.clear()
+    else:
+        args = [arg for arg in args if arg != "--no-rebind"]
+        local = args[0]
+        if local == "tcp:0":
+            local = "tcp:%d" % (47000 + len(table))
+            print(local[4:])
+        table[local] = args[1]
+else:
+    sys.stderr.write("unsupported command: %s\n" % command)
+    sys.exit(1)
+json.dump(state, open(path, "w"))
+'''
+
+    def __init__(self, path: str, latency: float = 0):
+        self.path = os.path.join(path, "adb")
+        self.latency = latency
+        with open(self.path, "w") as fd:
+            fd.write(f"#!{sys.executable}\nLATENCY = {float(latency)}\n{self.script}")
+        os.chmod(self.path, 0o755)
+
+    @property
+    def calls(self) -> int:
+        state_path = os.path.join(os.path.dirname(self.path), "state.json")
+        if not os.path.exists(state_path):
+            return 0
+        with open(state_path) as fd:
+            return json.load(fd)["calls"]
+
+    def create_adb(self, server: FakeAdbServer) -> Adb:
+        adb = Adb(options=["-P", server.port], native=True)
+        adb._tool = environ.get_tool("adb", cmdline=self.path)
+        return adb
+
+
+class _FakeAdbHandler(socketserver.BaseRequestHandler):
+    server: FakeAdbServer
+
+    def _recv_exactly(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def _recv_request(self):
+        length = int(self._recv_exactly(4), 16)
+        request = self._recv_exactly(length).decode()
+        self.server.requests.append(request)
+        self.server.delay()
+        return request
+
+    def _okay(self, data: bytes = None):
+        self.request.sendall(b"OKAY" if data is None else b"OKAY%04x%s" % (len(data), data))
+
+    def _fail(self, message: str):
+        self.request.sendall(b"FAIL%04x%s" % (len(message), message.encode()))
+
+    def handle(self):
+        try:
+            request = self._recv_request()
+            if request == "host:version":
+                self._okay(b"0029")
+            elif request == "host:devices":
+                self._okay(f"{self.server.serial}\tdevice\n".encode())
+            elif request == "host:devices-l":
+                self._okay(f"{self.server.serial}\tdevice product:fake transport_id:{self.server.transport_id}\n".encode())
+            elif request == "host:track-devices":
+                self._okay()
+                data = f"{self.server.serial}\tdevice\n".encode()
+                while data is not None:
+                    self.request.sendall(b"%04x%s" % (len(data), data))
+                    data = self.server.track_queue.get()
+            elif request == f"host-serial:{self.server.serial}:features":
+                self._okay(b"shell_v2,cmd" if self.server.shell_v2 else b"cmd")
+            elif request == f"host:transport:{self.server.serial}":
+                self._okay()
+                self._handle_service(self._recv_request())
+            elif request.startswith("host:transport:"):
+                self._fail(f"device '{request[len('host:transport:'):]}' not found")
+            else:
+                self._fail(f"unknown request {request}")
+        except (EOFError, ConnectionError):
+            # 客户端超时或者取消后主动断开
+            pass
+
+    def _handle_service(self, service: str):
+        if service.startswith("shell,v2,raw:"):
+            stdout, stderr, exit_code = self.server.get_command(service[len("shell,v2,raw:"):])
+            self._okay()
+            for id, data in ((1, stdout), (2, stderr), (3, bytes([exit_code]))):
+                if data:
+                    self.request.sendall(struct.pack("<BI", id, len(data)) + data)
+        elif service.startswith("shell:") or service.startswith("exec:"):
+            command = service.split(":", 1)[1]
+            self._okay()
+            match = re.search(r"\binstall(-write)? -S (\d+)", command)
+            if match:
+                # 与pm一样读取-S指定长度的stdin数据
+                self.server.stdin[command] = self._recv_exactly(int(match.group(2)))
+            stdout, stderr, _ = self.server.get_command(command)
+            self.request.sendall(stdout + stderr)
+        elif service == "sync:":
+            self._okay()
+            self._handle_sync()
+        elif service.startswith("localabstract:") and service[len("localabstract:"):] in self.server.agents:
+            self._okay()
+            name = service[len("localabstract:"):]
+            self._handle_agent(self.server.agents[name], self.server.agent_tokens.get(name))
+        else:
+            self._fail(f"unknown service {service}")
+
+    def _handle_agent(self, handler, token=None):
+        while True:
+            length = struct.unpack(">I", self._recv_exactly(4))[0]
+            request = json.loads(self._recv_exactly(length))
+            if token is not None and request.get("token") != token:
+                # 与常驻进程一样，token不对直接断开连接
+                return
+            self.server.requests.append(f"agent:{request['method']}")
+            self.server.delay()
+            response = {"jsonrpc": "2.0", "id": request["id"]}
+            if request["method"] == "ping":
+                response["result"] = "pong"
+            else:
+                result = handler(request["params"])
+                # (stdout, stderr)
+                if isinstance(result, tuple):
+                    result, response["stderr"] = result
+                response["result"] = result
+            data = json.dumps(response).encode()
+            self.request.sendall(struct.pack(">I", len(data)) + data)
+
+    def _handle_sync(self):
+        files = self.server.files if not self.server.real_files else _RealFiles()
+        while True:
+            id, length = struct.unpack("<4sI", self._recv_exactly(8))
+            if id == b"QUIT":
+                return
+            path = self._recv_exactly(length).decode()
+            if id == b"STAT":
+                data = files.get(path)
+                mode, size = (0o100644, len(data)) if data is not None else (0, 0)
+                self.request.sendall(struct.pack("<4sIII", b"STAT", mode, size, 0))
+            elif id == b"SEND":
+                path = path.rsplit(",", 1)[0]
+                buffer = b""
+                while True:
+                    id, length = struct.unpack("<4sI", self._recv_exactly(8))
+                    if id == b"DONE":
+                        break
+                    buffer += self._recv_exactly(length)
+                files[path] = buffer
+                if self.server.real_files:
+                    os.utime(path, (length, length))
+                self.request.sendall(struct.pack("<4sI", b"OKAY", 0))
+            elif id == b"RECV":
+                data = files.get(path)
+                if data is None:
+                    message = b"No such file or directory"
+                    self.request.sendall(struct.pack("<4sI", b"FAIL", len(message)) + message)
+                elif self.server.recv_limit is not None and len(data) > self.server.recv_limit:
+                    data = data[:self.server.recv_limit]
+                    self.request.sendall(struct.pack("<4sI", b"DATA", len(data)) + data)
+                    return
+                else:
+                    self.request.sendall(struct.pack("<4sI", b"DATA", len(data)) + data)
+                    self.request.sendall(struct.pack("<4sI", b"DONE", 0))
+
+
+class _RealFiles:
+    """
+    sync协议直接读写本地文件，配合execute可以让设备上的shell命令看到推送的文件
+    """
+
+    def get(self, path):
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as fd:
+            return fd.read()
+
+    def __setitem__(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fd:
+            fd.write(data)
+
+
+class TestAdbClient(unittest.TestCase):
+
+    def setUp(self):
+        prop_cache.invalidate("fake-serial")
+        memo_cache.invalidate("fake-serial")
+        self.server = FakeAdbServer()
+        self.server.add_command("getprop ro.product.model", stdout=b"Pixel\n")
+        self.server.add_command("ls /xxx", stderr=b"ls: /xxx: No such file or directory\n", exit_code=1)
+        self.adb = Adb(options=["-P", self.server.port], native=True)
+        self.device = Device(self.server.serial, adb=self.adb)
+
+    def tearDown(self):
+        self.adb.client.close()
+        self.server.close()
+
+    def test_list_devices(self):
+        devices = list(self.adb.list_devices(alive=True))
+        self.assertEqual([d.id for d in devices], [self.server.serial])
+
+    def test_shell(self):
+        self.assertEqual(self.device.get_prop("ro.product.model"), "Pixel")
+        self.assertIn("shell,v2,raw:getprop ro.product.model", self.server.requests)
+        with self.assertRaises(AdbError):
+            self.device.shell("ls", "/xxx")
+        self.assertEqual(self.device.shell("ls", "/xxx", ignore_errors=True), "")
+
+    def test_legacy_shell(self):
+        self.server.shell_v2 = False
+        client = AdbClient(port=self.server.port)
+        out, err, exit_code = client.shell(self.server.serial, "getprop ro.product.model")
+        self.assertEqual((out, err, exit_code), (b"Pixel\n", b"", None))
+
+    def test_sync(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            src = os.path.join(temp_dir, "src")
+            dst = os.path.join(temp_dir, "dst")
+            with open(src, "wb") as fd:
+                fd.write(b"hello" * 100000)
+            self.device.push(src, "/data/local/tmp/test")
+            self.device.pull("/data/local/tmp/test", dst)
+            with open(dst, "rb") as fd:
+                self.assertEqual(fd.read(), b"hello" * 100000)
+            # 远程文件不存在时不会留下空文件
+            with self.assertRaises(AdbError):
+                self.adb.client.pull(self.server.serial, "/data/local/tmp/none", os.path.join(temp_dir, "none"))
+            self.assertEqual(sorted(os.listdir(temp_dir)), ["dst", "src"])
+        # 同一台设备的sync连接会被复用
+        self.assertEqual(self.server.requests.count("sync:"), 1)
+
+    def test_delta_sync(self):
+        self.server.execute = True
+        self.server.real_files = True
+        with tempfile.TemporaryDirectory() as temp_dir:
+            src = os.path.join(temp_dir, "src")
+            remote = os.path.join(temp_dir, "remote")
+            local = os.path.join(temp_dir, "local")
+            os.makedirs(os.path.join(src, "a"))
+            for name, data in (("a/b.txt", b"b" * 1000), ("c.txt", b"c" * 10)):
+                with open(os.path.join(src, name), "wb") as fd:
+                    fd.write(data)
+
+            result = self.device.sync(src, remote)
+            self.assertEqual(sorted(result.transferred), ["a/b.txt", "c.txt"])
+            result = self.device.sync(src, remote, checksum=True)
+            self.assertEqual((result.transferred, sorted(result.skipped)), ([], ["a/b.txt", "c.txt"]))
+
+            # 大文件分块推送，修改时间与本地一致
+            with open(os.path.join(src, "c.txt"), "wb") as fd:
+                fd.write(b"d" * 10)
+            os.utime(os.path.join(src, "c.txt"), (1000000000, 1000000000))
+            result = SyncEngine(self.device, chunk_size=4).push(src, remote)
+            self.assertEqual(result.transferred, ["c.txt"])
+            self.assertEqual(utils.read_file(os.path.join(remote, "c.txt")), b"d" * 10)
+            self.assertEqual(os.path.getmtime(os.path.join(remote, "c.txt")), 1000000000)
+            self.assertEqual(self.device.sync(src, remote).transferred, [])
+
+            # 拉取中断后保留已经传输的部分，下次从中断的位置继续拉取
+            self.server.recv_limit = 600
+            result = self.device.sync(remote, local, direction="pull")
+            self.assertEqual((result.transferred, list(result.errors)), (["c.txt"], ["a/b.txt"]))
+            self.assertEqual(utils.read_file(os.path.join(local, "a", "b.txt.linktools-partial")), b"b" * 600)
+            self.server.recv_limit = None
+            result = self.device.sync(remote, local, direction="pull")
+            self.assertTrue(result.is_success, result.errors)
+            self.assertEqual(result.transferred, ["a/b.txt"])
+            self.assertEqual(utils.read_file(os.path.join(local, "a", "b.txt")), b"b" * 1000)
+            self.assertIn(f"exec:tail -c +601 {os.path.join(remote, 'a', 'b.txt')}", self.server.requests)
+            self.assertEqual(self.device.sync(remote, local, direction="pull").transferred, [])
+
+            # 开启校验时，未变化的单个文件不再拉取
+            single = os.path.join(temp_dir, "single.txt")
+            engine = SyncEngine(self.device, checksum=True)
+            remote_file = os.path.join(remote, "c.txt")
+            self.assertEqual(engine.pull(remote_file, single).transferred, [remote_file])
+            result = engine.pull(remote_file, single)
+            self.assertEqual((result.transferred, result.skipped), ([], [remote_file]))
+
+    def test_sync_timeout(self):
+        event = threading.Event()
+        engine = SyncEngine(self.device, max_workers=1)
+        start_time = time.time()
+        result = engine._run([
+            ("a", 1, (lambda: None,)),
+            ("b", 1, (event.wait,)),
+            ("c", 1, (event.wait,)),
+        ], [], utils.Timeout(.3))
+        event.set()
+        # 超时后不等待正在传输的文件，未完成的文件记录在errors中
+        self.assertLess(time.time() - start_time, 2)
+        self.assertEqual(result.transferred, ["a"])
+        self.assertEqual(sorted(result.errors), ["b", "c"])
+        self.assertIsInstance(result.errors["b"], TimeoutError)
+
+    def test_stream_install(self):
+        self.server.add_command("id -u", stdout=b"2000\n")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            base, split = os.path.join(temp_dir, "base.apk"), os.path.join(temp_dir, "split.apk")
+            utils.write_file(base, b"base" * 100000)
+            utils.write_file(split, b"split" * 10)
+
+            self.server.add_command("cmd package install -S 400000 -r", stdout=b"Success\n")
+            self.device.install(base, opts=["-r"])
+            self.assertEqual(self.server.stdin["cmd package install -S 400000 -r"], b"base" * 100000)
+            # 不需要推送临时文件
+            self.assertNotIn("sync:", self.server.requests)
+
+            self.server.add_command("cmd package install-create -S 400050",
+                                    stdout=b"Success: created install session [42]\n")
+            self.server.add_command("cmd package install-write -S 400000 42 0_base.apk -", stdout=b"Success\n")
+            self.server.add_command("cmd package install-write -S 50 42 1_split.apk -", stdout=b"Success\n")
+            self.server.add_command("cmd package install-commit 42", stdout=b"Failure [INSTALL_FAILED_TEST_ONLY]\n")
+            with self.assertRaises(InstallError):
+                self.device.install([base, split])
+            self.assertEqual(self.server.stdin["cmd package install-write -S 50 42 1_split.apk -"], b"split" * 10)
+            self.assertIn("exec:cmd package install-abandon 42", self.server.requests)
+
+    def test_device_tracker(self):
+        tracker = self.adb.track_devices()
+        try:
+            self.assertTrue(tracker.wait_ready(timeout=5))
+            self.assertIs(self.adb.track_devices(), tracker)
+            self.assertIs(Adb(options=["-P", self.server.port]).tracker, tracker)
+
+            events = []
+            tracker.add_listener(events.append)
+            count = self.server.requests.count("host:devices")
+            self.assertEqual([d.id for d in self.adb.list_devices(alive=True)], [self.server.serial])
+            self.assertEqual(Device(adb=self.adb).id, self.server.serial)
+            # 设备列表直接从设备表中读取
+            self.assertEqual(self.server.requests.count("host:devices"), count)
+
+            self.server.track_queue.put(f"{self.server.serial}\toffline\nemulator-5554\tdevice\n".encode())
+            self.server.track_queue.put(b"")
+            deadline = time.time() + 5
+            while len(events) < 5 and time.time() < deadline:
+                time.sleep(.05)
+            self.assertEqual(
+                [(e.type, e.id, e.state) for e in events],
+                [("attach", self.server.serial, "device"),
+                 ("change", self.server.serial, "offline"),
+                 ("attach", "emulator-5554", "device"),
+                 ("detach", self.server.serial, None),
+                 ("detach", "emulator-5554", None)],
+            )
+            self.assertEqual(list(self.adb.list_devices()), [])
+        finally:
+            tracker.stop()
+        self.assertIsNone(self.adb.tracker)
+
+    def test_async_device(self):
+        self.server.execute = True
+
+        async def run():
+            adb = AsyncAdb(options=["-P", self.server.port], native=True)
+            devices = await adb.list_devices(alive=True)
+            self.assertEqual([d.id for d in devices], [self.server.serial])
+            device = devices[0]
+            self.assertEqual(await device.shell("echo", "hello"), "hello")
+            self.assertEqual(await device.get_prop("ro.product.model"), "Pixel")
+            with self.assertRaises(AdbError):
+                await device.shell("ls", "/xxx")
+
+            with tempfile.TemporaryDirectory() as temp_dir:
+                src, dst = os.path.join(temp_dir, "src"), os.path.join(temp_dir, "dst")
+                utils.write_file(src, b"hello" * 100000)
+                await device.push(src, "/data/local/tmp/test")
+                await device.pull("/data/local/tmp/test", dst)
+                self.assertEqual(utils.read_file(dst), b"hello" * 100000)
+
+            # 取消task时直接中断，不需要等待命令结束
+            start_time = time.time()
+            task = asyncio.ensure_future(device.shell("sleep", "10"))
+            await asyncio.sleep(.2)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertLess(time.time() - start_time, 5)
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+    def test_async_shared_cache(self):
+        agent_info = Device.agent_info
+        agent_path = Device.get_storage_path("apk", agent_info["md5"], agent_info["name"])
+        agent_args = _make_agent_args(agent_path, agent_info, ["process", "--list"], flag=True)
+        self.server.add_command(f"md5sum {agent_path}", stdout=f"{agent_info['md5']}  {agent_path}\n".encode())
+        self.server.add_command(utils.list2cmdline(agent_args), stdout=(
+            f"{agent_info['start_flag']}[{{\"pid\": 1, \"name\": \"init\"}}]{agent_info['end_flag']}".encode()
+        ))
+        prop_path = PropCache._get_path(self.server.serial)
+        utils.ignore_error(os.remove, args=(prop_path,))
+        self.server.add_command("getprop", stdout=b"[ro.build.fingerprint]: [a]\n[ro.product.model]: [Pixel]\n")
+        self.server.add_command("getprop ro.build.fingerprint", stdout=b"a\n")
+
+        async def run():
+            adb = AsyncAdb(options=["-P", self.server.port], native=True)
+            device = (await adb.list_devices(alive=True))[0]
+
+            # 与Device共用查询缓存，同步接口清除缓存后异步接口也会重新获取
+            self.assertEqual([p.name for p in await device.get_processes()], ["init"])
+            await device.get_processes()
+            self.assertEqual(self.server.requests.count(f"shell,v2,raw:{utils.list2cmdline(agent_args)}"), 1)
+            self.device.invalidate_cache("process")
+            await device.get_processes()
+            self.assertEqual(self.server.requests.count(f"shell,v2,raw:{utils.list2cmdline(agent_args)}"), 2)
+
+            # 设备重连后读取磁盘缓存时同样校验fingerprint
+            self.assertEqual(await device.get_prop("ro.product.model"), "Pixel")
+            prop_cache.invalidate(self.server.serial)
+            self.server.transport_id += 1
+            self.server.add_command("getprop", stdout=b"[ro.build.fingerprint]: [b]\n[ro.product.model]: [Pixel 6]\n")
+            self.server.add_command("getprop ro.build.fingerprint", stdout=b"b\n")
+            self.assertEqual(await device.get_prop("ro.product.model"), "Pixel 6")
+            self.assertIn("shell,v2,raw:getprop ro.build.fingerprint", self.server.requests)
+
+            # 拉取失败时不会留下文件
+            with tempfile.TemporaryDirectory() as temp_dir:
+                dst = os.path.join(temp_dir, "dst")
+                with self.assertRaises(AdbError):
+                    await adb.client.pull(self.server.serial, "/data/local/tmp/missing", dst)
+                self.assertEqual(os.listdir(temp_dir), [])
+
+        memo_cache.invalidate(self.server.serial)
+        prop_cache.invalidate(self.server.serial)
+        environ.set_config("ANDROID_MEMO_CACHE", True)
+        environ.set_config("ANDROID_PROP_DISK_CACHE", True)
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(run())
+        finally:
+            loop.close()
+            environ.set_config("ANDROID_MEMO_CACHE", None)
+            environ.set_config("ANDROID_PROP_DISK_CACHE", None)
+            utils.ignore_error(os.remove, args=(prop_path,))
+
+        # 与AdbClient一样读取ANDROID_ADB_SERVER_PORT
+        os.environ["ANDROID_ADB_SERVER_PORT"] = "5038"
+        try:
+            self.assertEqual(AsyncAdbClient().port, 5038)
+        finally:
+            os.environ.pop("ANDROID_ADB_SERVER_PORT")
+
+    def test_shell_batch(self):
+        self.server.execute = True
+        results = self.device.shell_batch([
+            ("echo", "hello"),
+            "printf world; echo error >&2; false",
+            ("cat", "/xxx/yyy"),
+        ], ignore_errors=True)
+        self.assertEqual([r.out for r in results], ["hello\n", "world", ""])
+        self.assertEqual([r.err.strip() for r in results[:2]], ["", "error"])
+        self.assertEqual([r.exit_code for r in results], [0, 1, 1])
+        self.assertIn("/xxx/yyy", results[2].err)
+        # 所有命令只需要一次adb调用
+        self.assertEqual(len([r for r in self.server.requests if r.startswith("shell,v2,raw:")]), 1)
+        with self.assertRaises(AdbError):
+            self.device.shell_batch([("cat", "/xxx/yyy"), ("echo", "hello")])
+
+    def test_shell_batch_su_failed(self):
+        # su不存在时没有任何输出，也不会输出标记
+        self.server.add_command("id -u", stdout=b"2000\n")
+        self.device.invalidate_cache()
+        with self.assertRaises(AdbError):
+            self.device.shell_batch([("echo", "hello")], privilege=True)
+        results = self.device.shell_batch([("echo", "hello")], privilege=True, ignore_errors=True)
+        self.assertEqual([r.exit_code for r in results], [None])
+
+    def test_screencap(self):
+        png = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) + b"\x00\x00\x00\x00IEND\xae\x42\x60\x82"
+        self.server.add_command("screencap -p", stdout=png)
+        self.assertEqual(self.device.screencap(), png)
+        # 超时等原因导致输出不完整时报错，不返回截断的图片
+        self.server.add_command("screencap -p", stdout=png[:100])
+        with self.assertRaises(AdbError):
+            self.device.screencap()
+
+        # 2x1的RGBA_8888原始帧，android 9之后的头部为16字节
+        self.server.add_command("getprop", stdout=b"[ro.build.version.sdk]: [30]\n")
+        frame = struct.pack("<IIII", 2, 1, 1, 0) + bytes(range(8))
+        self.server.add_command("screencap", stdout=frame)
+        self.assertEqual(self.device.screencap(png=False), frame)
+        self.server.add_command("screencap", stdout=frame[:-1])
+        with self.assertRaises(AdbError):
+            self.device.screencap(png=False)
+        self.server.add_command("while true; do screencap; sleep 0.100; done", stdout=frame * 3)
+        frames = list(self.device.iter_screen_frames(fps=10))
+        self.assertEqual(len(frames), 3)
+        self.assertEqual((frames[0].width, frames[0].height, bytes(frames[0].data)), (2, 1, bytes(range(8))))
+
+        chunks = []
+        self.server.add_command("screenrecord --output-format=h264 --time-limit=1 -", stdout=b"\x00\x00\x00\x01" * 64)
+        recorder = self.device.screenrecord(chunks.append, time_limit=1)
+        self.assertTrue(recorder.wait(timeout=5))
+        self.assertEqual(b"".join(chunks), b"\x00\x00\x00\x01" * 64)
+        self.assertEqual(recorder.bytes_written, 256)
+
+    def test_pull_tree(self):
+        self.server.execute = True
+        with tempfile.TemporaryDirectory() as remote_dir, tempfile.TemporaryDirectory() as local_dir:
+            os.makedirs(os.path.join(remote_dir, "app", "lib"))
+            for name, data in (("base.apk", b"base" * 1000), ("split_config.arm64_v8a.apk", b"split"),
+                               ("lib/libtest.so", b"\x7fELF")):
+                with open(os.path.join(remote_dir, "app", name), "wb") as fd:
+                    fd.write(data)
+            os.symlink("/etc/passwd", os.path.join(remote_dir, "app", "passwd"))
+
+            with self.device.read_stream(os.path.join(remote_dir, "app", "base.apk")) as stream:
+                self.assertEqual(stream.read_all(), b"base" * 1000)
+
+            updates = []
+            paths = self.device.pull_tree(os.path.join(remote_dir, "app"), os.path.join(local_dir, "tree"),
+                                          progress=lambda *args: updates.append(args))
+            self.assertEqual(len(paths), 3)
+            self.assertFalse(os.path.lexists(os.path.join(local_dir, "tree", "passwd")))
+            with open(os.path.join(local_dir, "tree", "lib", "libtest.so"), "rb") as fd:
+                self.assertEqual(fd.read(), b"\x7fELF")
+            self.assertEqual(updates[-1][1:], (4009, 4009))
+
+            apks = [os.path.join(remote_dir, "app", name) for name in ("base.apk", "split_config.arm64_v8a.apk")]
+            self.server.add_command("pm path com.test", stdout="".join(f"package:{p}\n" for p in apks).encode())
+            paths = self.device.pull_apks("com.test", os.path.join(local_dir, "apks"))
+            self.assertEqual([os.path.basename(p) for p in paths], ["base.apk", "split_config.arm64_v8a.apk"])
+            with open(paths[1], "rb") as fd:
+                self.assertEqual(fd.read(), b"split")
+
+    def test_prop_cache(self):
+        self.server.add_command("getprop", stdout=b"[ro.product.cpu.abi]: [arm64-v8a]\n[sys.multi]: [a\nb]\n")
+        self.server.add_command("setprop sys.multi c")
+        self.assertEqual(self.device.abi, "arm64")
+        self.assertEqual(Device(self.server.serial, adb=self.adb).get_prop("sys.multi"), "a\nb")
+        self.assertEqual(self.server.requests.count("shell,v2,raw:getprop"), 1)
+        # 设置属性后缓存失效
+        self.device.set_prop("sys.multi", "c")
+        self.device.get_prop("sys.multi")
+        self.assertEqual(self.server.requests.count("shell,v2,raw:getprop"), 2)
+
+    def test_memo_cache(self):
+        self.server.add_command("id -u", stdout=b"2000\n")
+        # 默认不缓存
+        self.assertEqual(self.device.get_uid(), 2000)
+        self.assertEqual(self.device.get_uid(), 2000)
+        self.assertEqual(self.server.requests.count("shell,v2,raw:id -u"), 2)
+
+        environ.set_config("ANDROID_MEMO_CACHE", True)
+        try:
+            self.assertEqual(self.device.get_uid(), 2000)
+            self.assertEqual(Device(self.server.serial, adb=self.adb).get_uid(), 2000)
+            self.assertEqual(self.server.requests.count("shell,v2,raw:id -u"), 3)
+            # 修改设备状态后同组的缓存失效
+            self.device.invalidate_cache("process")
+            self.device.get_uid()
+            self.assertEqual(self.server.requests.count("shell,v2,raw:id -u"), 3)
+            self.device.invalidate_cache("package")
+            self.device.get_uid()
+            self.assertEqual(self.server.requests.count("shell,v2,raw:id -u"), 4)
+
+            # 返回深拷贝，修改结果中的对象不会影响缓存
+            class Holder:
+                id = "memo-serial"
+
+                @memoize("package")
+                def get_items(self):
+                    return [{"name": "a"}]
+
+            items = Holder().get_items()
+            items[0]["name"] = "b"
+            self.assertEqual(Holder().get_items(), [{"name": "a"}])
+        finally:
+            environ.set_config("ANDROID_MEMO_CACHE", None)
+            memo_cache.invalidate("memo-serial")
+
+        cache = MemoCache(maxsize=2)
+        cache.put(("serial", "package", "a", (), ()), 1, ttl=30)
+        cache.put(("serial", "package", "b", (), ()), 2, ttl=30)
+        cache.put(("serial", "process", "c", (), ()), 3, ttl=0)
+        self.assertIs(cache.get(("serial", "package", "a", (), ())), __missing__)
+        self.assertEqual(cache.get(("serial", "package", "b", (), ())), 2)
+        self.assertIs(cache.get(("serial", "process", "c", (), ())), __missing__)
+        self.assertEqual(cache.stats["hits"], 1)
+        self.assertEqual(cache.stats["misses"], 2)
+
+    def test_prop_disk_cache(self):
+        path = PropCache._get_path(self.server.serial)
+        utils.ignore_error(os.remove, args=(path,))
+        self.server.add_command("getprop", stdout=b"[ro.build.fingerprint]: [a]\n[ro.product.model]: [Pixel]\n")
+        self.server.add_command("getprop ro.build.fingerprint", stdout=b"a\n")
+        fingerprint_request = "shell,v2,raw:getprop ro.build.fingerprint"
+
+        def wait_for(condition):
+            deadline = time.time() + 5
+            while not condition() and time.time() < deadline:
+                time.sleep(.01)
+            self.assertTrue(condition())
+
+        environ.set_config("ANDROID_PROP_DISK_CACHE", True)
+        try:
+            self.assertEqual(self.device.get_prop("ro.product.model"), "Pixel")
+            # 连接没变，直接使用磁盘缓存，fingerprint只在后台校验
+            prop_cache.invalidate(self.server.serial)
+            self.assertEqual(self.device.get_prop("ro.product.model"), "Pixel")
+            self.assertEqual(self.server.requests.count("shell,v2,raw:getprop"), 1)
+            wait_for(lambda: fingerprint_request in self.server.requests)
+            self.assertTrue(os.path.exists(path))
+            # 设备重连过，同步校验fingerprint，系统没变继续使用磁盘缓存
+            self.server.transport_id += 1
+            prop_cache.invalidate(self.server.serial)
+            count = self.server.requests.count(fingerprint_request)
+            self.assertEqual(self.device.get_prop("ro.product.model"), "Pixel")
+            self.assertEqual(self.server.requests.count(fingerprint_request), count + 1)
+            self.assertEqual(self.server.requests.count("shell,v2,raw:getprop"), 1)
+            # 设备号和transport_id相同但是系统不同，后台校验后丢弃磁盘缓存
+            self.server.add_command("getprop", stdout=b"[ro.build.fingerprint]: [b]\n[ro.product.model]: [Pixel 6]\n")
+            self.server.add_command("getprop ro.build.fingerprint", stdout=b"b\n")
+            prop_cache.invalidate(self.server.serial)
+            self.device.get_prop("ro.product.model")
+            wait_for(lambda: not os.path.exists(path))
+            self.assertEqual(self.device.get_prop("ro.product.model"), "Pixel 6")
+            self.assertEqual(self.server.requests.count("shell,v2,raw:getprop"), 2)
+            # 设备号相同但是系统不同，丢弃磁盘缓存
+            self.server.transport_id += 1
+            prop_cache.invalidate(self.server.serial)
+            self.server.add_command("getprop", stdout=b"[ro.build.fingerprint]: [c]\n[ro.product.model]: [Pixel 7]\n")
+            self.server.add_command("getprop ro.build.fingerprint", stdout=b"c\n")
+            self.assertEqual(self.device.get_prop("ro.product.model"), "Pixel 7")
+            self.assertEqual(self.server.requests.count("shell,v2,raw:getprop"), 3)
+        finally:
+            environ.set_config("ANDROID_PROP_DISK_CACHE", None)
+            utils.ignore_error(os.remove, args=(path,))
+
+    def test_agent_daemon(self):
+        daemon = self.device.agent_daemon
+        # stderr单独返回，不会混进结果
+        self.server.agents[daemon.name] = lambda params: (json.dumps([{"name": params[-1]}]), "warning: xxx\n")
+        self.assertEqual(daemon.call("package", "--packages", "com.test"), '[{"name": "com.test"}]')
+        self.assertEqual(daemon.call("package", "--packages", "com.test2"), '[{"name": "com.test2"}]')
+        # 多次调用复用同一个连接
+        self.assertEqual(self.server.requests.count(f"localabstract:{daemon.name}"), 1)
+        daemon.stop()
+
+        # 每个AgentDaemon使用随机的socket名和token，token不对的请求会被拒绝
+        other = AgentDaemon(self.device, start_timeout=.5)
+        self.assertNotEqual(other.name, daemon.name)
+        self.assertNotEqual(other.token, daemon.token)
+        self.server.agents[other.name] = self.server.agents[daemon.name]
+        self.server.agent_tokens[other.name] = daemon.token
+        with self.assertRaises(AgentDaemonError):
+            other.call("package", "--packages", "com.test")
+
+    def test_trace(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "trace.ndjson")
+            utils.start_tracing(path)
+            try:
+                self.device.get_prop("ro.product.model", cache=False)
+                utils.Popen(sys.executable, "-c", "print('hello')", capture_output=True).exec()
+            finally:
+                utils.stop_tracing()
+            with open(path) as fd:
+                events = [json.loads(line) for line in fd]
+        device_event, process_event = events
+        self.assertEqual((device_event["name"], device_event["cat"]), ("adb shell", "device"))
+        self.assertEqual(device_event["args"]["serial"], self.server.serial)
+        self.assertIn(__file__, device_event["args"]["caller"])
+        self.assertEqual(process_event["args"]["exit_code"], 0)
+        self.assertEqual(process_event["args"]["stdout_bytes"], len(os.linesep) + 5)
+        self.assertIsNone(utils.get_tracer())
+
+    def test_fallback(self):
+        self.server.close()
+        client = AdbClient(port=self.server.port)
+        self.assertFalse(client.is_available())
+
+
+class TestShellSession(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.server = FakeAdbServer()
+        self.executable = FakeAdbExecutable(self.temp_dir.name)
+        self.adb = self.executable.create_adb(self.server)
+        self.device = Device(self.server.serial, adb=self.adb)
+
+    def tearDown(self):
+        get_pool(self.device).close()
+        self.adb.client.close()
+        self.server.close()
+        self.temp_dir.cleanup()
+
+    def test_reuse(self):
+        for i in range(3):
+            self.assertEqual(self.device.shell("echo", i, session=True), str(i))
+        # 三次调用只启动了一个shell进程
+        self.assertEqual(self.executable.calls, 1)
+
+    def test_isolation(self):
+        cwd = self.device.shell("pwd", session=True)
+        self.device.shell("cd", "/", session=True)
+        self.device.shell("export", "LINKTOOLS_FOO=1", session=True)
+        self.assertEqual(self.device.shell("pwd", session=True), cwd)
+        self.assertEqual(self.device.shell("echo", "$LINKTOOLS_FOO", session=True), "")
+        self.assertEqual(self.executable.calls, 1)
+
+    def test_timeout(self):
+        with self.device.session() as session:
+            result = session.run("sleep", 10, timeout=.5)
+            self.assertIsNone(result.exit_code)
+            self.assertFalse(session.is_alive)
+        # 超时的会话被关闭，之后重新创建
+        self.assertEqual(self.device.shell("echo", "ok", session=True), "ok")
+        self.assertEqual(self.executable.calls, 2)
+
+        # 引号不匹配时shell会一直等待输入，没有指定超时时间也不会一直阻塞
+        environ.set_config("ANDROID_SHELL_SESSION_TIMEOUT", .5)
+        try:
+            with self.device.session() as session:
+                self.assertIsNone(session.run("echo", "'").exit_code)
+        finally:
+            environ.set_config("ANDROID_SHELL_SESSION_TIMEOUT", None)
+
+    def test_fallback(self):
+        self.server.shell_v2 = False
+        self.server.add_command("echo hello", stdout=b"hello\n")
+        self.assertEqual(self.device.shell("echo", "hello", session=True), "hello")
+        self.assertEqual(self.executable.calls, 0)
+        self.assertIn("shell:echo hello", self.server.requests)
+
+    def test_lost(self):
+        # 命令发送之后会话退出，命令可能已经执行，不能再通过adb shell执行一次
+        with self.assertRaises(ShellSessionLostError):
+            self.device.shell("kill", "-9", "$$", session=True)
+        self.assertFalse([r for r in self.server.requests if r.startswith("shell") and "kill" in r])
+
+
+class TestDeviceGroup(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = {}
+        self.commands = {"dev-ok": ["echo", "ok"], "dev-fail": ["ls", "/xxx"], "dev-slow": ["sleep", "3"]}
+        for serial in self.commands:
+            server = self.servers[serial] = FakeAdbServer(serial=serial)
+            server.add_command("echo ok", stdout=b"ok\n")
+            server.add_command("ls /xxx", stderr=b"ls: /xxx: No such file or directory\n", exit_code=1)
+            server.execute = True
+        self.adbs = {serial: Adb(options=["-P", server.port], native=True) for serial, server in self.servers.items()}
+
+    def tearDown(self):
+        for adb in self.adbs.values():
+            adb.client.close()
+        for server in self.servers.values():
+            server.close()
+
+    def make_group(self, *serials):
+        return DeviceGroup([Device(serial, adb=self.adbs[serial]) for serial in serials])
+
+    def run_command(self, device, timeout):
+        return device.shell(*self.commands[device.id], timeout=timeout)
+
+    def test_errors(self):
+        results = self.make_group("dev-fail", "dev-ok").map(self.run_command)
+        self.assertEqual([r.device.id for r in results], ["dev-fail", "dev-ok"])
+        self.assertIsInstance(results[0].error, AdbError)
+        self.assertFalse(results[0].is_success)
+        with self.assertRaises(AdbError):
+            results[0].get()
+        self.assertEqual(results[1].get(), "ok")
+
+    def test_device_timeout(self):
+        start_time = time.time()
+        results = self.make_group("dev-ok", "dev-slow").map(self.run_command, device_timeout=.5)
+        self.assertLess(time.time() - start_time, 2)
+        self.assertEqual(results[0].get(), "ok")
+        self.assertIsInstance(results[1].error, TimeoutError)
+        self.assertIsNotNone(results[1].elapsed)
+
+    def test_timeout(self):
+        start_time = time.time()
+        results = self.make_group("dev-ok", "dev-slow").map(self.run_command, max_workers=1, timeout=.5)
+        self.assertLess(time.time() - start_time, 2)
+        self.assertEqual(results[0].get(), "ok")
+        self.assertIsInstance(results[1].error, TimeoutError)
+
+    def test_cancel(self):
+        group = self.make_group("dev-slow", "dev-ok")
+        threading.Timer(.3, group.cancel).start()
+        start_time = time.time()
+        results = group.map(self.run_command, max_workers=1)
+        self.assertLess(time.time() - start_time, 2)
+        self.assertTrue(group.is_cancelled)
+        for result in results:
+            self.assertIsInstance(result.error, concurrent.futures.CancelledError)
+        # 取消之后还可以再次执行
+        self.commands["dev-slow"] = ["echo", "ok"]
+        results = group.map(self.run_command)
+        self.assertEqual([r.get() for r in results], ["ok", "ok"])
+        self.assertFalse(group.is_cancelled)
+
+
+class TestPackageStruct(unittest.TestCase):
+
+    def test_lazy_fields(self):
+        obj = {
+            "name": "com.test",
+            "activities": [{"name": "com.test.Main", "exported": True, "intents": [
+                {"actions": ["android.intent.action.MAIN"], "categories": ["android.intent.category.LAUNCHER"]},
+            ]}],
+        }
+        package = Package(obj)
+        self.assertEqual(package.name, "com.test")
+        # 组件列表在第一次访问时才解析
+        self.assertFalse(hasattr(package, "_activities"))
+        activities = package.activities
+        self.assertEqual([a.name for a in activities], ["com.test.Main"])
+        self.assertIsInstance(activities[0], Activity)
+        self.assertIs(package.activities, activities)
+        self.assertFalse(hasattr(package, "_services"))
+        self.assertEqual(package.services, [])
+        self.assertEqual(package.get_launch_activity().name, "com.test.Main")
+        package.activities = []
+        self.assertEqual(package.activities, [])
+
+    def test_iter_json_array(self):
+        data = ' [ {"a": [1, {"b": "]"}], "c": {"d": "x\\"]\\u005d,"}},\n"[\\"", [], [[1], {}], 1.5, null ] '
+        self.assertEqual(list(_iter_json_array(data)), json.loads(data))
+        self.assertEqual(list(_iter_json_array("[]")), [])
+        self.assertEqual(list(_iter_json_array(" [ ] ")), [])
+        with self.assertRaises(AdbError):
+            list(_iter_json_array('{"a": 1}'))
+        with self.assertRaises(ValueError):
+            list(_iter_json_array('[{"a": 1}, {"b": ]'))
+
+
+class TestPackageCache(unittest.TestCase):
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = PackageCache(os.path.join(temp_dir, "package.db"))
+            full = {"name": "com.test", "versionCode": 1, "lastUpdateTime": 100, "sourceDir": "/a", "activities": []}
+            simple = {"name": "com.test", "versionCode": 1, "lastUpdateTime": 100, "sourceDir": "/a"}
+            self.assertEqual(cache.get("serial", [simple]), {})
+            cache.put("serial", [full])
+            self.assertEqual(cache.get("serial", [simple]), {"com.test": full})
+            self.assertEqual(cache.get("other", [simple]), {})
+            # 版本变化后缓存失效
+            self.assertEqual(cache.get("serial", [dict(simple, lastUpdateTime=200)]), {})
+            self.assertEqual(cache.stats, {"hits": 1, "misses": 3})
+            cache.retain("serial", [])
+            self.assertEqual(cache.get("serial", [simple]), {})
+
+    def test_query(self):
+        serial = "package-query-serial"
+        names = [f"com.test.package{i:04d}" for i in range(300)]
+        versions = {name: 1 for name in names}
+        calls = []
+
+        def call_agent(*args):
+            calls.append(args)
+            if "--packages" in args:
+                selected = args[args.index("--packages") + 1:]
+            else:
+                selected = names
+            if "--simple" in args:
+                return json.dumps([{"name": name, "versionCode": versions[name]} for name in selected])
+            return json.dumps([{"name": name, "versionCode": versions[name], "activities": []} for name in selected])
+
+        def query(refresh=False):
+            calls.clear()
+            query = _PackageQuery(serial, ["package"], refresh=refresh)
+            args = query.args
+            while args is not None:
+                args = query.feed(call_agent(*args))
+            return [package.name for package in query.iter_packages()]
+
+        package_cache.clear(serial)
+        try:
+            # 缓存为空时直接获取一次完整信息，不传入包名
+            self.assertEqual(query(), names)
+            self.assertEqual(calls, [("package", "--simple"), ("package",)])
+            self.assertEqual(query(), names)
+            self.assertEqual(calls, [("package", "--simple")])
+            # 部分包有更新时分批获取，每批不超过命令长度限制
+            for name in names[:200]:
+                versions[name] = 2
+            self.assertEqual(query(), names)
+            batches = [call[2:] for call in calls[1:]]
+            self.assertGreater(len(batches), 1)
+            self.assertEqual([name for batch in batches for name in batch], names[:200])
+            for batch in batches:
+                self.assertLessEqual(len(" ".join(batch)), _package_names_max_length)
+            # 强制刷新时直接获取完整信息，解析的同时更新缓存
+            for name in names:
+                versions[name] = 3
+            self.assertEqual(query(refresh=True), names)
+            self.assertEqual(calls, [("package",)])
+            self.assertEqual(query(), names)
+            self.assertEqual(calls, [("package", "--simple")])
+        finally:
+            package_cache.clear(serial)
+
+
+class TestProcessSampler(unittest.TestCase):
+
+    class LocalDevice:
+        """
+        采样脚本直接在本机shell中执行
+        """
+        id = "local"
+        uid = 0
+
+        def popen(self, *args, **kwargs):
+            return subprocess.Popen(["sh", "-c", args[-1]], **kwargs)
+
+    @unittest.skipUnless(os.path.exists("/proc/self/stat"), "procfs required")
+    def test_sampler(self):
+        busy = subprocess.Popen([sys.executable, "-c", "while True: pass"])
+        output = io.StringIO()
+        sampler = ProcessSampler(self.LocalDevice(), interval=.2, callback=SnapshotWriter(output, "csv"))
+        try:
+            sampler.start()
+            for _ in range(3):
+                snapshot = sampler.wait_snapshot(timeout=5)
+            samples = [p for p in snapshot.processes if p.pid == busy.pid]
+            self.assertEqual(len(samples), 1)
+            self.assertGreater(samples[0].cpu, 50)
+            self.assertGreater(samples[0].rss, 0)
+            self.assertEqual(snapshot.top(1)[0].pid, busy.pid)
+        finally:
+            sampler.stop()
+            busy.kill()
+            busy.wait()
+        rows = list(csv.reader(io.StringIO(output.getvalue())))
+        self.assertEqual(rows[0], list(SnapshotWriter.fields))
+        self.assertIn(str(busy.pid), [row[1] for row in rows[1:]])
+
+
+class TestSocketMonitor(unittest.TestCase):
+
+    class LocalDevice:
+        """
+        直接读取本机的/proc/net
+        """
+        id = "local"
+
+        def shell_batch(self, commands, **kwargs):
+            results = []
+            for command in commands:
+                process = subprocess.run(["sh", "-c", command], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                results.append(ShellResult(command, process.stdout.decode(), process.stderr.decode(),
+                                           process.returncode))
+            return results
+
+        def get_packages(self, **kwargs):
+            return [Package({"name": "org.example", "userId": 10086})]
+
+    def test_parse(self):
+        sockets = parse_inet_sockets("tcp", [
+            "  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode",
+            "   0: 0100007F:1F90 00000000:0000 0A 00000000:00000001 00:00000000 00000000 10086        0 12345 1",
+        ])
+        self.assertEqual(len(sockets), 1)
+        self.assertEqual((sockets[0].local_address, sockets[0].local_port), ("127.0.0.1", 8080))
+        self.assertEqual((sockets[0].state, sockets[0].listening, sockets[0].uid), ("LISTEN", True, 10086))
+        self.assertEqual((sockets[0].inode, sockets[0].receive_queue), (12345, 1))
+
+        sockets = parse_unix_sockets([
+            "Num       RefCount Protocol Flags    Type St Inode Path",
+            "0000000000000000: 00000002 00000000 00010000 0001 01 23456 /dev/socket/zygote",
+        ])
+        self.assertEqual((sockets[0].path, sockets[0].type, sockets[0].state),
+                         ("/dev/socket/zygote", "STREAM", "LISTENING"))
+
+        monitor = SocketMonitor(self.LocalDevice(), protos=())
+        self.assertEqual(monitor._get_packages(InetSocket({"uid": 1010086})), ["org.example"])
+        self.assertEqual(monitor._get_packages(InetSocket({"uid": 1000})), [])
+
+    @unittest.skipUnless(os.path.exists("/proc/net/tcp"), "procfs required")
+    def test_monitor(self):
+        monitor = SocketMonitor(self.LocalDevice(), protos=("tcp",))
+        self.assertEqual(monitor.poll(), [])
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        port = server.getsockname()[1]
+        try:
+            changes = monitor.poll()
+            opened = [c for c in changes if c.action == SocketChange.OPEN and c.socket.local_port == port]
+            self.assertEqual(len(opened), 1)
+            self.assertTrue(opened[0].socket.listening)
+        finally:
+            server.close()
+        changes = monitor.poll()
+        self.assertIn(port, [c.socket.local_port for c in changes if c.action == SocketChange.CLOSE])
+
+
+class TestForwardManager(unittest.TestCase):
+
+    class FakeDevice:
+        id = "emulator-5554"
+
+        def __init__(self):
+            self.commands = []
+            self.forwards = {}
+
+        def exec(self, *args, **kwargs):
+            self.commands.append(args)
+            if args == ("forward", "--list"):
+                return "".join(f"{self.id} {local} {remote}\n" for local, remote in self.forwards.items())
+            elif args[:2] == ("forward", "--remove"):
+                self.forwards.pop(args[2], None)
+            elif args[0] == "forward":
+                self.forwards[args[1]] = args[2]
+            return ""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.registry = ForwardRegistry(os.path.join(self.temp_dir.name, "forward.json"), range(47134, 47234))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_ref_count(self):
+        device = self.FakeDevice()
+        manager = ForwardManager(device, self.registry)
+        forward1 = manager.forward("tcp:0", "localabstract:test")
+        forward2 = manager.forward(None, "localabstract:test")
+        self.assertEqual(forward1.local_port, forward2.local_port)
+        self.assertEqual(len([c for c in device.commands if c[0] == "forward" and c[1] != "--list"]), 1)
+
+        reserved = self.registry.reserve_port()
+        self.assertNotEqual(reserved, forward1.local_port)
+
+        forward1.stop()
+        forward1.stop()
+        self.assertIn(f"tcp:{forward1.local_port}", device.forwards)
+        forward2.stop()
+        self.assertEqual(device.forwards, {})
+
+    def test_stale_cleanup(self):
+        process = subprocess.Popen([sys.executable, "-c", "pass"])
+        process.wait()
+        device = self.FakeDevice()
+        device.forwards["tcp:47134"] = "tcp:27042"
+        with self.registry.transaction() as data:
+            data["forward"][f"{device.id}|tcp:47134"] = {
+                "serial": device.id, "local": "tcp:47134", "remote": "tcp:27042", "pids": [process.pid],
+            }
+
+        forward = ForwardManager(device, self.registry).forward("tcp:0", "tcp:1234")
+        self.assertIn(("forward", "--remove", "tcp:47134"), device.commands)
+        self.assertEqual(device.forwards, {forward._local: "tcp:1234"})
+        forward.stop()
+
+
+class TestRedirectEngine(unittest.TestCase):
+
+    class FakeDevice:
+        """
+        在本机shell中执行脚本，iptables和iptables-restore只记录调用参数
+        """
+        id = "local"
+
+        def __init__(self, bin_dir):
+            self.bin_dir = bin_dir
+            self.batches = 0
+
+        def shell_batch(self, commands, **kwargs):
+            self.batches += 1
+            env = dict(os.environ, PATH=f"{self.bin_dir}{os.pathsep}{os.environ['PATH']}")
+            results = []
+            for command in commands:
+                process = subprocess.run(["sh", "-c", command], env=env, stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE)
+                results.append(ShellResult(command, process.stdout.decode(), process.stderr.decode(),
+                                           process.returncode))
+            return results
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.log = os.path.join(self.temp_dir.name, "log")
+        for name, script in (("iptables", 'echo "iptables $*" >> "$LOG"; case "$3" in -C|-D) exit 1;; esac'),
+                             ("iptables-restore", 'echo "restore $*" >> "$LOG"; cat >> "$LOG"')):
+            path = os.path.join(self.temp_dir.name, name)
+            with open(path, "w") as fd:
+                fd.write(f"#!/bin/sh\nLOG={self.log}\n{script}\n")
+            os.chmod(path, 0o755)
+        self.device = self.FakeDevice(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def read_log(self):
+        with open(self.log) as fd:
+            lines = fd.read().splitlines()
+        os.remove(self.log)
+        return lines
+
+    def test_apply(self):
+        engine = RedirectEngine(self.device, chain="LT")
+        engine.apply([RedirectRule("10.0.0.2:8080", uids=[10086, "10100-10199"], ports=range(1, 20)),
+                      RedirectRule.dns("10.0.0.2:53")])
+        self.assertEqual(self.device.batches, 1)
+        log = self.read_log()
+        self.assertIn("iptables -t nat -I OUTPUT 1 -j LT", log)
+        self.assertIn("restore --noflush", log)
+        self.assertIn("-A LT -j LT_0", log)
+        self.assertEqual(len([line for line in log if line.startswith("-A LT_0 -p tcp")]), 4)
+        self.assertIn("-A LT_0 -p udp ! -o lo --dport 53 -j DNAT --to-destination 10.0.0.2:53", log)
+        self.assertIn("iptables -t nat -X LT_1", log)
+
+        # 切换规则时只替换跳转，不会清空nat表
+        engine.apply([RedirectRule("10.0.0.3:8080")])
+        log = self.read_log()
+        self.assertIn("-A LT -j LT_1", log)
+        self.assertIn("iptables -t nat -X LT_0", log)
+        self.assertFalse([line for line in log if line.strip() == "iptables -t nat -F"])
+
+        engine.clear()
+        log = self.read_log()
+        self.assertIn("iptables -t nat -D OUTPUT -j LT", log)
+        self.assertIn("iptables -t nat -X LT", log)
+
+    def test_shared(self):
+        engine = RedirectEngine(self.device, chain="LT")
+        port = forward_registry.reserve_port()
+        first = Redirect(engine, "127.0.0.1", port, f"127.0.0.1:{port}", reserved=True)
+        second = Redirect(engine, "10.0.0.3", 8080, "10.0.0.3:8080")
+        first.update(uids=[10086])
+        second.update(uids=[10087])
+        log = self.read_log()
+        self.assertIn(f"-A LT_1 -p tcp ! -o lo -m owner --uid-owner 10086 -j DNAT --to-destination 127.0.0.1:{port}", log)
+        self.assertIn("-A LT_1 -p tcp ! -o lo -m owner --uid-owner 10087 -j DNAT --to-destination 10.0.0.3:8080", log)
+
+        # 停止一个重定向时保留其他重定向的规则，并释放预留的端口
+        first.stop()
+        log = self.read_log()
+        self.assertIn("-A LT -j LT_0", log)
+        self.assertNotIn(f"127.0.0.1:{port}", "\n".join(log))
+        self.assertIn("-A LT_0 -p tcp ! -o lo -m owner --uid-owner 10087 -j DNAT --to-destination 10.0.0.3:8080", log)
+        self.assertNotIn("iptables -t nat -D OUTPUT -j LT", log)
+        with forward_registry.transaction() as data:
+            self.assertNotIn(str(port), data["ports"])
+
+        # 最后一个重定向停止后才移除整条链
+        second.stop()
+        log = self.read_log()
+        self.assertIn("iptables -t nat -D OUTPUT -j LT", log)
+        self.assertEqual(engine.rules, [])
+
+
+class TestForegroundTracker(unittest.TestCase):
+
+    class FakeDevice:
+        """
+        在本机shell中执行脚本，dumpsys和logcat输出固定内容
+        """
+        id = "local"
+
+        def __init__(self, bin_dir):
+            self.bin_dir = bin_dir
+
+        def popen(self, *args, **kwargs):
+            env = dict(os.environ, PATH=f"{self.bin_dir}{os.pathsep}{os.environ['PATH']}")
+            return subprocess.Popen(["sh", "-c", args[-1]], env=env, **kwargs)
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        dumpsys = (
+            "echo '  mResumedActivity: ActivityRecord{1a2b3c u0 com.android.launcher3/.Launcher t1}'\n"
+            "echo '  topResumedActivity=ActivityRecord{4d5e6f u0 com.android.settings/.Settings t2}'"
+        )
+        logcat = (
+            "echo '[0,com.android.chrome/com.google.android.apps.chrome.Main,resumeTopActivity]'\n"
+            "echo 'garbage'\n"
+            "echo '[0,com.android.settings/.SubSettings]'\n"
+            "sleep 30"
+        )
+        for name, script in (("dumpsys", dumpsys), ("logcat", logcat)):
+            path = os.path.join(self.temp_dir.name, name)
+            with open(path, "w") as fd:
+                fd.write(f"#!/bin/sh\n{script}\n")
+            os.chmod(path, 0o755)
+        self.device = self.FakeDevice(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_parse(self):
+        self.assertEqual(
+            parse_resumed_activity("  mResumedActivity: ActivityRecord{1a2b3c u0 com.example/.MainActivity t9}"),
+            "com.example/.MainActivity")
+        self.assertIsNone(parse_resumed_activity("  mResumedActivity: null"))
+
+    def test_get(self):
+        # 获取时不会启动logcat，需要显式调用start
+        tracker = ForegroundTracker.get(self.device)
+        self.assertIs(ForegroundTracker.get(self.device), tracker)
+        self.assertFalse(tracker.is_running)
+        self.assertFalse(tracker.is_ready)
+        self.assertIsNone(ForegroundTracker.find(self.device))
+
+    def test_tracker(self):
+        tracker = ForegroundTracker(self.device)
+        changes = queue.Queue()
+        tracker.add_listener(lambda package, activity: changes.put((package, activity)))
+        tracker.start()
+        try:
+            self.assertTrue(tracker.wait_ready(timeout=10))
+            self.assertTrue(tracker.is_ready)
+            self.assertEqual(changes.get(timeout=10), ("com.android.settings", "com.android.settings/.Settings"))
+            self.assertEqual(changes.get(timeout=10)[0], "com.android.chrome")
+            self.assertEqual(changes.get(timeout=10)[1], "com.android.settings/.SubSettings")
+            self.assertEqual(tracker.current_package, "com.android.settings")
+            self.assertTrue(tracker.is_running)
+        finally:
+            tracker.stop()
+        self.assertFalse(tracker.is_running)
+        self.assertFalse(tracker.is_ready)
+        self.assertFalse(tracker.failed)
+
+
+if __name__ == '__main__':
+    unittest.main()
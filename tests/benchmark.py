@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+"""
+android.adb.Device的延迟基准测试，不需要真机，设备端输出来自fake_device.json中录制的结果：
+    cd tests && python -m unittest benchmark
+
+CI中与单元测试一起运行，见.github/workflows/python-test.yml
+
+默认只检查与机器性能无关的指标：请求次数不能超过基线，新实现与旧实现、有缓存与无缓存的耗时比例不能超过上限
+
+BENCHMARK_SAVE=1        把本次结果写入benchmark.json作为新的基线
+BENCHMARK_STRICT=1      同时把中位数与基线比较，只在录制基线的机器上有意义
+BENCHMARK_LATENCY       模拟的单次往返延迟（秒），默认0.002，与基线不一致时不比较中位数
+BENCHMARK_TOLERANCE     BENCHMARK_STRICT=1时中位数允许超过基线的比例，默认1.0
+BENCHMARK_ROUNDS        每个用例执行的次数，默认20
+BENCHMARK_OUTPUT_SIZE   读取大量输出用例的数据量（字节），默认4MB，本地压测时可以调大到209715200（200MB）
+"""
+
+import json
+import os
+import queue
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+from typing import Any, Callable, Dict, List
+
+from adb import FakeAdbServer, FakeAdbExecutable
+from linktools import utils, environ
+from linktools.android import Device, Package
+from linktools.android.cache import package_cache
+from linktools.android.forward import ForwardManager, ForwardRegistry
+from linktools.android.memo import memo_cache
+from linktools.android.prop import prop_cache
+
+_root_path = os.path.dirname(os.path.abspath(__file__))
+_records_path = os.path.join(_root_path, "fake_device.json")
+_baseline_path = os.path.join(_root_path, "benchmark.json")
+
+_save = os.environ.get("BENCHMARK_SAVE", "") not in ("", "0", "false")
+_strict = os.environ.get("BENCHMARK_STRICT", "") not in ("", "0", "false")
+_latency = float(os.environ.get("BENCHMARK_LATENCY", "0.002"))
+_tolerance = float(os.environ.get("BENCHMARK_TOLERANCE", "1.0"))
+_rounds = int(os.environ.get("BENCHMARK_ROUNDS", "20"))
+_output_size = int(os.environ.get("BENCHMARK_OUTPUT_SIZE", str(4 * 1024 * 1024)))
+
+
+class BenchmarkResult:
+
+    def __init__(self, name: str, times: List[float], requests: float):
+        self.name = name
+        self.times = times
+        self.requests = requests
+
+    @property
+    def median(self) -> float:
+        return statistics.median(self.times)
+
+    @property
+    def mean(self) -> float:
+        return statistics.mean(self.times)
+
+    @property
+    def ops(self) -> float:
+        return 1 / self.mean if self.mean > 0 else 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"median": round(self.median, 6), "requests": self.requests}
+
+    def __str__(self):
+        return f"{self.name:<16} median {self.median * 1000:8.2f}ms  " \
+               f"min {min(self.times) * 1000:8.2f}ms  " \
+               f"{self.ops:8.1f} ops/s  " \
+               f"{self.requests:5.1f} requests/call"
+
+
+def run_benchmark(name: str, fn: Callable[[], Any], counter: Callable[[], int] = lambda: 0,
+                  rounds: int = _rounds, warmup: int = 2) -> BenchmarkResult:
+    """
+    先预热，再逐次计时，请求次数取平均值
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    start_count = counter()
+    for _ in range(rounds):
+        start_time = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start_time)
+    return BenchmarkResult(name, times, (counter() - start_count) / rounds)
+
+
+class BenchmarkMixin:
+    """
+    与benchmark.json中的基线比较，BENCHMARK_SAVE=1时记录新的基线
+    """
+
+    baselines: Dict[str, Any] = {}
+    results: Dict[str, BenchmarkResult] = {}
+
+    @staticmethod
+    def read_baselines() -> Dict[str, Any]:
+        if not os.path.exists(_baseline_path):
+            return {}
+        with open(_baseline_path) as fd:
+            return json.load(fd)
+
+    @classmethod
+    def load_baselines(cls):
+        cls.baselines = cls.read_baselines()
+        cls.results = {}
+
+    @classmethod
+    def save_baselines(cls):
+        for result in cls.results.values():
+            print(result, file=sys.stderr)
+        if _save:
+            # 只运行部分用例时，其他用例保留原来的基线
+            baselines = cls.read_baselines()
+            cases = baselines.get("cases", {}) if baselines.get("latency") == _latency else {}
+            cases.update({name: result.to_dict() for name, result in cls.results.items()})
+            with open(_baseline_path, "w") as fd:
+                json.dump({"latency": _latency, "cases": dict(sorted(cases.items()))}, fd, indent=2)
+                fd.write("\n")
+
+    def count_requests(self) -> int:
+        return 0
+
+    def check(self, name: str, fn: Callable[[], Any], rounds: int = _rounds,
+              warmup: int = 2, legacy: bool = False) -> BenchmarkResult:
+        """
+        :param legacy: 仅用于对比的旧实现，只记录结果，不与基线比较
+        """
+        result = run_benchmark(name, fn, self.count_requests, rounds=rounds, warmup=warmup)
+        self.results[name] = result
+        baseline = self.baselines.get("cases", {}).get(name)
+        if _save or legacy or baseline is None:
+            return result
+        # 请求次数不受机器性能影响，多一次往返就是回退
+        self.assertLessEqual(result.requests, baseline["requests"], f"{name}: more round trips than baseline")
+        if _strict and self.baselines.get("latency") == _latency:
+            limit = baseline["median"] * (1 + _tolerance)
+            self.assertLessEqual(result.median, limit,
+                                 f"{name}: median {result.median * 1000:.2f}ms exceeds {limit * 1000:.2f}ms")
+        return result
+
+    def check_ratio(self, result: BenchmarkResult, reference: BenchmarkResult, ratio: float) -> None:
+        """
+        两个用例在同一台机器上运行，中位数的比例不受机器性能影响
+        :param result: 新实现或有缓存的结果
+        :param reference: 旧实现或无缓存的结果
+        :param ratio: result的中位数最多是reference的多少倍
+        """
+        if _save:
+            return
+        self.assertLessEqual(result.median, reference.median * ratio,
+                             f"{result.name}: median {result.median * 1000:.2f}ms exceeds "
+                             f"{ratio} * {reference.name} {reference.median * 1000:.2f}ms")
+
+
+class TestDeviceBenchmark(BenchmarkMixin, unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.TemporaryDirectory()
+        cls.server = FakeAdbServer(latency=_latency)
+        cls.server.load_records(_records_path)
+        cls.executable = FakeAdbExecutable(cls.temp_dir.name, latency=_latency)
+        cls.adb = cls.executable.create_adb(cls.server)
+        cls.device = Device(cls.server.serial, adb=cls.adb)
+        cls.server.agents[cls.device.agent_daemon.name] = cls.server.call_agent
+        prop_cache.invalidate(cls.server.serial)
+        memo_cache.invalidate(cls.server.serial)
+        cls.load_baselines()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.device.agent_daemon.stop()
+        cls.adb.client.close()
+        cls.server.close()
+        cls.temp_dir.cleanup()
+        cls.save_baselines()
+
+    def count_requests(self) -> int:
+        return len(self.server.requests) + self.executable.calls
+
+    def test_shell(self):
+        self.assertEqual(self.device.shell("echo", "hello"), "hello")
+        self.check("shell", lambda: self.device.shell("echo", "hello"))
+
+    def test_get_prop(self):
+        self.assertEqual(self.device.get_prop("ro.product.model", cache=False), "Pixel 6")
+        self.check("get_prop", lambda: self.device.get_prop("ro.product.model", cache=False))
+
+    def test_get_packages(self):
+        packages = self.device.get_packages(refresh=True)
+        self.assertEqual([p.name for p in packages], ["com.android.settings", "com.android.chrome", "com.example.demo"])
+        self.check("get_packages", lambda: self.device.get_packages(refresh=True))
+
+    def test_get_processes(self):
+        self.assertEqual(len(self.device.get_processes()), 16)
+
+        def get_processes():
+            self.device.invalidate_cache("process")
+            return self.device.get_processes()
+
+        # 查询缓存需要显式开启
+        environ.set_config("ANDROID_MEMO_CACHE", True)
+        try:
+            uncached = self.check("get_processes", get_processes)
+            cached = self.check("get_processes_cached", self.device.get_processes)
+        finally:
+            environ.set_config("ANDROID_MEMO_CACHE", None)
+        self.check_ratio(cached, uncached, .1)
+
+    def test_install(self):
+        path = os.path.join(self.temp_dir.name, "base.apk")
+        utils.write_file(path, b"\0" * 1024 * 1024)
+        self.server.add_command(f"cmd package install -S {1024 * 1024} -r", stdout=b"Success\n")
+        self.check("install", lambda: self.device.install(path, opts=["-r"]), rounds=max(_rounds // 4, 1))
+
+    def test_forward(self):
+        registry = ForwardRegistry(os.path.join(self.temp_dir.name, "forward.json"), range(47134, 47234))
+        manager = ForwardManager(self.device, registry)
+
+        def forward():
+            manager.forward("tcp:0", "localabstract:benchmark").stop()
+
+        self.check("forward", forward, rounds=max(_rounds // 4, 1))
+
+
+def _make_package_dump(count: int = 400, components: int = 10) -> str:
+    """
+    用fake_device.json中录制的包信息构造一台装了很多应用的设备的agent输出，
+    每个包的组件按录制的组件复制到指定数量
+    """
+    with open(_records_path) as fd:
+        templates = json.loads(json.load(fd)["agents"]["package"])
+    keys = ("requestedPermissions", "permissions", "activities", "services", "receivers", "providers")
+    pools = {key: [item for template in templates for item in template.get(key) or []] for key in keys}
+    packages = []
+    for i in range(count):
+        package = {k: v for k, v in templates[i % len(templates)].items() if k not in keys}
+        package["name"] = f"{package['name']}{i}"
+        for key, pool in pools.items():
+            package[key] = [dict(pool[j % len(pool)], name=f"{pool[j % len(pool)]['name']}{j}")
+                            for j in range(components)]
+        packages.append(package)
+    return json.dumps(packages)
+
+
+def _measure_peak(fn: Callable[[], Any]) -> int:
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class TestPackageBenchmark(BenchmarkMixin, unittest.TestCase):
+    """
+    通过Device.iter_packages获取大量包信息，走的是实际调用时的agent和包信息缓存路径
+    """
+
+    keys = ("requested_permissions", "permissions", "activities", "services", "receivers", "providers")
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dump = _make_package_dump()
+        cls.temp_dir = tempfile.TemporaryDirectory()
+        cls.server = FakeAdbServer(serial="package-benchmark", latency=_latency)
+        cls.server.agent_outputs["package"] = cls.dump
+        cls.server.agent_outputs["package --simple"] = json.dumps([
+            {k: v for k, v in obj.items() if not isinstance(v, list)}
+            for obj in json.loads(cls.dump)
+        ])
+        cls.executable = FakeAdbExecutable(cls.temp_dir.name, latency=_latency)
+        cls.adb = cls.executable.create_adb(cls.server)
+        cls.device = Device(cls.server.serial, adb=cls.adb)
+        cls.server.agents[cls.device.agent_daemon.name] = cls.server.call_agent
+        package_cache.clear(cls.server.serial)
+        cls.load_baselines()
+
+    @classmethod
+    def tearDownClass(cls):
+        package_cache.clear(cls.server.serial)
+        cls.device.agent_daemon.stop()
+        cls.adb.client.close()
+        cls.server.close()
+        cls.temp_dir.cleanup()
+        cls.save_baselines()
+
+    def count_requests(self) -> int:
+        return len(self.server.requests) + self.executable.calls
+
+    def eager(self):
+        # 原来的实现：一次性解析整个数组，并构造所有组件对象
+        packages = [Package(obj) for obj in json.loads(self.device.call_agent("package"))]
+        for package in packages:
+            for key in self.keys:
+                for component in getattr(package, key):
+                    getattr(component, "intents", None)
+        return [package.name for package in packages if not package.system]
+
+    def lazy(self):
+        return [package.name for package in self.device.iter_packages() if not package.system]
+
+    def test_packages(self):
+        expected = self.eager()
+        environ.set_config("ANDROID_PACKAGE_CACHE", False)
+        try:
+            self.assertEqual(self.lazy(), expected)
+            eager = self.check("packages_eager", self.eager, rounds=3, warmup=0, legacy=True)
+            lazy = self.check("packages_lazy", self.lazy, rounds=3, warmup=0)
+            eager_peak, lazy_peak = _measure_peak(self.eager), _measure_peak(self.lazy)
+        finally:
+            environ.set_config("ANDROID_PACKAGE_CACHE", None)
+        # 开启缓存后，第一次获取完整信息并写入缓存，之后只需要获取简单信息
+        self.assertEqual(self.lazy(), expected)
+        cached = self.check("packages_cached", self.lazy, rounds=3, warmup=0)
+        cached_peak = _measure_peak(self.lazy)
+        print(f"packages: {len(self.dump) / 1024 / 1024:.1f}MB dump, peak memory "
+              f"eager {eager_peak / 1024 / 1024:.1f}MB, lazy {lazy_peak / 1024 / 1024:.1f}MB, "
+              f"cached {cached_peak / 1024 / 1024:.1f}MB", file=sys.stderr)
+        # 只按基本字段过滤时不需要构造组件对象，也不需要同时持有整个数组
+        self.check_ratio(lazy, eager, .5)
+        self.check_ratio(cached, eager, .5)
+        self.assertLess(lazy_peak, eager_peak / 2)
+        self.assertLess(cached_peak, eager_peak / 2)
+
+
+def _legacy_exec(process: utils.Popen):
+    """
+    原来的实现：每个管道一个线程按行读取，通过队列传给调用线程，再逐行拼接，仅用于对比
+    """
+    lines = queue.Queue()
+
+    def read_lines(io, flag):
+        for line in iter(io.readline, b""):
+            lines.put((flag, line))
+        lines.put((flag, None))
+
+    for flag, io in ((1, process.stdout), (2, process.stderr)):
+        threading.Thread(target=read_lines, args=(io, flag), daemon=True).start()
+    out = err = None
+    alive = 2
+    while alive:
+        flag, data = lines.get(timeout=1)
+        if data is None:
+            alive -= 1
+        elif flag == 1:
+            out = data if out is None else out + data
+        else:
+            err = data if err is None else err + data
+    process.wait()
+    return out, err
+
+
+class TestOutputBenchmark(BenchmarkMixin, unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.load_baselines()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.save_baselines()
+
+    @staticmethod
+    def make_output_process(size: int) -> utils.Popen:
+        return utils.Popen("sh", "-c", f"yes 0123456789012345678901234567890123456789 | head -c {size}",
+                           capture_output=True)
+
+    def test_large_output(self):
+        out, err = self.make_output_process(_output_size).exec()
+        self.assertEqual(len(out), _output_size)
+        self.check("output_large", lambda: self.make_output_process(_output_size).exec(), rounds=3, warmup=0)
+
+        # 旧实现逐行拼接是平方复杂度，只用1MB对比
+        size = 1024 * 1024
+        result = self.check("output_1m", lambda: self.make_output_process(size).exec(), rounds=3, warmup=0)
+        legacy = self.check("output_1m_threads", lambda: _legacy_exec(self.make_output_process(size)),
+                            rounds=3, warmup=0, legacy=True)
+        self.check_ratio(result, legacy, .1)
+
+    def test_small_commands(self):
+        def run_commands(fn):
+            for _ in range(1000):
+                with utils.Popen("echo", "hello", capture_output=True) as process:
+                    fn(process)
+
+        result = self.check("exec_1000", lambda: run_commands(utils.Popen.exec), rounds=3, warmup=0)
+        legacy = self.check("exec_1000_threads", lambda: run_commands(_legacy_exec), rounds=3, warmup=0, legacy=True)
+        # 耗时主要花在创建进程上，两次测量之间的波动较大，只检查没有明显变慢
+        self.check_ratio(result, legacy, 1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
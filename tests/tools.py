@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from linktools import environ, Tools, Tool, ToolError
+from linktools._tools import ToolIndex, ToolScheduler
+from linktools.cli.commands.common import tools as tools_command
+
+
+class TestToolIndex(unittest.TestCase):
+
+    def test_index(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "index.json")
+            index = ToolIndex(path, "key")
+            self.assertIsNone(index.paths)
+            index.put("adb", {"name": "adb", "absolute_path": "/a/adb"})
+            index.save(["/a"])
+
+            index = ToolIndex(path, "key")
+            self.assertEqual(index.paths, ["/a"])
+            self.assertEqual(index.get("adb"), {"name": "adb", "absolute_path": "/a/adb"})
+            # 键不同时不使用已有的结果
+            self.assertIsNone(ToolIndex(path, "other").paths)
+            self.assertIsNone(ToolIndex(path, "other").get("adb"))
+
+    def test_resolve(self):
+        tools = Tools(environ)
+        paths = tools.get_paths()
+        # 命中索引时与重新解析的结果一致
+        tools = Tools(environ)
+        self.assertEqual(tools.index.paths, paths)
+        for tool in tools:
+            self.assertEqual(tool.config, json.loads(json.dumps(tool._parse_config())))
+        # 修改过配置的工具不使用索引
+        tool = tools["adb"].copy(cmdline=sys.executable)
+        self.assertEqual(tool.absolute_path, sys.executable)
+
+
+class TestToolScheduler(unittest.TestCase):
+
+    class FakeTool(Tool):
+        """
+        下载只等待一段时间，解压时创建absolute_path
+        """
+
+        lock = threading.Lock()
+        downloads = []
+        installs = []
+
+        def _download(self, progress=None):
+            if self.exists:
+                return None
+            with self.lock:
+                self.downloads.append(self.name)
+            time.sleep(self.config.get("delay", .2))
+            if self.config.get("fail"):
+                raise ToolError(f"download {self} failed")
+            return self.name
+
+        def _install(self, temp_path):
+            if temp_path is not None:
+                with open(self.absolute_path, "w"):
+                    pass
+            with self.lock:
+                self.installs.append(self.name)
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.tools = Tools(environ)
+        self.tools.__dict__["index"] = None
+        self.tools.__dict__["items"] = {}
+        self.FakeTool.downloads.clear()
+        self.FakeTool.installs.clear()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def add_tool(self, name, depends_on=(), url=None, path=None, **kwargs):
+        self.tools.items[name] = self.FakeTool(self.tools, {
+            "name": name,
+            "depends_on": list(depends_on),
+            "download_url": f"http://example.com/{url or name}.zip",
+            "absolute_path": os.path.join(self.temp_dir.name, path or name),
+            "cmdline": "",
+            **kwargs,
+        })
+
+    def test_prepare(self):
+        # 依赖下载得更慢，也要先解压依赖
+        self.add_tool("a", depends_on=["b"], delay=.1)
+        self.add_tool("b", delay=.4)
+        self.add_tool("c")
+        # 同一个压缩包中的工具
+        self.add_tool("d", url="c", path="c")
+        self.add_tool("e", depends_on=["f"])
+        self.add_tool("f", fail=True)
+
+        start_time = time.time()
+        errors = self.tools.prepare("a", "c", "d", "e", parallel=4)
+        # 5个下载串行执行至少需要1秒
+        self.assertLess(time.time() - start_time, .8)
+        self.assertEqual(sorted(errors), ["e", "f"])
+        self.assertEqual(sorted(self.FakeTool.downloads), ["a", "b", "c", "e", "f"])
+        self.assertLess(self.FakeTool.installs.index("b"), self.FakeTool.installs.index("a"))
+        self.assertNotIn("e", self.FakeTool.installs)
+        self.assertIn("d", self.FakeTool.installs)
+
+    def test_circular(self):
+        self.add_tool("a", depends_on=["b"])
+        self.add_tool("b", depends_on=["a"])
+        with self.assertRaises(ToolError):
+            ToolScheduler(self.tools).resolve([self.tools["a"]])
+
+
+
+class TestToolsCommand(unittest.TestCase):
+
+    def test_all(self):
+        # --all只能与--download一起使用，不能用来清除或者执行工具
+        for args in (["--all"], ["--clear", "--all"], ["--all", "adb"], ["--download", "--all", "adb"]):
+            with self.assertRaises(SystemExit) as context:
+                tools_command.command.main(args)
+            self.assertEqual(context.exception.code, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()